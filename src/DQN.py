@@ -4,12 +4,22 @@
 # Author: Amir Alansary <amiralansary@gmail.com>
 
 import warnings
-from evaluator import Evaluator
+from evaluator import (Evaluator, BatchedEvaluator, MultiStartEvaluator,
+                       ParallelEvaluator, compare_models)
 from logger import Logger
 from trainer import Trainer
+from actor_learner import ActorLearnerTrainer
+from distributed import make_trainer, train_distributed
 from DQNModel import DQN
 from medical import MedicalPlayer, FrameStack
+from quantize import quantize_model
+from rollout import export_rollout
+from inference import InferenceRunner, tune_threads
+from ensemble import EnsembleEvaluator, load_model
+from timing import instrument_training
+from profiling import profile_training
 import argparse
+import functools
 import os
 import torch
 
@@ -44,10 +54,11 @@ EVAL_EPISODE = 50
 
 def get_player(directory=None, files_list=None, landmark_ids=None, viz=False,
                task="play", file_type="brain", saveGif=False, saveVideo=False,
-               multiscale=True, history_length=20, agents=1, logger=None):
+               multiscale=True, history_length=20, agents=1, logger=None,
+               screen_dims=IMAGE_SIZE):
     env = MedicalPlayer(
         directory=directory,
-        screen_dims=IMAGE_SIZE,
+        screen_dims=screen_dims,
         viz=viz,
         saveGif=saveGif,
         saveVideo=saveVideo,
@@ -80,8 +91,10 @@ if __name__ == '__main__':
     parser.add_argument(
         '--task',
         help='''task to perform,
-                must load a pretrained model if task is "play" or "eval"''',
-        choices=['play', 'eval', 'train'], default='train')
+                must load a pretrained model if task is "play", "eval" or
+                "export", and the teacher model if task is "distill"''',
+        choices=['play', 'eval', 'train', 'export', 'distill'],
+        default='train')
     parser.add_argument(
         '--file_type', help='Type of the training and validation files',
         choices=['brain', 'cardiac', 'fetal'], default='train')
@@ -134,6 +147,32 @@ if __name__ == '__main__':
     parser.add_argument(
         '--save_freq', help='Saves network every save_freq steps',
         default=1000, type=int)
+    parser.add_argument(
+        '--async_save',
+        help='Write the saved models on a background thread',
+        action='store_true', default=False)
+    parser.add_argument(
+        '--keep_checkpoints',
+        help='''Number of versions kept of every saved model, the older ones
+                are renamed name.1.pt, name.2.pt, ...''',
+        default=1, type=int)
+    parser.add_argument(
+        '--timing',
+        help='''Time the decoding, cropping, environment steps, replay
+                sampling, action selection and updates of training, written
+                to the board every epoch''',
+        action='store_true', default=False)
+    parser.add_argument(
+        '--profile',
+        help='''Number of environment steps profiled with cProfile and
+                torch.profiler, whose Chrome trace and summaries are written
+                to the log directory. 0 does not profile''',
+        default=0, type=int)
+    parser.add_argument(
+        '--profile_warmup',
+        help='''Number of environment steps before the profile starts, for
+                instance --init_memory_size to profile the updates''',
+        default=0, type=int)
     parser.add_argument(
         '--delta',
         help="""Amount to decreases epsilon each episode,
@@ -156,8 +195,166 @@ if __name__ == '__main__':
         help="""Number of agent steps between each training step on one
                 mini-batch""",
         default=1, type=int)
+    parser.add_argument(
+        '--snapshot_freq',
+        help="""Number of epochs between snapshots of the replay buffer and
+                training state (requires --write), 0 (default) for none.
+                Every snapshot writes the whole replay buffer to disk""",
+        default=0, type=int)
+    parser.add_argument(
+        '--resume',
+        help="""Path to a snapshot directory to resume training from,
+                skips filling the replay buffer""",
+        default=None, type=str)
+    parser.add_argument(
+        '--prefetch',
+        help="""Number of mini-batches sampled ahead of the learner on a
+                background thread, 0 to sample synchronously""",
+        default=0, type=int)
+    parser.add_argument(
+        '--prefill_episodes',
+        help="""Number of random episodes generated at once per volume to
+                fill the replay buffer before training, without stepping the
+                environment. 0 steps the environment""",
+        default=0, type=int)
+    parser.add_argument(
+        '--async_reset',
+        help='''Restart the agents whose training episode is over from new
+                starting points while the other agents go on''',
+        action='store_true', default=False)
+    parser.add_argument(
+        '--n_step',
+        help='Number of steps used for the multi-step Q-learning targets',
+        default=1, type=int)
+    parser.add_argument(
+        '--quantize',
+        help="""Run an int8 version of the model on CPU (play and eval
+                only). For eval, the distances are compared to the float
+                model on the same files and starting points""",
+        action='store_true', default=False)
+    parser.add_argument(
+        '--calibration_episodes',
+        help='Number of episodes used to calibrate the quantized model',
+        default=3, type=int)
+    parser.add_argument(
+        '--calib_files', type=argparse.FileType('r'), nargs='+',
+        help="""Filepaths to the text files that contain the lists of images
+                and landmarks ['images', 'landmarks'] played to calibrate the
+                quantized model, which must not be the evaluated ones. For
+                play, the played --files are used when not given""")
+    parser.add_argument(
+        '--export_path',
+        help="""Where the export task saves the TorchScript module playing
+                whole greedy episodes with the loaded model""",
+        default='policy_scripted.pt', type=str)
+    parser.add_argument(
+        '--rollout',
+        help="""Path to a TorchScript module saved by the export task, used
+                to play the episodes of play and eval""",
+        default=None, type=str)
+    parser.add_argument(
+        '--channels_last',
+        help='Use the channels_last_3d memory format for inference',
+        action='store_true', default=False)
+    parser.add_argument(
+        '--bf16',
+        help='Select actions with bfloat16 autocast on CPU',
+        action='store_true', default=False)
+    parser.add_argument(
+        '--compile',
+        help="""Compile the action selection with torch.compile, falls back
+                to eager mode if compilation fails""",
+        action='store_true', default=False)
+    parser.add_argument(
+        '--tune_threads',
+        help="""Pick the number of CPU threads with the fastest inference in
+                a short benchmark at startup""",
+        action='store_true', default=False)
+    parser.add_argument(
+        '--channels', nargs=4, type=int, default=[32, 32, 64, 64],
+        help='''Output channels of the conv layers of the trained or loaded
+                model, for distill those of the student''')
+    parser.add_argument(
+        '--image_size', nargs=3, type=int, default=list(IMAGE_SIZE),
+        help='''Size of the crops seen by the trained or loaded model, for
+                distill the student sees the centre of the teacher's crops''')
+    parser.add_argument(
+        '--starts',
+        help='''Number of random starting points searching every landmark at
+                once in play and eval, their frame stacks are batched in one
+                forward pass per step''',
+        default=1, type=int)
+    parser.add_argument(
+        '--select',
+        help='''How the location of a landmark is picked among the end points
+                of the --starts: "qvalue" keeps the one with the lowest
+                maximum Q-value (as the oscillation check does), "median"
+                takes their median''',
+        choices=['qvalue', 'median'], default='qvalue')
+    parser.add_argument(
+        '--eval_processes',
+        help='''Number of processes playing the files of eval and the
+                validation files during training, one file at a time each''',
+        default=1, type=int)
+    parser.add_argument(
+        '--eval_volumes',
+        help='''Number of files of eval and of the validation during
+                training played at the same time in one process, with one
+                batched forward pass per step''',
+        default=1, type=int)
+    parser.add_argument(
+        '--async_validation',
+        help='''Play the validation files in a background process on a copy
+                of the weights while training goes on''',
+        action='store_true', default=False)
+    parser.add_argument(
+        '--learner_thread',
+        help='''Run the updates on a background thread while the agents
+                keep stepping the environment, with at most this many updates
+                waiting. 0 updates in the training loop''',
+        default=0, type=int)
+    parser.add_argument(
+        '--actors',
+        help='''Number of actor processes playing the training episodes,
+                each with its own exploration rate, while the main process
+                only learns. 0 plays and learns in a single process''',
+        default=0, type=int)
+    parser.add_argument(
+        '--sync_freq',
+        help='Number of learner updates between weight copies to the actors',
+        default=100, type=int)
+    parser.add_argument(
+        '--ranks',
+        help='''Number of learner processes on this node, each playing its
+                own environment into its own replay shard and averaging its
+                gradients with the others (gloo backend). 1 trains in this
+                process''',
+        default=1, type=int)
+    parser.add_argument(
+        '--nodes',
+        help='Number of nodes running --ranks learner processes each',
+        default=1, type=int)
+    parser.add_argument(
+        '--node_rank', help='Index of this node among the --nodes',
+        default=0, type=int)
+    parser.add_argument(
+        '--dist_url',
+        help='Address of the first learner process on the first node',
+        default='tcp://127.0.0.1:29500', type=str)
+    parser.add_argument(
+        '--ensemble', nargs='+', default=None,
+        help='''Paths to several models evaluated together on the same files
+                instead of --load (eval only). A model with n agents looks for
+                the first n landmarks, the ensemble predicts the median of
+                their locations''')
+    parser.add_argument(
+        '--ensemble_stack', action='store_true',
+        help='''Run the --ensemble models of the same architecture in a
+                single vectorised call on CPU too, by default they are only
+                stacked on GPU''')
 
     args = parser.parse_args()
+    args.image_size = tuple(args.image_size)
 
     agents = len(args.landmarks)
 
@@ -165,7 +362,9 @@ if __name__ == '__main__':
     assert agents > 0
 
     # check input files
-    if args.task == 'play':
+    if args.task == 'export':
+        pass
+    elif args.task == 'play':
         error_message = f"""Wrong input files {len(args.files)} for {args.task}
                             task - should be 1 \'images.txt\' """
         assert len(args.files) == 1, (error_message)
@@ -174,70 +373,304 @@ if __name__ == '__main__':
                             {args.task} task - should be 2 [\'images.txt\',
                             \'landmarks.txt\'] """
         assert len(args.files) == 2, (error_message)
+    assert not (args.quantize and args.task == 'eval' and
+                args.calib_files is None), \
+        "--quantize needs --calib_files for eval, the evaluated files can " \
+        "not be used to calibrate"
+    assert args.calib_files is None or len(args.calib_files) == 2, \
+        "--calib_files should be 2 ['images.txt', 'landmarks.txt']"
+    assert args.ensemble is None or args.task == 'eval', \
+        "--ensemble is only used by the eval task"
+    assert args.ensemble is None or \
+        len(set(args.ensemble)) == len(args.ensemble), \
+        "the models of --ensemble must be different files"
+    assert args.ensemble is not None or not args.ensemble_stack, \
+        "--ensemble_stack needs --ensemble"
+    assert args.starts == 1 or not args.rollout, \
+        "--starts can not be combined with --rollout"
+    assert args.eval_processes == 1 or not (
+        args.rollout or args.quantize or args.starts > 1), \
+        "--eval_processes only runs the float model one start at a time"
+    assert args.eval_volumes == 1 or not (
+        args.rollout or args.starts > 1 or args.eval_processes > 1), \
+        "--eval_volumes can not be combined with --rollout, --starts or " \
+        "--eval_processes"
+    assert not args.async_validation or (
+        args.eval_processes == 1 and args.eval_volumes == 1), \
+        "--async_validation plays the files one at a time"
+    assert args.resume is None or (args.write and args.snapshot_freq > 0), \
+        "--resume needs --write and --snapshot_freq to keep taking snapshots"
+    assert args.actors == 0 or not (
+        args.async_reset or args.prefill_episodes > 0), \
+        "--async_reset and --prefill_episodes can not be combined with " \
+        "--actors, which play their own episodes"
+    distributed = args.task == 'train' and args.ranks * args.nodes > 1
+    assert not distributed or (
+        args.actors == 0 and args.learner_thread == 0 and
+        args.resume is None), \
+        "--ranks can not be combined with --actors, --learner_thread or " \
+        "--resume"
+    assert args.profile == 0 or not (distributed or args.actors > 0), \
+        "--profile counts the environment steps of this process, it can " \
+        "not be combined with --ranks or --actors"
+
+    if args.timing:
+        instrument_training()
+
+    # with several learner processes, rank 0 writes the logs
+    logger = Logger(args.logDir, args.write and not distributed,
+                    args.save_freq, async_save=args.async_save,
+                    keep=args.keep_checkpoints)
+    profiler = None
+    if args.profile > 0:
+        profiler = profile_training(logger.dir or args.logDir, args.profile,
+                                    args.profile_warmup, logger)
+
+    if args.task != 'export':
+        # load files into env to set num_actions, num_validation_files
+        # TODO: is this necessary?
+        init_player = MedicalPlayer(files_list=args.files,
+                                    file_type=args.file_type,
+                                    landmark_ids=args.landmarks,
+                                    screen_dims=IMAGE_SIZE,
+                                    # TODO: why is this always play?
+                                    task='play',
+                                    agents=agents,
+                                    logger=logger)
+        NUM_ACTIONS = init_player.action_space.n
+
+    if args.task == 'export':
+        dqn = DQN(agents, frame_history=FRAME_HISTORY, logger=logger,
+                  type=args.model_name, channels=args.channels,
+                  image_size=args.image_size)
+        model = dqn.q_network
+        model.load_state_dict(torch.load(args.load, map_location='cpu'))
+        export_rollout(model, args.export_path, agents,
+                       frame_history=FRAME_HISTORY,
+                       screen_dims=args.image_size)
+        logger.log(f"Exported the greedy rollout to {args.export_path}")
+    elif args.ensemble is not None:
+        models = {path: load_model(path, FRAME_HISTORY, NUM_ACTIONS,
+                                   args.image_size)
+                  for path in args.ensemble}
 
-    logger = Logger(args.logDir, args.write, args.save_freq)
-
-    # load files into env to set num_actions, num_validation_files
-    # TODO: is this necessary?
-    init_player = MedicalPlayer(files_list=args.files,
-                                file_type=args.file_type,
-                                landmark_ids=args.landmarks,
-                                screen_dims=IMAGE_SIZE,
-                                # TODO: why is this always play?
-                                task='play',
-                                agents=agents,
-                                logger=logger)
-    NUM_ACTIONS = init_player.action_space.n
-
-    if args.task != 'train':
+        def make_env(agents):
+            assert agents <= len(args.landmarks), \
+                f"a model of {agents} agents needs as many --landmarks"
+            return get_player(files_list=args.files,
+                              file_type=args.file_type,
+                              landmark_ids=args.landmarks[:agents],
+                              task=args.task,
+                              agents=agents,
+                              viz=0,
+                              logger=logger,
+                              screen_dims=args.image_size)
+        evaluator = EnsembleEvaluator(models, make_env, logger,
+                                      args.steps_per_episode,
+                                      stack=args.ensemble_stack or None)
+        evaluator.play_n_episodes()
+        evaluator.close()
+    elif args.task in ('play', 'eval'):
         # TODO: refactor DQN to not have to create both a q_network and
         # target_network
         dqn = DQN(agents, frame_history=FRAME_HISTORY, logger=logger,
-                  type=args.model_name)
+                  type=args.model_name, channels=args.channels,
+                  image_size=args.image_size)
         model = dqn.q_network
         model.load_state_dict(torch.load(args.load, map_location=model.device))
-        environment = get_player(files_list=args.files,
-                                 file_type=args.file_type,
-                                 landmark_ids=args.landmarks,
-                                 saveGif=args.saveGif,
-                                 saveVideo=args.saveVideo,
-                                 task=args.task,
-                                 agents=agents,
-                                 viz=args.viz,
-                                 logger=logger)
-        evaluator = Evaluator(environment, model, logger, agents,
-                              args.steps_per_episode)
-        evaluator.play_n_episodes()
-    else:  # train model
-        environment = get_player(task='train',
-                                 files_list=args.files,
-                                 file_type=args.file_type,
-                                 landmark_ids=args.landmarks,
-                                 agents=agents,
-                                 viz=args.viz,
-                                 multiscale=args.multiscale,
+
+        def make_env(screen_dims=args.image_size, viz=args.viz,
+                     saveGif=args.saveGif, saveVideo=args.saveVideo):
+            return get_player(files_list=args.files,
+                              file_type=args.file_type,
+                              landmark_ids=args.landmarks,
+                              saveGif=saveGif,
+                              saveVideo=saveVideo,
+                              task=args.task,
+                              agents=agents,
+                              viz=viz,
+                              logger=logger,
+                              screen_dims=screen_dims)
+        if args.quantize:
+            calib_env = make_env(viz=0, saveGif=False, saveVideo=False)
+            if args.calib_files is not None:
+                calib_env = get_player(files_list=args.calib_files,
+                                       file_type=args.file_type,
+                                       landmark_ids=args.landmarks,
+                                       task='eval',
+                                       agents=agents,
+                                       logger=logger,
+                                       screen_dims=args.image_size)
+            quantized = quantize_model(
+                model, calib_env, args.calibration_episodes,
+                args.steps_per_episode, logger)
+            if args.task == 'eval':
+                compare_models({"float": model, "int8": quantized},
+                               make_env, logger, agents,
+                               args.steps_per_episode)
+            model = quantized
+        rollout = None
+        if args.rollout is not None:
+            rollout = torch.jit.load(args.rollout)
+        runner = InferenceRunner(model, channels_last=args.channels_last,
+                                 bf16=args.bf16, compile=args.compile,
                                  logger=logger)
-        eval_env = None
-        if args.val_files is not None:
-            eval_env = get_player(task='eval',
-                                  files_list=args.val_files,
+        if args.tune_threads:
+            tune_threads(runner, torch.zeros(
+                (1, agents, FRAME_HISTORY) + args.image_size), logger=logger)
+        if args.starts > 1:
+            evaluator = MultiStartEvaluator(
+                lambda: make_env(viz=0, saveGif=False, saveVideo=False),
+                model, logger, agents, args.steps_per_episode,
+                starts=args.starts, select=args.select, runner=runner)
+            evaluator.play_n_episodes()
+            evaluator.close()
+        elif args.eval_processes > 1 and args.task == 'eval':
+            evaluator = ParallelEvaluator(
+                make_env(viz=0, saveGif=False, saveVideo=False), model,
+                logger, agents, args.steps_per_episode,
+                functools.partial(get_player,
+                                  files_list=[f.name for f in args.files],
                                   file_type=args.file_type,
                                   landmark_ids=args.landmarks,
+                                  task=args.task,
                                   agents=agents,
-                                  logger=logger)
-        trainer = Trainer(environment,
-                          eval_env=eval_env,
-                          batch_size=args.batch_size,
-                          image_size=IMAGE_SIZE,
-                          frame_history=FRAME_HISTORY,
-                          update_frequency=args.target_update_freq,
-                          replay_buffer_size=args.memory_size,
-                          init_memory_size=args.init_memory_size,
-                          gamma=GAMMA,
-                          steps_per_episode=args.steps_per_episode,
-                          max_episodes=args.max_episodes,
-                          delta=args.delta,
-                          logger=logger,
-                          model_name=args.model_name,
-                          train_freq=args.train_freq,
-                          ).train()
+                                  viz=0,
+                                  screen_dims=args.image_size),
+                args.eval_processes)
+            evaluator.play_n_episodes()
+            evaluator.close()
+        elif args.eval_volumes > 1 and args.task == 'eval':
+            evaluator = BatchedEvaluator(
+                lambda: make_env(viz=0, saveGif=False, saveVideo=False),
+                model, logger, agents, args.steps_per_episode,
+                args.eval_volumes, runner=runner)
+            evaluator.play_n_episodes()
+            evaluator.close()
+        elif not (args.quantize and args.task == 'eval'):
+            evaluator = Evaluator(make_env(), model, logger, agents,
+                                  args.steps_per_episode, rollout=rollout,
+                                  runner=runner)
+            evaluator.play_n_episodes()
+    else:  # train or distill model
+        teacher = None
+        if args.task == 'distill':
+            teacher = DQN(agents, frame_history=FRAME_HISTORY, logger=logger,
+                          type=args.model_name).q_network
+            teacher.load_state_dict(
+                torch.load(args.load, map_location=teacher.device))
+        # the replay buffer holds the crops seen by the teacher
+        env_image_size = IMAGE_SIZE if teacher is not None else args.image_size
+        make_env = functools.partial(
+            get_player, task='train',
+            files_list=[f.name for f in args.files],
+            file_type=args.file_type,
+            landmark_ids=args.landmarks,
+            agents=agents,
+            multiscale=args.multiscale,
+            screen_dims=env_image_size)
+        make_eval_env = None
+        if args.val_files is not None:
+            make_eval_env = functools.partial(
+                get_player, task='eval',
+                files_list=[f.name for f in args.val_files],
+                file_type=args.file_type,
+                landmark_ids=args.landmarks,
+                agents=agents,
+                screen_dims=args.image_size)
+        trainer_args = dict(batch_size=args.batch_size,
+                            image_size=env_image_size,
+                            frame_history=FRAME_HISTORY,
+                            update_frequency=args.target_update_freq,
+                            replay_buffer_size=args.memory_size,
+                            init_memory_size=args.init_memory_size,
+                            gamma=GAMMA,
+                            steps_per_episode=args.steps_per_episode,
+                            max_episodes=args.max_episodes,
+                            delta=args.delta,
+                            model_name=args.model_name,
+                            train_freq=args.train_freq,
+                            snapshot_freq=args.snapshot_freq,
+                            resume=args.resume,
+                            prefetch=args.prefetch,
+                            n_step=args.n_step,
+                            channels_last=args.channels_last,
+                            bf16=args.bf16,
+                            compile=args.compile,
+                            teacher=teacher,
+                            channels=args.channels,
+                            network_image_size=args.image_size,
+                            eval_processes=args.eval_processes,
+                            eval_volumes=args.eval_volumes,
+                            async_validation=args.async_validation,
+                            prefill_episodes=args.prefill_episodes,
+                            async_reset=args.async_reset)
+        if distributed:
+            train_distributed(
+                functools.partial(make_trainer,
+                                  make_env=make_env,
+                                  make_eval_env=make_eval_env,
+                                  log_dir=args.logDir,
+                                  write=args.write,
+                                  save_freq=args.save_freq,
+                                  async_save=args.async_save,
+                                  keep_checkpoints=args.keep_checkpoints,
+                                  timing=args.timing,
+                                  **trainer_args),
+                args.ranks, dist_url=args.dist_url, nodes=args.nodes,
+                node_rank=args.node_rank)
+        else:
+            environment = get_player(task='train',
+                                     files_list=args.files,
+                                     file_type=args.file_type,
+                                     landmark_ids=args.landmarks,
+                                     agents=agents,
+                                     viz=args.viz,
+                                     multiscale=args.multiscale,
+                                     logger=logger,
+                                     screen_dims=env_image_size)
+            eval_env = None
+            if args.val_files is not None:
+                eval_env = get_player(task='eval',
+                                      files_list=args.val_files,
+                                      file_type=args.file_type,
+                                      landmark_ids=args.landmarks,
+                                      agents=agents,
+                                      logger=logger,
+                                      screen_dims=args.image_size)
+            trainer_class = Trainer
+            if args.actors > 0:
+                trainer_class = functools.partial(
+                    ActorLearnerTrainer,
+                    make_env=make_env,
+                    actors=args.actors,
+                    sync_freq=args.sync_freq)
+            trainer = trainer_class(environment,
+                                    eval_env=eval_env,
+                                    logger=logger,
+                                    learner_thread=args.learner_thread,
+                                    make_eval_env=make_eval_env,
+                                    **trainer_args)
+            if args.tune_threads:
+                tune_threads(trainer.act_runner, torch.zeros(
+                    (1, agents, FRAME_HISTORY) + env_image_size),
+                    logger=logger)
+            trainer.train()
+            if teacher is not None and args.val_files is not None:
+                def make_env(screen_dims):
+                    return get_player(task='eval',
+                                      files_list=args.val_files,
+                                      file_type=args.file_type,
+                                      landmark_ids=args.landmarks,
+                                      agents=agents,
+                                      logger=logger,
+                                      screen_dims=screen_dims)
+                trainer.dqn.q_network.train(False)
+                compare_models({"teacher": teacher,
+                                "student": trainer.dqn.q_network},
+                               make_env, logger, agents,
+                               args.steps_per_episode)
+
+    if profiler is not None:
+        # the run may end before all the profiled steps
+        profiler.close()
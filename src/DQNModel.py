@@ -1,7 +1,105 @@
+import math
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 
 
+class GroupedLinear(nn.Module):
+    """
+    One linear layer per agent, stored as a single (agents, in, out) weight
+    and applied to all agents with one batched matrix multiplication.
+    With comm=True each agent's input is concatenated with the mean of the
+    inputs over agents (CommNet communication), the weight is then
+    (agents, 2 * in, out) and the concatenation is never materialised.
+    """
+
+    def __init__(self, agents, in_features, out_features, comm=False):
+        super(GroupedLinear, self).__init__()
+        self.agents = agents
+        self.in_features = in_features
+        self.out_features = out_features
+        self.comm = comm
+        total_in = in_features * (2 if comm else 1)
+        self.weight = nn.Parameter(torch.empty(agents, total_in,
+                                               out_features))
+        self.bias = nn.Parameter(torch.empty(agents, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self, xavier=False):
+        """ Same initialisation as nn.Linear (or xavier_uniform) per agent """
+        fan_in, fan_out = self.weight.shape[1:]
+        if xavier:
+            bound = math.sqrt(6 / (fan_in + fan_out))
+        else:
+            bound = 1 / math.sqrt(fan_in)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -1 / math.sqrt(fan_in),
+                         1 / math.sqrt(fan_in))
+
+    def forward(self, x):
+        """
+        Input is a tensor of size (batch_size, agents, in_features)
+        Output is a tensor of size (batch_size, agents, out_features)
+        """
+        bias = self.bias.unsqueeze(1)
+        weight = self.weight
+        if self.comm:
+            # cat((x, mean(x))) @ W == x @ W[:in] + mean(x) @ W[in:]
+            weight = self.weight[:, :self.in_features]
+            comm = torch.matmul(x.mean(1), self.weight[:, self.in_features:])
+            bias = bias + comm
+        output = torch.baddbmm(bias, x.transpose(0, 1), weight)
+        return output.transpose(0, 1)
+
+    def extra_repr(self):
+        return (f"agents={self.agents}, in_features={self.in_features}, "
+                f"out_features={self.out_features}, comm={self.comm}")
+
+
+def convert_state_dict(state_dict, prefix=""):
+    """
+    Convert checkpoints saved with per-agent nn.Linear / nn.PReLU heads
+    (keys fc1.0.weight, prelu4.0.weight, ...) to the GroupedLinear layout.
+    The dictionary is modified in place and returned.
+    """
+    for name in ("fc1", "fc2", "fc3", "prelu4", "prelu5"):
+        for param in ("weight", "bias"):
+            keys = []
+            while f"{prefix}{name}.{len(keys)}.{param}" in state_dict:
+                keys.append(f"{prefix}{name}.{len(keys)}.{param}")
+            if not keys:
+                continue
+            values = [state_dict.pop(key) for key in keys]
+            if name.startswith("prelu"):
+                value = torch.cat(values)
+            elif param == "weight":
+                value = torch.stack([v.t() for v in values])
+            else:
+                value = torch.stack(values)
+            state_dict[f"{prefix}{name}.{param}"] = value
+    return state_dict
+
+
+def _convert_state_dict_hook(state_dict, prefix, *args):
+    convert_state_dict(state_dict, prefix)
+
+
+def trunk_features(channels, image_size):
+    """
+    Number of features at the output of the conv trunk of Network3D /
+    CommNet for crops of size image_size
+    """
+    size = 1
+    for n in image_size:
+        n = (n - 2) // 2  # conv0 (k5, p1), maxpool0
+        n = (n - 2) // 2  # conv1 (k5, p1), maxpool1
+        n = (n - 1) // 2  # conv2 (k4, p1), maxpool2
+        n = n - 2  # conv3 (k3)
+        assert n > 0, f"crops of size {image_size} are too small"
+        size *= n
+    return channels[3] * size
+
+
 class Network2D(nn.Module):
 
     def __init__(self, agents, frame_history, number_actions):
@@ -80,64 +178,108 @@ class Network2D(nn.Module):
 
 class Network3D(nn.Module):
 
-    def __init__(self, agents, frame_history, number_actions, xavier=True):
+    def __init__(self, agents, frame_history, number_actions, xavier=True,
+                 channels=(32, 32, 64, 64), image_size=(45, 45, 45)):
+        """
+        :param channels: output channels of the four conv layers
+        :param image_size: size of the crops seen by the network
+        """
         super(Network3D, self).__init__()
 
         self.agents = agents
         self.frame_history = frame_history
+        self.image_size = tuple(image_size)
+        features = trunk_features(channels, image_size)
         self.device = torch.device(
             "cuda" if torch.cuda.is_available() else "cpu")
 
         self.conv0 = nn.Conv3d(
             in_channels=frame_history,
-            out_channels=32,
+            out_channels=channels[0],
             kernel_size=(5, 5, 5),
             padding=1).to(
             self.device)
         self.maxpool0 = nn.MaxPool3d(kernel_size=(2, 2, 2)).to(self.device)
         self.prelu0 = nn.PReLU().to(self.device)
         self.conv1 = nn.Conv3d(
-            in_channels=32,
-            out_channels=32,
+            in_channels=channels[0],
+            out_channels=channels[1],
             kernel_size=(5, 5, 5),
             padding=1).to(
             self.device)
         self.maxpool1 = nn.MaxPool3d(kernel_size=(2, 2, 2)).to(self.device)
         self.prelu1 = nn.PReLU().to(self.device)
         self.conv2 = nn.Conv3d(
-            in_channels=32,
-            out_channels=64,
+            in_channels=channels[1],
+            out_channels=channels[2],
             kernel_size=(4, 4, 4),
             padding=1).to(
             self.device)
         self.maxpool2 = nn.MaxPool3d(kernel_size=(2, 2, 2)).to(self.device)
         self.prelu2 = nn.PReLU().to(self.device)
         self.conv3 = nn.Conv3d(
-            in_channels=64,
-            out_channels=64,
+            in_channels=channels[2],
+            out_channels=channels[3],
             kernel_size=(3, 3, 3),
             padding=0).to(
             self.device)
         self.prelu3 = nn.PReLU().to(self.device)
 
-        self.fc1 = nn.ModuleList(
-            [nn.Linear(in_features=512, out_features=256).to(
-                self.device) for _ in range(self.agents)])
-        self.prelu4 = nn.ModuleList(
-            [nn.PReLU().to(self.device) for _ in range(self.agents)])
-        self.fc2 = nn.ModuleList(
-            [nn.Linear(in_features=256, out_features=128).to(
-                self.device) for _ in range(self.agents)])
-        self.prelu5 = nn.ModuleList(
-            [nn.PReLU().to(self.device) for _ in range(self.agents)])
-        self.fc3 = nn.ModuleList(
-            [nn.Linear(in_features=128, out_features=number_actions).to(
-                self.device) for _ in range(self.agents)])
+        # Individual layers, one set of weights per agent
+        self.fc1 = GroupedLinear(
+            self.agents, in_features=features,
+            out_features=256).to(self.device)
+        self.prelu4 = nn.PReLU(num_parameters=self.agents).to(self.device)
+        self.fc2 = GroupedLinear(
+            self.agents, in_features=256, out_features=128).to(self.device)
+        self.prelu5 = nn.PReLU(num_parameters=self.agents).to(self.device)
+        self.fc3 = GroupedLinear(
+            self.agents, in_features=128,
+            out_features=number_actions).to(self.device)
 
         if xavier:
             for module in self.modules():
                 if type(module) in [nn.Conv3d, nn.Linear]:
                     torch.nn.init.xavier_uniform(module.weight)
+                elif type(module) is GroupedLinear:
+                    module.reset_parameters(xavier=True)
+        # load checkpoints saved with per-agent nn.Linear heads
+        self._register_load_state_dict_pre_hook(_convert_state_dict_hook)
+
+    def trunk(self, input):
+        """
+        Shared layers, run once over all agents by folding the agent axis
+        into the batch axis.
+        Input is a tensor of size
+        (batch_size, agents, frame_history, *image_size)
+        Output is a tensor of size
+        (batch_size, agents, features)
+        """
+        x = input.reshape(-1, *input.shape[2:])
+        x = self.conv0(x)
+        x = self.prelu0(x)
+        x = self.maxpool0(x)
+        x = self.conv1(x)
+        x = self.prelu1(x)
+        x = self.maxpool1(x)
+        x = self.conv2(x)
+        x = self.prelu2(x)
+        x = self.maxpool2(x)
+        x = self.conv3(x)
+        x = self.prelu3(x)
+        return x.reshape(input.shape[0], input.shape[1], -1)
+
+    def heads(self, x):
+        """
+        Individual layers.
+        Input is a tensor of size
+        (batch_size, agents, features)
+        Output is a tensor of size
+        (batch_size, agents, number_actions)
+        """
+        x = self.prelu4(self.fc1(x))
+        x = self.prelu5(self.fc2(x))
+        return self.fc3(x)
 
     def forward(self, input):
         """
@@ -147,102 +289,115 @@ class Network3D(nn.Module):
         (batch_size, agents, number_actions)
         """
         input = input.to(self.device) / 255.0
-        output = []
-        for i in range(self.agents):
-            # Shared layers
-            x = input[:, i]
-            x = self.conv0(x)
-            x = self.prelu0(x)
-            x = self.maxpool0(x)
-            x = self.conv1(x)
-            x = self.prelu1(x)
-            x = self.maxpool1(x)
-            x = self.conv2(x)
-            x = self.prelu2(x)
-            x = self.maxpool2(x)
-            x = self.conv3(x)
-            x = self.prelu3(x)
-            x = x.view(-1, 512)
-            # Individual layers
-            x = self.fc1[i](x)
-            x = self.prelu4[i](x)
-            x = self.fc2[i](x)
-            x = self.prelu5[i](x)
-            x = self.fc3[i](x)
-            output.append(x)
-        output = torch.stack(output, dim=1)
+        output = self.heads(self.trunk(input))
         return output.cpu()
 
 
 class CommNet(nn.Module):
 
-    def __init__(self, agents, frame_history, number_actions, xavier=True):
+    def __init__(self, agents, frame_history, number_actions, xavier=True,
+                 channels=(32, 32, 64, 64), image_size=(45, 45, 45)):
+        """
+        :param channels: output channels of the four conv layers
+        :param image_size: size of the crops seen by the network
+        """
         super(CommNet, self).__init__()
 
         self.agents = agents
         self.frame_history = frame_history
+        self.image_size = tuple(image_size)
+        features = trunk_features(channels, image_size)
         self.device = torch.device(
             "cuda" if torch.cuda.is_available() else "cpu")
 
         self.conv0 = nn.Conv3d(
             in_channels=frame_history,
-            out_channels=32,
+            out_channels=channels[0],
             kernel_size=(5, 5, 5),
             padding=1).to(
             self.device)
         self.maxpool0 = nn.MaxPool3d(kernel_size=(2, 2, 2)).to(self.device)
         self.prelu0 = nn.PReLU().to(self.device)
         self.conv1 = nn.Conv3d(
-            in_channels=32,
-            out_channels=32,
+            in_channels=channels[0],
+            out_channels=channels[1],
             kernel_size=(5, 5, 5),
             padding=1).to(
             self.device)
         self.maxpool1 = nn.MaxPool3d(kernel_size=(2, 2, 2)).to(self.device)
         self.prelu1 = nn.PReLU().to(self.device)
         self.conv2 = nn.Conv3d(
-            in_channels=32,
-            out_channels=64,
+            in_channels=channels[1],
+            out_channels=channels[2],
             kernel_size=(4, 4, 4),
             padding=1).to(
             self.device)
         self.maxpool2 = nn.MaxPool3d(kernel_size=(2, 2, 2)).to(self.device)
         self.prelu2 = nn.PReLU().to(self.device)
         self.conv3 = nn.Conv3d(
-            in_channels=64,
-            out_channels=64,
+            in_channels=channels[2],
+            out_channels=channels[3],
             kernel_size=(3, 3, 3),
             padding=0).to(
             self.device)
         self.prelu3 = nn.PReLU().to(self.device)
 
-        self.fc1 = nn.ModuleList(
-            [nn.Linear(
-                in_features=512 * 2,
-                out_features=256).to(
-                self.device) for _ in range(
-                self.agents)])
-        self.prelu4 = nn.ModuleList(
-            [nn.PReLU().to(self.device) for _ in range(self.agents)])
-        self.fc2 = nn.ModuleList(
-            [nn.Linear(
-                in_features=256 * 2,
-                out_features=128).to(
-                self.device) for _ in range(
-                self.agents)])
-        self.prelu5 = nn.ModuleList(
-            [nn.PReLU().to(self.device) for _ in range(self.agents)])
-        self.fc3 = nn.ModuleList(
-            [nn.Linear(
-                in_features=128 * 2,
-                out_features=number_actions).to(
-                self.device) for _ in range(
-                self.agents)])
+        # Communication layers, each agent also sees the mean over agents
+        self.fc1 = GroupedLinear(
+            self.agents, in_features=features, out_features=256,
+            comm=True).to(self.device)
+        self.prelu4 = nn.PReLU(num_parameters=self.agents).to(self.device)
+        self.fc2 = GroupedLinear(
+            self.agents, in_features=256, out_features=128,
+            comm=True).to(self.device)
+        self.prelu5 = nn.PReLU(num_parameters=self.agents).to(self.device)
+        self.fc3 = GroupedLinear(
+            self.agents, in_features=128, out_features=number_actions,
+            comm=True).to(self.device)
 
         if xavier:
             for module in self.modules():
                 if type(module) in [nn.Conv3d, nn.Linear]:
                     torch.nn.init.xavier_uniform(module.weight)
+                elif type(module) is GroupedLinear:
+                    module.reset_parameters(xavier=True)
+        # load checkpoints saved with per-agent nn.Linear heads
+        self._register_load_state_dict_pre_hook(_convert_state_dict_hook)
+
+    def trunk(self, input):
+        """
+        Shared layers, run once over all agents by folding the agent axis
+        into the batch axis.
+        Input is a tensor of size
+        (batch_size, agents, frame_history, *image_size)
+        Output is a tensor of size
+        (batch_size, agents, features)
+        """
+        x = input.reshape(-1, *input.shape[2:])
+        x = self.conv0(x)
+        x = self.prelu0(x)
+        x = self.maxpool0(x)
+        x = self.conv1(x)
+        x = self.prelu1(x)
+        x = self.maxpool1(x)
+        x = self.conv2(x)
+        x = self.prelu2(x)
+        x = self.maxpool2(x)
+        x = self.conv3(x)
+        x = self.prelu3(x)
+        return x.reshape(input.shape[0], input.shape[1], -1)
+
+    def heads(self, x):
+        """
+        Communication and individual layers.
+        Input is a tensor of size
+        (batch_size, agents, features)
+        Output is a tensor of size
+        (batch_size, agents, number_actions)
+        """
+        x = self.prelu4(self.fc1(x))
+        x = self.prelu5(self.fc2(x))
+        return self.fc3(x)
 
     def forward(self, input):
         """
@@ -252,51 +407,7 @@ class CommNet(nn.Module):
         (batch_size, agents, number_actions)
         """
         input1 = input.to(self.device) / 255.0
-
-        # Shared layers
-        input2 = []
-        for i in range(self.agents):
-            x = input1[:, i]
-            x = self.conv0(x)
-            x = self.prelu0(x)
-            x = self.maxpool0(x)
-            x = self.conv1(x)
-            x = self.prelu1(x)
-            x = self.maxpool1(x)
-            x = self.conv2(x)
-            x = self.prelu2(x)
-            x = self.maxpool2(x)
-            x = self.conv3(x)
-            x = self.prelu3(x)
-            x = x.view(-1, 512)
-            input2.append(x)
-        input2 = torch.stack(input2, dim=1)
-
-        # Communication layers
-        comm = torch.mean(input2, axis=1)
-        input3 = []
-        for i in range(self.agents):
-            x = input2[:, i]
-            x = self.fc1[i](torch.cat((x, comm), axis=-1))
-            input3.append(self.prelu4[i](x))
-        input3 = torch.stack(input3, dim=1)
-
-        comm = torch.mean(input3, axis=1)
-        input4 = []
-        for i in range(self.agents):
-            x = input3[:, i]
-            x = self.fc2[i](torch.cat((x, comm), axis=-1))
-            input4.append(self.prelu5[i](x))
-        input4 = torch.stack(input4, dim=1)
-
-        comm = torch.mean(input4, axis=1)
-        output = []
-        for i in range(self.agents):
-            x = input4[:, i]
-            x = self.fc3[i](torch.cat((x, comm), axis=-1))
-            output.append(x)
-        output = torch.stack(output, dim=1)
-
+        output = self.heads(self.trunk(input1))
         return output.cpu()
 
 
@@ -308,34 +419,43 @@ class DQN:
             frame_history,
             logger,
             number_actions=6,
-            type="Network3d"):
+            type="Network3d",
+            n_step=1,
+            channels=(32, 32, 64, 64),
+            image_size=(45, 45, 45)):
         self.agents = agents
         self.number_actions = number_actions
         self.frame_history = frame_history
+        # transitions hold n-step returns, see ReplayMemory.sample
+        self.n_step = n_step
         self.logger = logger
         self.device = torch.device(
             "cuda" if torch.cuda.is_available() else "cpu")
         self.logger.log(f"Using {self.device}")
+        network_args = {"channels": channels, "image_size": image_size}
         # Create a Q-network, which predicts the q-value for a particular state
         if type == "Network3d":
             self.q_network = Network3D(
                 agents,
                 frame_history,
-                number_actions).to(
+                number_actions,
+                **network_args).to(
                 self.device)
             self.target_network = Network3D(
-                agents, frame_history, number_actions).to(
+                agents, frame_history, number_actions, **network_args).to(
                 self.device)
         elif type == "CommNet":
             self.q_network = CommNet(
                 agents,
                 frame_history,
-                number_actions).to(
+                number_actions,
+                **network_args).to(
                 self.device)
             self.target_network = CommNet(
                 agents,
                 frame_history,
-                number_actions).to(
+                number_actions,
+                **network_args).to(
                 self.device)
         elif type == "Network2d":
             self.q_network = Network2D(
@@ -357,6 +477,30 @@ class DQN:
         self.optimiser = torch.optim.Adam(self.q_network.parameters(), lr=1e-3)
         self.scheduler = torch.optim.lr_scheduler.StepLR(
             self.optimiser, step_size=50, gamma=0.5)
+        # number of processes averaging their gradients, see distribute
+        self.world_size = 1
+
+    def distribute(self):
+        """
+        Average the gradients of every update over the processes of the
+        default process group, starting from the weights of rank 0
+        """
+        self.world_size = dist.get_world_size()
+        for param in self.q_network.parameters():
+            dist.broadcast(param.data, src=0)
+        self.copy_to_target_network()
+
+    def average_gradients(self):
+        """ All-reduce the gradients of the Q-network in one flat buffer """
+        grads = [p.grad for p in self.q_network.parameters()
+                 if p.grad is not None]
+        flat = torch.cat([grad.flatten() for grad in grads])
+        dist.all_reduce(flat)
+        flat /= self.world_size
+        offset = 0
+        for grad in grads:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
 
     def copy_to_target_network(self):
         self.target_network.load_state_dict(self.q_network.state_dict())
@@ -375,10 +519,25 @@ class DQN:
         # Compute the gradients based on this loss, i.e. the gradients of the
         # loss with respect to the Q-network parameters.
         loss.backward()
+        if self.world_size > 1:
+            self.average_gradients()
         # Take one gradient step to update the Q-network.
         self.optimiser.step()
         return loss.item()
 
+    def distill(self, states, teacher_q_values):
+        """
+        One gradient step bringing the Q-values of the Q-network on states
+        closer to teacher_q_values (mean squared error).
+        """
+        self.optimiser.zero_grad()
+        q_values = self.q_network.forward(torch.as_tensor(states))
+        loss = torch.nn.functional.mse_loss(
+            q_values, torch.as_tensor(teacher_q_values, dtype=torch.float32))
+        loss.backward()
+        self.optimiser.step()
+        return loss.item()
+
     def _calculate_loss_tf(self, transitions, discount_factor):
         import tensorflow as tf
         curr_state = transitions[0]
@@ -420,14 +579,19 @@ class DQN:
         '''
         Transitions are tuple of shape
         (states, actions, rewards, next_states, dones)
+        where rewards are n_step returns, next_states are n_step ahead and
+        dones are True if the episode ended within the n steps
         '''
-        curr_state = torch.tensor(transitions[0])
-        next_state = torch.tensor(transitions[3])
-        terminal = torch.tensor(transitions[4]).type(torch.int)
+        # as_tensor shares memory with numpy arrays and prefetched tensors
+        curr_state = torch.as_tensor(transitions[0])
+        next_state = torch.as_tensor(transitions[3])
+        terminal = torch.as_tensor(transitions[4]).type(torch.int)
 
+        # each reward is clipped to [-1, 1], bound the discounted sum
+        bound = sum(discount_factor ** i for i in range(self.n_step))
         rewards = torch.clamp(
-            torch.tensor(
-                transitions[2], dtype=torch.float32), -1, 1)
+            torch.as_tensor(
+                transitions[2], dtype=torch.float32), -bound, bound)
 
         y = self.target_network.forward(next_state)
         # dim (batch_size, agents, number_actions)
@@ -440,13 +604,14 @@ class DQN:
         isNotOver = (torch.ones(*terminal.shape) - terminal)
         # Bellman equation
         batch_labels_tensor = rewards + isNotOver * \
-            (discount_factor * max_target_net.detach())
+            (discount_factor ** self.n_step * max_target_net.detach())
 
         # td_errors = (network_prediction -
         # batch_labels_tensor.unsqueeze(-1)).detach() # TODO td error needed
         # for exp replay
 
-        actions = torch.tensor(transitions[1], dtype=torch.long).unsqueeze(-1)
+        actions = torch.as_tensor(
+            transitions[1], dtype=torch.long).unsqueeze(-1)
         y_pred = torch.gather(network_prediction, -1, actions).squeeze()
 
         # Update transitions' weights
@@ -0,0 +1,222 @@
+import copy
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from expreplay import ReplayMemory
+from inference import InferenceRunner
+from timing import timers
+from trainer import Trainer
+
+
+def actor_epsilons(actors, base=0.4, alpha=7):
+    """ Fixed exploration rate of every actor, as in Ape-X """
+    if actors == 1:
+        return [base]
+    return [base ** (1 + alpha * i / (actors - 1)) for i in range(actors)]
+
+
+def _actor(index, make_env, shared, lock, version, transitions, stop,
+           epsilon, steps_per_episode, frame_history, image_size, chunk,
+           seed):
+    """
+    Play training episodes epsilon-greedily with the latest weights shared
+    by the learner, sending the transitions to the learner in chunks and
+    the distances and score at the end of every episode.
+    """
+    torch.set_num_threads(1)
+    np.random.seed(seed + index)
+    env = make_env()
+    model = copy.deepcopy(shared)
+    runner = InferenceRunner(model)
+    # only used for the frame history of the action selection
+    history = ReplayMemory(1, image_size, frame_history, env.agents)
+    number_actions = env.action_space.n
+    synced = -1
+    sent = []
+    while not stop.is_set():
+        if version.value != synced:
+            with lock:
+                model.load_state_dict(shared.state_dict())
+                synced = version.value
+        env.reset()
+        terminal = [False] * env.agents
+        score = np.zeros(env.agents)
+        for _ in range(steps_per_episode):
+            if np.random.random() < epsilon:
+                q_values = np.zeros((env.agents, number_actions))
+                acts = np.random.randint(number_actions, size=env.agents)
+            else:
+                acts, q_values = runner.greedy(torch.from_numpy(
+                    history.recent_state()).unsqueeze(0))
+            obs, reward, terminal, info = env.step(
+                np.copy(acts), q_values, terminal)
+            score += reward
+            transition = (obs.astype(np.uint8), acts, reward, terminal)
+            history.append(transition)
+            sent.append(transition)
+            if len(sent) >= chunk:
+                transitions.put((index, sent, None))
+                sent = []
+            if all(terminal) or stop.is_set():
+                break
+        distances = [info[f"distError_{i}"] for i in range(env.agents)]
+        transitions.put((index, sent, (distances, score.tolist())))
+        sent = []
+
+
+class ActorLearnerTrainer(Trainer):
+    """
+    Trainer whose episodes are played by several actor processes, each with
+    its own environment and a fixed exploration rate, while this process
+    only learns. The actors stream their transitions to one replay shard
+    each (the frame histories of an actor are contiguous in its shard) and
+    act with the weights of the learner, shared every sync_freq updates.
+    No snapshots of the replay are saved.
+    """
+
+    def __init__(self, env, make_env, actors=2, sync_freq=100, chunk=32,
+                 replay_buffer_size=1e6, **kwargs):
+        """
+        :param make_env: picklable function returning a new training
+            environment in the actors
+        :param sync_freq: number of learner updates between two copies of
+            the weights to the actors
+        :param chunk: number of transitions sent at once by the actors
+        :param replay_buffer_size: size of the replay of all the actors,
+            every actor fills a shard of replay_buffer_size // actors
+        """
+        super(ActorLearnerTrainer, self).__init__(
+            env, replay_buffer_size=replay_buffer_size // actors, **kwargs)
+        assert self.teacher is None, "distillation needs a single process"
+        assert self.resume is None, \
+            "the replay shards are not saved in snapshots"
+        self.make_env = make_env
+        self.actors = actors
+        self.sync_freq = sync_freq
+        self.chunk = chunk
+        self.epsilons = actor_epsilons(actors)
+        # the replay buffer of the single process trainer is the first shard
+        self.shards = [self.buffer] + [
+            ReplayMemory(self.replay_buffer_size, self.image_size,
+                         self.frame_history, self.agents,
+                         n_step=self.buffer.n_step, gamma=self.gamma)
+            for _ in range(actors - 1)]
+        self._rng = np.random.RandomState(0)
+
+    def ready_shards(self):
+        """ Shards holding at least one transition that can be sampled """
+        return [shard for shard in self.shards if
+                len(shard) > shard.history_len + shard.n_step]
+
+    def sample(self):
+        """ Mini-batch drawn from the shards in proportion of their size """
+        ready = self.ready_shards()
+        sizes = np.array([len(shard) for shard in ready], dtype=float)
+        counts = self._rng.multinomial(self.batch_size, sizes / sizes.sum())
+        batches = [shard.sample(n, rng=self._rng)
+                   for shard, n in zip(ready, counts) if n > 0]
+        return tuple(np.concatenate(arrays) for arrays in zip(*batches))
+
+    def share_weights(self, shared, lock, version):
+        with lock:
+            shared.load_state_dict(self.dqn.q_network.state_dict())
+            version.value += 1
+
+    def train(self):
+        self.logger.log(self.dqn.q_network)
+        self.logger.log(f"{self.actors} actors with epsilons "
+                        f"{np.round(self.epsilons, 4).tolist()}")
+        self.set_reproducible()
+        context = mp.get_context("spawn")
+        shared = copy.deepcopy(self.dqn.q_network).cpu()
+        shared.device = torch.device("cpu")
+        shared.train(False)
+        shared.share_memory()
+        lock = context.Lock()
+        version = context.Value("i", 0)
+        stop = context.Event()
+        transitions = context.Queue(maxsize=4 * self.actors)
+        processes = [context.Process(
+            target=_actor, daemon=True,
+            args=(i, self.make_env, shared, lock, version, transitions, stop,
+                  self.epsilons[i], self.steps_per_episode,
+                  self.frame_history, self.image_size, self.chunk, 0))
+            for i in range(self.actors)]
+        for process in processes:
+            process.start()
+
+        episode = 1
+        updates = 0
+        env_steps = 0
+        losses = []
+        epoch_distances = []
+        start = time.perf_counter()
+        epoch_start = (start, 0, 0)
+        self.logger.log("Initialising memory buffer...")
+        while episode <= self.max_episodes:
+            memory = sum(len(shard) for shard in self.shards)
+            # the transitions of a short init_memory_size may all be in
+            # shards too short to be sampled
+            learning = (memory >= self.init_memory_size and
+                        len(self.ready_shards()) > 0)
+            try:
+                index, sent, ended = transitions.get(
+                    block=not learning, timeout=1)
+            except queue.Empty:
+                index, sent, ended = None, [], None
+            for transition in sent:
+                self.shards[index].append(transition)
+            env_steps += len(sent)
+            if learning:
+                losses.append(self.train_step(self.sample()))
+                updates += 1
+                if updates % self.sync_freq == 0:
+                    self.share_weights(shared, lock, version)
+            if ended is None:
+                continue
+            distances, score = ended
+            epoch_distances.append(distances)
+            self.append_episode_board(
+                {f"distError_{i}": d for i, d in enumerate(distances)},
+                score, "train", episode)
+            if (episode * self.epoch_length) % self.update_frequency == 0:
+                self.dqn.copy_to_target_network()
+            self.poll_validation()
+            if episode % self.epoch_length == 0:
+                self.append_epoch_board(epoch_distances, self.epsilons[0],
+                                        losses, "train", episode)
+                now = time.perf_counter()
+                elapsed = now - epoch_start[0]
+                self.logger.write_to_board("throughput", {
+                    "env_steps_per_s": (env_steps - epoch_start[1]) / elapsed,
+                    "updates_per_s": (updates - epoch_start[2]) / elapsed},
+                    episode)
+                epoch_start = (now, env_steps, updates)
+                self.validation_epoch(episode)
+                self.dqn.save_model(name="latest_dqn.pt", forced=True)
+                self.logger.write_save_times(episode)
+                timers.write_to_board(self.logger, episode)
+                self.dqn.scheduler.step()
+                epoch_distances = []
+                losses = []
+            episode += 1
+
+        stop.set()
+        # the actors can only exit once their last chunks are consumed
+        while any(process.is_alive() for process in processes):
+            try:
+                transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in processes:
+            process.join()
+        if self.validator is not None:
+            self.poll_validation(wait=True)
+            self.validator.close()
+        self.evaluator.close()
+        self.logger.flush_models()
+        elapsed = time.perf_counter() - start
+        self.logger.log(f"{env_steps / elapsed:.1f} environment steps/s, "
+                        f"{updates / elapsed:.1f} updates/s")
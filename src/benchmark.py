@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import argparse
+import time
+import torch
+from DQNModel import Network3D, CommNet
+
+NETWORKS = {"Network3d": Network3D, "CommNet": CommNet}
+
+
+def looped_trunk(model, input):
+    """
+    Reference implementation running the shared layers once per agent,
+    as the networks did before the agent axis was folded into the batch.
+    """
+    output = []
+    for i in range(model.agents):
+        x = input[:, i]
+        x = model.prelu0(model.conv0(x))
+        x = model.maxpool0(x)
+        x = model.prelu1(model.conv1(x))
+        x = model.maxpool1(x)
+        x = model.prelu2(model.conv2(x))
+        x = model.maxpool2(x)
+        x = model.prelu3(model.conv3(x))
+        output.append(x.view(-1, 512))
+    return torch.stack(output, dim=1)
+
+
+def time_call(fn, repeats):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_trunk(name, agents, batch_size, repeats, frame_history=4,
+                image_size=(45, 45, 45)):
+    model = NETWORKS[name](agents, frame_history, 6)
+    input = torch.randint(0, 255, (batch_size, agents, frame_history) +
+                          image_size, dtype=torch.uint8)
+    input = input.to(model.device) / 255.0
+    results = {}
+    for mode, trunk in (("looped", lambda x: looped_trunk(model, x)),
+                        ("batched", model.trunk)):
+        def forward():
+            with torch.no_grad():
+                model.heads(trunk(input))
+
+        def backward():
+            model.zero_grad()
+            model.heads(trunk(input)).sum().backward()
+
+        results[mode] = (time_call(forward, repeats),
+                         time_call(backward, repeats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--model_name', help='Networks to benchmark', nargs='+',
+        default=["Network3d", "CommNet"], choices=list(NETWORKS))
+    parser.add_argument(
+        '--agents', help='Numbers of agents', nargs='+', type=int,
+        default=[1, 5, 8, 20])
+    parser.add_argument(
+        '--batch_sizes', help='Batch sizes', nargs='+', type=int,
+        default=[1, 64])
+    parser.add_argument(
+        '--repeats', help='Number of timed calls per measurement',
+        default=3, type=int)
+    args = parser.parse_args()
+
+    print(f"{'model':>10} {'agents':>6} {'batch':>5} "
+          f"{'fwd loop':>9} {'fwd batch':>9} {'f+b loop':>9} "
+          f"{'f+b batch':>9}  (seconds)")
+    for name in args.model_name:
+        for agents in args.agents:
+            for batch_size in args.batch_sizes:
+                res = bench_trunk(name, agents, batch_size, args.repeats)
+                print(f"{name:>10} {agents:>6} {batch_size:>5} "
+                      f"{res['looped'][0]:9.4f} {res['batched'][0]:9.4f} "
+                      f"{res['looped'][1]:9.4f} {res['batched'][1]:9.4f}")
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+import torch
+
+
+def cpu_copy(state_dict):
+    """ Copy of a state dict with its tensors cloned to CPU memory """
+    copy = type(state_dict)(
+        (key, value.detach().to("cpu", copy=True)
+         if torch.is_tensor(value) else value)
+        for key, value in state_dict.items())
+    metadata = getattr(state_dict, "_metadata", None)
+    if metadata is not None:
+        copy._metadata = metadata
+    return copy
+
+
+def rotate(path, keep):
+    """
+    Keep the previous keep - 1 versions of path as path.1, path.2, ... (the
+    most recent first), path itself is left in place
+    """
+    stem, ext = os.path.splitext(path)
+    for i in range(keep - 1, 1, -1):
+        if os.path.exists(f"{stem}.{i - 1}{ext}"):
+            os.replace(f"{stem}.{i - 1}{ext}", f"{stem}.{i}{ext}")
+    if keep > 1 and os.path.exists(path):
+        if os.path.exists(f"{stem}.1{ext}"):
+            os.remove(f"{stem}.1{ext}")
+        os.link(path, f"{stem}.1{ext}")
+
+
+def write_checkpoint(state_dict, path, keep=1):
+    """
+    torch.save state_dict next to path and rename it over path, keeping the
+    previous keep - 1 versions
+    """
+    torch.save(state_dict, path + ".tmp")
+    rotate(path, keep)
+    os.replace(path + ".tmp", path)
+
+
+class CheckpointWriter(object):
+    """
+    Writes state dicts with torch.save on a background thread, so that the
+    training loop only waits for a copy of the tensors to CPU memory. Each
+    file is written next to its destination and renamed over it, it is
+    never seen half written. When a file is saved again before the previous
+    version was written, only the most recent one is written.
+    An exception raised by a write is raised again by the next save or
+    flush.
+    """
+
+    def __init__(self, keep=1):
+        """
+        :param keep: number of versions kept of every file, the older ones
+            are named name.1.pt, name.2.pt, ...
+        """
+        self.keep = keep
+        self._pending = {}
+        self._writing = None
+        self._times = []
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                path = next(iter(self._pending))
+                state_dict = self._pending.pop(path)
+                self._writing = path
+            start = time.perf_counter()
+            try:
+                write_checkpoint(state_dict, path, self.keep)
+            except Exception as e:
+                self._error = e
+            with self._cond:
+                self._times.append(time.perf_counter() - start)
+                self._writing = None
+                self._cond.notify_all()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state_dict, path):
+        """ Write a CPU copy of state_dict to path in the background """
+        self._check()
+        state_dict = cpu_copy(state_dict)
+        with self._cond:
+            # a pending older version is not written
+            self._pending.pop(path, None)
+            self._pending[path] = state_dict
+            self._cond.notify_all()
+
+    def flush(self):
+        """ Wait until all the saved state dicts are written """
+        with self._cond:
+            while self._pending or self._writing is not None:
+                self._cond.wait()
+        self._check()
+
+    def write_times(self):
+        """ Durations in seconds of the writes done since the last call """
+        with self._cond:
+            times, self._times = self._times, []
+        return times
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
@@ -6,6 +6,7 @@
 import SimpleITK as sitk
 import numpy as np
 import warnings
+from collections import OrderedDict
 
 warnings.simplefilter("ignore", category=ResourceWarning)
 
@@ -17,6 +18,11 @@ __all__ = [
     'NiftiImage']
 
 
+def _filename(file):
+    """ path of a file given as a path or as an open file (argparse) """
+    return getattr(file, "name", file)
+
+
 def getLandmarksFromTXTFile(file, split=','):
     """
     Extract each landmark point line by line from a text file, and return
@@ -72,14 +78,14 @@ class filesListBrainMRLandmark(object):
         assert files_list, 'There is no file given'
         # read image filenames
         self.image_files = [line.split('\n')[0]
-                            for line in open(files_list[0].name)]
+                            for line in open(_filename(files_list[0]))]
         # read landmark filenames if task is train or eval
         self.returnLandmarks = returnLandmarks
         self.agents = agents
         if self.returnLandmarks:
             self.landmark_files = [
                 line.split('\n')[0] for line in open(
-                    files_list[1].name)]
+                    _filename(files_list[1]))]
             assert len(
                 self.image_files) == len(
                 self.landmark_files), """number of image files is not equal to
@@ -89,14 +95,15 @@ class filesListBrainMRLandmark(object):
     def num_files(self):
         return len(self.image_files)
 
-    def sample_circular(self, landmark_ids, shuffle=False):
-        """ return a random sampled ImageRecord from the list of files
+    def sample_circular(self, landmark_ids, shuffle=False, indexes=None):
+        """ return a random sampled ImageRecord from the list of files,
+        or from the files at the given indexes only
         """
         if shuffle:
             # TODO: could use PyTorch shuffles
             # indexes = rng.choice(x, len(x), replace=False)
             pass
-        else:
+        elif indexes is None:
             indexes = np.arange(self.num_files)
 
         while True:
@@ -139,14 +146,14 @@ class filesListCardioLandmark(object):
         assert files_list, 'There is no file given'
         # read image filenames
         self.image_files = [line.split('\n')[0]
-                            for line in open(files_list[0].name)]
+                            for line in open(_filename(files_list[0]))]
         # read landmark filenames if task is train or eval
         self.returnLandmarks = returnLandmarks
         self.agents = agents
         if self.returnLandmarks:
             self.landmark_files = [
                 line.split('\n')[0] for line in open(
-                    files_list[1].name)]
+                    _filename(files_list[1]))]
             assert len(
                 self.image_files) == len(
                 self.landmark_files), """number of image files is not equal to
@@ -156,13 +163,14 @@ class filesListCardioLandmark(object):
     def num_files(self):
         return len(self.image_files)
 
-    def sample_circular(self, landmark_ids, shuffle=False):
-        """ return a random sampled ImageRecord from the list of files
+    def sample_circular(self, landmark_ids, shuffle=False, indexes=None):
+        """ return a random sampled ImageRecord from the list of files,
+        or from the files at the given indexes only
         """
         if shuffle:
             # indexes = rng.choice(x, len(x), replace=False)
             pass
-        else:
+        elif indexes is None:
             indexes = np.arange(self.num_files)
 
         while True:
@@ -213,14 +221,14 @@ class filesListFetalUSLandmark(object):
         assert files_list, 'There is no file given'
         # read image filenames
         self.image_files = [line.split('\n')[0]
-                            for line in open(files_list[0].name)]
+                            for line in open(_filename(files_list[0]))]
         # read landmark filenames if task is train or eval
         self.returnLandmarks = returnLandmarks
         self.agents = agents
         if self.returnLandmarks:
             self.landmark_files = [
                 line.split('\n')[0] for line in open(
-                    files_list[1].name)]
+                    _filename(files_list[1]))]
             assert len(
                 self.image_files) == len(
                 self.landmark_files), """number of image files is not equal to
@@ -230,13 +238,14 @@ class filesListFetalUSLandmark(object):
     def num_files(self):
         return len(self.image_files)
 
-    def sample_circular(self, landmark_ids, shuffle=False):
-        """ return a random sampled ImageRecord from the list of files
+    def sample_circular(self, landmark_ids, shuffle=False, indexes=None):
+        """ return a random sampled ImageRecord from the list of files,
+        or from the files at the given indexes only
         """
         if shuffle:
             # indexes = rng.choice(x, len(x), replace=False)
             pass
-        else:
+        elif indexes is None:
             indexes = np.arange(self.num_files)
 
         while True:
@@ -271,9 +280,25 @@ class ImageRecord(object):
 class NiftiImage(object):
     """Helper class that provides TensorFlow image coding utilities."""
 
+    # number of decoded images kept and shared by all the instances, e.g.
+    # by several environments reading the same files in lockstep. The data
+    # of the cached images is read-only, the images and their SimpleITK
+    # images are shared and must not be modified.
+    cache_size = 0
+    _cache = OrderedDict()
+
     def __init__(self):
         pass
 
+    @staticmethod
+    def set_cache_size(size):
+        """ Keep at most size decoded images, returns the previous size """
+        previous = NiftiImage.cache_size
+        NiftiImage.cache_size = size
+        while len(NiftiImage._cache) > size:
+            NiftiImage._cache.popitem(last=False)
+        return previous
+
     def _is_nifti(self, filename):
         """Determine if a file contains a nifti format image.
         Args
@@ -292,6 +317,10 @@ class NiftiImage(object):
         Returns
           image: an image container with attributes; name, data, dims
         """
+        key = (filename, label)
+        if key in NiftiImage._cache:
+            NiftiImage._cache.move_to_end(key)
+            return NiftiImage._cache[key]
         image = ImageRecord()
         image.name = filename
         assert self._is_nifti(
@@ -307,14 +336,15 @@ class NiftiImage(object):
             p10 = np.percentile(np_image, 10)
             p99 = np.percentile(np_image, 99)
             p100 = np_image.max().astype('float')
+            # SimpleITK only takes Python floats
             sitk_image = sitk.Threshold(sitk_image,
-                                        lower=p10,
-                                        upper=p100,
-                                        outsideValue=p10)
+                                        lower=float(p10),
+                                        upper=float(p100),
+                                        outsideValue=float(p10))
             sitk_image = sitk.Threshold(sitk_image,
-                                        lower=p0,
-                                        upper=p99,
-                                        outsideValue=p99)
+                                        lower=float(p0),
+                                        upper=float(p99),
+                                        outsideValue=float(p99))
             sitk_image = sitk.RescaleIntensity(sitk_image,
                                                outputMinimum=0,
                                                outputMaximum=255)
@@ -324,4 +354,9 @@ class NiftiImage(object):
             sitk_image).transpose(2, 1, 0)  # .astype('uint8')
         image.dims = np.shape(image.data)
 
+        if NiftiImage.cache_size > 0:
+            image.data.flags.writeable = False
+            NiftiImage._cache[key] = (sitk_image, image)
+            while len(NiftiImage._cache) > NiftiImage.cache_size:
+                NiftiImage._cache.popitem(last=False)
         return sitk_image, image
@@ -0,0 +1,199 @@
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from logger import Logger
+from prefetch import BatchPrefetcher
+from timing import timers, instrument_training
+from trainer import Trainer
+
+
+class DistributedTrainer(Trainer):
+    """
+    Trainer running as one rank of a data-parallel learner. Every rank plays
+    its own environment into its own replay shard and averages its gradients
+    with the other ranks at every update (see DQN.distribute), so that the
+    Q-networks of all the ranks stay identical. The episodes finished by all
+    the ranks are summed after every update, from which every rank derives
+    the same target network copies, epsilon, scheduler steps and end of
+    training. Only rank 0 logs its episodes, validates and saves the models.
+    No snapshots of the replay are saved.
+    """
+
+    def __init__(self, env, rank=0, world_size=1, replay_buffer_size=1e6,
+                 init_memory_size=5e4, **kwargs):
+        """
+        :param replay_buffer_size: size of the replay of all the ranks,
+            every rank holds a shard of replay_buffer_size // world_size
+        :param init_memory_size: number of transitions filled in the replay
+            of all the ranks before training, split in the same way
+        """
+        super(DistributedTrainer, self).__init__(
+            env, replay_buffer_size=replay_buffer_size // world_size,
+            init_memory_size=init_memory_size // world_size, **kwargs)
+        assert self.teacher is None, "distillation needs a single process"
+        assert self.resume is None, \
+            "the replay shards are not saved in snapshots"
+        assert self.learner_thread == 0, \
+            "the updates of all the ranks must run in their training loops"
+        self.rank = rank
+        self.world_size = world_size
+        self.dqn.distribute()
+
+    def set_reproducible(self):
+        super(DistributedTrainer, self).set_reproducible()
+        # different episodes and exploration on every rank
+        np.random.seed(self.rank)
+
+    def sync_episodes(self, finished):
+        """ Number of episodes finished by all the ranks """
+        count = torch.tensor([finished], dtype=torch.int64)
+        dist.all_reduce(count)
+        return int(count.item())
+
+    def train(self):
+        self.logger.log(self.dqn.q_network)
+        self.logger.log(f"Rank {self.rank} of {self.world_size}")
+        self.set_reproducible()
+        self.init_memory()
+        prefetcher = None
+        if self.prefetch > 0:
+            prefetcher = BatchPrefetcher(self.buffer, self.batch_size,
+                                         depth=self.prefetch,
+                                         pin_memory=True, seed=self.rank)
+        # episodes finished by all the ranks
+        episode = 0
+        # (info, score) of the episodes finished here since the last update
+        finished = []
+        acc_steps = 0
+        updates = 0
+        losses = []
+        epoch_distances = []
+        start = time.perf_counter()
+        while episode < self.max_episodes:
+            obs = self.env.reset()
+            terminal = [False for _ in range(self.agents)]
+            score = [0] * self.agents
+            for step_num in range(self.steps_per_episode):
+                acc_steps += 1
+                acts, q_values = self.get_next_actions(
+                    self.buffer.recent_state())
+                obs, reward, terminal, info = self.env.step(
+                    np.copy(acts), q_values, terminal)
+                score = [sum(x) for x in zip(score, reward)]
+                self.buffer.append((obs, acts, reward, terminal))
+                episode_over = (all(t for t in terminal) or
+                                step_num == self.steps_per_episode - 1)
+                if episode_over:
+                    finished.append((info, score))
+                elif self.async_reset and any(terminal):
+                    terminal = self.restart_agents(terminal)
+                if acc_steps % self.train_freq == 0:
+                    if prefetcher is not None:
+                        mini_batch = prefetcher.next()
+                    else:
+                        mini_batch = self.buffer.sample(self.batch_size)
+                    losses.append(self.train_step(mini_batch))
+                    updates += 1
+                    total = episode + self.sync_episodes(len(finished))
+                    for info_, score_ in finished:
+                        epoch_distances.append(
+                            [info_['distError_' + str(i)]
+                             for i in range(self.agents)])
+                        if self.rank == 0:
+                            self.append_episode_board(info_, score_, "train",
+                                                      total)
+                    finished = []
+                    for ended in range(episode + 1, total + 1):
+                        if self.end_episode(ended, epoch_distances, losses):
+                            epoch_distances = []
+                            losses = []
+                    episode = total
+                    if episode >= self.max_episodes:
+                        break
+                if episode_over:
+                    break
+        if prefetcher is not None:
+            prefetcher.close()
+        if self.validator is not None:
+            self.poll_validation(wait=True)
+            self.validator.close()
+        self.evaluator.close()
+        self.logger.flush_models()
+        elapsed = time.perf_counter() - start
+        self.logger.log(f"rank {self.rank}: "
+                        f"{acc_steps / elapsed:.1f} environment steps/s, "
+                        f"{updates / elapsed:.1f} updates/s")
+
+    def end_episode(self, episode, epoch_distances, losses):
+        """
+        Bookkeeping of the episode-th episode finished by the ranks, returns
+        True at the end of an epoch
+        """
+        if (episode * self.epoch_length) % self.update_frequency == 0:
+            self.dqn.copy_to_target_network()
+        self.eps = max(self.min_eps, self.eps - self.delta)
+        self.poll_validation()
+        if episode % self.epoch_length != 0:
+            return False
+        if self.rank == 0:
+            # rank 0 may not have finished any episode of the epoch
+            if len(epoch_distances) > 0:
+                self.append_epoch_board(epoch_distances, self.eps, losses,
+                                        "train", episode)
+            self.validation_epoch(episode)
+            self.dqn.save_model(name="latest_dqn.pt", forced=True)
+            self.logger.write_save_times(episode)
+            timers.write_to_board(self.logger, episode)
+        self.dqn.scheduler.step()
+        return True
+
+
+def make_trainer(rank, world_size, make_env, make_eval_env=None,
+                 log_dir="runs", write=False, save_freq=10, async_save=False,
+                 keep_checkpoints=1, timing=False, **kwargs):
+    """
+    DistributedTrainer of rank, playing an environment returned by
+    make_env(logger=...). Only rank 0 writes logs and has the validation
+    environments of make_eval_env.
+    :param timing: time the hot paths of training, see instrument_training
+    """
+    if timing:
+        instrument_training()
+    logger = Logger(log_dir, write and rank == 0, save_freq,
+                    async_save=async_save, keep=keep_checkpoints)
+    eval_env = None
+    if rank == 0 and make_eval_env is not None:
+        eval_env = make_eval_env(logger=logger)
+    else:
+        make_eval_env = None
+    return DistributedTrainer(make_env(logger=logger), rank=rank,
+                              world_size=world_size, eval_env=eval_env,
+                              make_eval_env=make_eval_env, logger=logger,
+                              **kwargs)
+
+
+def _run_rank(local_rank, ranks, nodes, node_rank, dist_url, make):
+    rank = node_rank * ranks + local_rank
+    # the ranks of a node share its cores
+    torch.set_num_threads(max(1, torch.get_num_threads() // ranks))
+    dist.init_process_group("gloo", init_method=dist_url, rank=rank,
+                            world_size=nodes * ranks)
+    try:
+        make(rank, nodes * ranks).train()
+    finally:
+        dist.destroy_process_group()
+
+
+def train_distributed(make, ranks, dist_url="tcp://127.0.0.1:29500",
+                      nodes=1, node_rank=0):
+    """
+    Train with ranks processes on this node, out of nodes * ranks in total,
+    communicating with the gloo backend.
+    :param make: picklable function returning the DistributedTrainer of
+        (rank, world_size), for instance a functools.partial of make_trainer
+    :param dist_url: address of rank 0 on the first node
+    """
+    mp.spawn(_run_rank, args=(ranks, nodes, node_rank, dist_url, make),
+             nprocs=ranks, join=True)
@@ -0,0 +1,199 @@
+import copy
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state
+from DQNModel import Network3D, CommNet, convert_state_dict, trunk_features
+from dataReader import NiftiImage
+from inference import InferenceRunner
+
+
+def load_model(path, frame_history, number_actions, image_size):
+    """
+    Build the Network3D / CommNet saved at path, the number of agents, the
+    channels of the conv layers and the communication of the heads are
+    read from the checkpoint.
+    """
+    state_dict = convert_state_dict(torch.load(path, map_location="cpu"))
+    channels = [state_dict[f"conv{i}.weight"].shape[0] for i in range(4)]
+    agents, in_features = state_dict["fc1.weight"].shape[:2]
+    comm = in_features == 2 * trunk_features(channels, image_size)
+    network = CommNet if comm else Network3D
+    model = network(agents, frame_history, number_actions,
+                    channels=channels, image_size=image_size)
+    model.load_state_dict(state_dict)
+    model.train(False)
+    return model
+
+
+class StackedModels(object):
+    """
+    Models of the same architecture run in a single vectorised call
+    (torch.func.vmap over their stacked weights).
+    """
+
+    def __init__(self, models):
+        self.params, self.buffers = stack_module_state(models)
+        self.base = copy.deepcopy(models[0]).to("meta")
+        self.device = models[0].device
+
+    def q_values(self, members, inputs):
+        """
+        Q-values of the models at positions members, inputs is a tensor of
+        size (len(members), batch_size, agents, frame_history, *image_size)
+        """
+        index = torch.tensor(members, device=self.device)
+        params = {k: v[index] for k, v in self.params.items()}
+        buffers = {k: v[index] for k, v in self.buffers.items()}
+
+        def forward(params, buffers, x):
+            return functional_call(self.base, (params, buffers), (x,))
+        with torch.inference_mode():
+            return torch.vmap(forward)(params, buffers, inputs.float())
+
+
+class EnsembleEvaluator(object):
+    """
+    Evaluate several models on the same files at once. Every model plays in
+    its own environment, the environments step in lockstep and share the
+    decoded volumes, so each file is only read once. A model with n agents
+    looks for the first n landmarks, the prediction of the ensemble for a
+    landmark is the median of the locations found by the models looking for
+    it.
+    """
+
+    def __init__(self, models, make_env, logger, max_steps, stack=None,
+                 seed=0):
+        """
+        :param models: dictionary of the models by name
+        :param make_env: make_env(agents) returns a new evaluation
+            environment for the first agents landmarks
+        :param stack: run the models of the same architecture in a single
+            call, by default only on GPU where it saves kernel launches. On
+            CPU it is usually slower than running the models one after the
+            other, True stacks them on every device (--ensemble_stack).
+        """
+        self.names = list(models)
+        self.models = [models[name] for name in self.names]
+        self.logger = logger
+        self.max_steps = max_steps
+        self.seed = seed
+        self.agents = max(model.agents for model in self.models)
+        # all the environments decode the same file when they are reset,
+        # the cache size is restored by close
+        self._cache_size = NiftiImage.set_cache_size(
+            max(NiftiImage.cache_size, 1))
+        self.envs = [make_env(model.agents) for model in self.models]
+        self.runners = [InferenceRunner(model) for model in self.models]
+        if stack is None:
+            stack = self.models[0].device.type == "cuda"
+        groups = {}
+        for k, model in enumerate(self.models):
+            key = (type(model), model.image_size,
+                   tuple(p.shape for p in model.parameters()))
+            groups.setdefault(key, []).append(k)
+        self.groups = []
+        for members in groups.values():
+            stacked = None
+            if stack and len(members) > 1:
+                stacked = StackedModels([self.models[k] for k in members])
+            self.groups.append((members, stacked))
+
+    def close(self):
+        NiftiImage.set_cache_size(self._cache_size)
+
+    def _q_values(self, active, obs):
+        q_values = {}
+        for group, stacked in self.groups:
+            members = [k for k in group if k in active]
+            inputs = [torch.from_numpy(obs[k]).permute(
+                0, 4, 1, 2, 3).unsqueeze(0) for k in members]
+            if stacked is not None and len(members) > 1:
+                outputs = stacked.q_values([group.index(k) for k in members],
+                                           torch.stack(inputs))
+                for k, output in zip(members, outputs):
+                    q_values[k] = output.squeeze(0).cpu().numpy()
+            else:
+                for k, x in zip(members, inputs):
+                    q_values[k] = self.runners[k].q_values(
+                        x).squeeze(0).numpy()
+        return q_values
+
+    def play_one_episode(self, episode=0):
+        """
+        Play the next file with every model, the models with the same number
+        of agents start from the same locations. Returns the info
+        dictionaries of the environments at the end of the episode.
+        """
+        obs = []
+        for env in self.envs:
+            np.random.seed(self.seed + episode)
+            obs.append(env.reset())
+        isOver = [[False] * model.agents for model in self.models]
+        infos = [None] * len(self.models)
+        active = set(range(len(self.models)))
+        steps = 0
+        while steps < self.max_steps and active:
+            q_values = self._q_values(active, obs)
+            for k in sorted(active):
+                acts = q_values[k].argmax(-1).astype(np.int32)
+                obs[k], _, isOver[k], infos[k] = self.envs[k].step(
+                    acts, q_values[k], isOver[k])
+                if np.all(isOver[k]):
+                    active.discard(k)
+            steps += 1
+        return infos
+
+    def aggregate(self, infos):
+        """
+        Median location of every landmark over the models looking for it,
+        and its distance to the landmark.
+        """
+        results = []
+        for i in range(self.agents):
+            found = [k for k, model in enumerate(self.models)
+                     if model.agents > i]
+            locations = [[infos[k][f"agent_{axis}pos_{i}"]
+                          for axis in "xyz"] for k in found]
+            target = [infos[found[0]][f"landmark_{axis}pos_{i}"]
+                      for axis in "xyz"]
+            env = self.envs[found[0]].unwrapped
+            median = np.median(locations, 0)
+            results.append((median, env.calcDistance(median, target,
+                                                     env.spacing)))
+        return results
+
+    def play_n_episodes(self):
+        """
+        Play every file once, write the location and distance found by each
+        model and by the ensemble for every landmark and log the mean
+        distances. Returns the distances of the models and of the ensemble,
+        of size (files, models + 1, landmarks), nan where a model does not
+        look for a landmark.
+        """
+        self.logger.write_locations(
+            ["number", "Filename", "Landmark", "Model", "pos x", "pos y",
+             "pos z", "Distance"])
+        distances = []
+        for episode in range(self.envs[0].files.num_files):
+            infos = self.play_one_episode(episode)
+            filename = infos[0]["filename_0"]
+            row = np.full((len(self.models) + 1, self.agents), np.nan)
+            for i, (median, distance) in enumerate(self.aggregate(infos)):
+                for k, name in enumerate(self.names):
+                    if self.models[k].agents <= i:
+                        continue
+                    row[k, i] = infos[k][f"distError_{i}"]
+                    self.logger.write_locations(
+                        [episode + 1, filename, i, name] +
+                        [infos[k][f"agent_{axis}pos_{i}"] for axis in "xyz"] +
+                        [row[k, i]])
+                row[-1, i] = distance
+                self.logger.write_locations(
+                    [episode + 1, filename, i, "median"] + list(median) +
+                    [distance])
+            distances.append(row)
+        distances = np.array(distances)
+        means = np.nanmean(distances, 0)
+        for name, mean in zip(self.names + ["median"], means):
+            self.logger.log(f"{name}: mean distances {mean}")
+        return distances
@@ -1,20 +1,74 @@
+import copy
+import functools
+import time
+import multiprocessing
 import numpy as np
 import torch
+from collections import OrderedDict, deque
 from itertools import chain
+from inference import InferenceRunner
+from dataReader import NiftiImage
+
+
+class QValueCache(object):
+    """
+    Least recently used cache of the Q-values of the states met during an
+    episode, keyed by the signature of the frame history.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        q_values = self._cache.get(key)
+        if q_values is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return q_values
+
+    def put(self, key, q_values):
+        self._cache[key] = q_values
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
 
 
 class Evaluator(object):
-    def __init__(self, environment, model, logger, agents, max_steps):
+    def __init__(self, environment, model, logger, agents, max_steps,
+                 cache_size=10000, rollout=None, runner=None):
+        """
+        :param runner: InferenceRunner of model, a default one is created if
+            None
+        :param rollout: TorchScript GreedyRollout (see rollout.py) playing
+            whole episodes without returning to Python, used instead of
+            model when not rendering
+        :param cache_size: number of Q-values of revisited states kept during
+            an episode, 0 to always run the network
+        """
         self.env = environment
         self.model = model
         self.logger = logger
         self.agents = agents
         self.max_steps = max_steps
+        self.cache = QValueCache(cache_size) if cache_size > 0 else None
+        self.rollout = rollout
+        self.runner = runner if runner is not None else InferenceRunner(model)
 
     def play_n_episodes(self, render=False):
         """
         wraps play_one_episode, playing a single episode at a time and logs
-        results used when playing demos.
+        results used when playing demos. Returns the distances of every
+        episode.
         """
         self.model.train(False)
         headers = ["number"] + list(chain.from_iterable(zip(
@@ -28,8 +82,8 @@ class Evaluator(object):
             [f"Distance {i}" for i in range(self.agents)])))
         self.logger.write_locations(headers)
         distances = []
-        for k in range(self.env.files.num_files):
-            score, start_dists, q_values, info = self.play_one_episode(render)
+        for k, (score, start_dists, q_values, info) in enumerate(
+                self.play_episodes(render)):
             # TODO add to board?
             # self.logger.add_distances_board(start_dists, info, k)
             row = [k + 1] + list(chain.from_iterable(zip(
@@ -46,30 +100,69 @@ class Evaluator(object):
             self.logger.write_locations(row)
         self.logger.log(f"mean distances {np.mean(distances, 0)}")
         self.logger.log(f"Std distances {np.std(distances, 0, ddof=1)}")
+        if self.cache is not None and self.cache.hits + self.cache.misses:
+            self.logger.log(f"Q-value cache hit rate "
+                            f"{self.cache.hit_rate():.1%} ({self.cache.hits} "
+                            f"hits, {self.cache.misses} misses)")
+        return distances
+
+    def play_episodes(self, render=False):
+        """ play_one_episode on every file, yields their results """
+        for _ in range(self.env.files.num_files):
+            yield self.play_one_episode(render)
+
+    def close(self):
+        """
+        Stop the processes of the evaluator and restore the size of the
+        NiftiImage cache, if it changed them
+        """
+        pass
 
     def play_one_episode(self, render=False, frame_history=4):
+        if self.rollout is not None and not render:
+            return self.play_scripted_episode()
 
         def predict(obs_stack):
             """
             Run a full episode, mapping observation to action,
             using greedy policy.
             """
-            inputs = torch.tensor(obs_stack).permute(
+            inputs = torch.from_numpy(obs_stack).permute(
                 0, 4, 1, 2, 3).unsqueeze(0)
-            q_vals = self.model.forward(inputs).detach().squeeze(0)
-            idx = torch.max(q_vals, -1)[1]
-            greedy_steps = np.array(idx, dtype=np.int32).flatten()
-            return greedy_steps, q_vals.data.numpy()
+            return self.runner.greedy(inputs)
+
+        def frame():
+            """ what the agents see in the newest frame of the stack """
+            env = self.env.unwrapped
+            return (env.xscale,) + tuple(
+                (image.name, location)
+                for image, location in zip(env._image, env._location))
 
         obs_stack = self.env.reset()
+        # the observation is a function of the image, location and scale of
+        # the frames in the stack, FrameStack starts with empty frames
+        frames = deque([None] * (frame_history - 1) + [frame()],
+                       maxlen=frame_history)
+        if self.cache is not None:
+            # the weights may have changed since the last episode
+            self.cache.clear()
         # Here obs have shape (agent, *image_size, frame_history)
         sum_r = np.zeros((self.agents))
         isOver = [False] * self.agents
         start_dists = None
         steps = 0
         while steps < self.max_steps and not np.all(isOver):
-            acts, q_values = predict(obs_stack)
+            q_values = None
+            if self.cache is not None:
+                q_values = self.cache.get(tuple(frames))
+            if q_values is not None:
+                acts = q_values.argmax(-1).astype(np.int32)
+            else:
+                acts, q_values = predict(obs_stack)
+            if self.cache is not None:
+                self.cache.put(tuple(frames), q_values)
             obs_stack, r, isOver, info = self.env.step(acts, q_values, isOver)
+            frames.append(frame())
             steps += 1
             if start_dists is None:
                 start_dists = [
@@ -80,3 +173,345 @@ class Evaluator(object):
                 if not isOver[i]:
                     sum_r[i] += r[i]
         return sum_r, start_dists, q_values, info
+
+    def play_scripted_episode(self):
+        """ Same as play_one_episode, running the episode in self.rollout """
+        self.env.reset()
+        env = self.env.unwrapped
+        volumes = [torch.from_numpy(image.data) for image in env._image]
+        targets, spacing = None, None
+        if env.task != 'play':
+            targets = torch.tensor(np.array(env._target_loc),
+                                   dtype=torch.double)
+            spacing = torch.tensor(env.spacing, dtype=torch.double)
+        with torch.no_grad():
+            locations, score, q_values, terminal = self.rollout(
+                volumes, torch.tensor(env._location), env.xscale,
+                env.action_step, env.multiscale, self.max_steps, targets,
+                spacing)
+        env._location = [tuple(loc) for loc in locations[-1].tolist()]
+        env.terminal = [terminal] * self.agents
+        env.current_episode_score = [[s] for s in score.tolist()]
+        start_dists = None
+        if env.task != 'play':
+            env.cur_dist = [
+                env.calcDistance(env._location[i], env._target_loc[i],
+                                 env.spacing) for i in range(self.agents)]
+            start_dists = [
+                env.calcDistance(locations[0, i].tolist(),
+                                 env._target_loc[i], env.spacing)
+                for i in range(self.agents)]
+        return score.numpy(), start_dists, q_values.numpy(), env._get_info()
+
+
+class MultiStartEvaluator(Evaluator):
+    """
+    Search every landmark from several random starting points at once. One
+    environment per start reads the same volume (shared through the
+    NiftiImage cache), the frame stacks of all the starts still searching
+    go through the network in a single batch and the location reported for
+    each landmark is picked among the end points of the starts.
+    """
+
+    def __init__(self, make_env, model, logger, agents, max_steps, starts=8,
+                 select="qvalue", runner=None):
+        """
+        :param make_env: make_env() returns a new evaluation environment,
+            all reading the files in the same order
+        :param select: "qvalue" keeps the end point with the lowest maximum
+            Q-value, as MedicalPlayer.getBestLocation, "median" the median of
+            the end points
+        """
+        assert select in ("qvalue", "median"), f"unknown selection {select}"
+        # restored by close
+        self._cache_size = NiftiImage.set_cache_size(
+            max(NiftiImage.cache_size, 1))
+        self.envs = [make_env() for _ in range(starts)]
+        super(MultiStartEvaluator, self).__init__(
+            self.envs[0], model, logger, agents, max_steps, cache_size=0,
+            runner=runner)
+        self.select = select
+
+    def close(self):
+        NiftiImage.set_cache_size(self._cache_size)
+
+    def _q_values(self, obs):
+        inputs = torch.from_numpy(np.stack(obs)).permute(0, 1, 5, 2, 3, 4)
+        return self.runner.q_values(inputs).numpy()
+
+    def play_one_episode(self, render=False, frame_history=4):
+        obs = [env.reset() for env in self.envs]
+        isOver = [[False] * self.agents for _ in self.envs]
+        sum_r = np.zeros((len(self.envs), self.agents))
+        start_dists = None
+        active = list(range(len(self.envs)))
+        steps = 0
+        while steps < self.max_steps and active:
+            q_values = self._q_values([obs[s] for s in active])
+            for s, q in zip(active, q_values):
+                acts = q.argmax(-1).astype(np.int32)
+                obs[s], r, isOver[s], info = self.envs[s].step(
+                    acts, q, isOver[s])
+                if start_dists is None and s == 0:
+                    start_dists = [info[f"distError_{i}"]
+                                   for i in range(self.agents)]
+                sum_r[s] += np.where(isOver[s], 0, r)
+            active = [s for s in active if not np.all(isOver[s])]
+            steps += 1
+        # Q-values of the end points
+        q_values = self._q_values(obs)
+        envs = [env.unwrapped for env in self.envs]
+        locations = np.array([env._location for env in envs])
+        if self.select == "qvalue":
+            best = q_values.max(-1).argmin(0)
+            chosen = locations[best, np.arange(self.agents)]
+        else:
+            chosen = np.median(locations, 0)
+        env = envs[0]
+        info = env._get_info()
+        for i in range(self.agents):
+            for axis, value in zip("xyz", chosen[i]):
+                info[f"agent_{axis}pos_{i}"] = value
+            if env.task != 'play':
+                info[f"distError_{i}"] = env.calcDistance(
+                    chosen[i], env._target_loc[i], env.spacing)
+        # mean score over the starts and Q-values of all the end points
+        return sum_r.mean(0), start_dists, q_values, info
+
+
+class BatchedEvaluator(Evaluator):
+    """
+    Evaluator playing the episodes of several files at the same time in a
+    single process, one environment per file. The frame stacks of all the
+    episodes in progress go through the network in a single batch every
+    step, and an environment whose episode is over moves on to the next
+    file that has not been played yet.
+    """
+
+    def __init__(self, make_env, model, logger, agents, max_steps,
+                 volumes=8, runner=None):
+        """
+        :param make_env: make_env() returns a new evaluation environment
+        :param volumes: number of files played at the same time
+        """
+        # the new environments all start by decoding the first file,
+        # the cache size is restored by close
+        self._cache_size = NiftiImage.set_cache_size(
+            max(NiftiImage.cache_size, 1))
+        self.envs = [make_env() for _ in range(volumes)]
+        super(BatchedEvaluator, self).__init__(
+            self.envs[0], model, logger, agents, max_steps, cache_size=0,
+            runner=runner)
+
+    def close(self):
+        NiftiImage.set_cache_size(self._cache_size)
+
+    def play_episodes(self, render=False):
+        """ Play every file once, yields the results in file order """
+        assert not render, "the batched episodes can not be rendered"
+        files = iter(range(self.env.files.num_files))
+        episodes = {}
+        results = {}
+        next_file = 0
+
+        def start(j):
+            index = next(files, None)
+            if index is None:
+                return
+            self.envs[j].unwrapped.set_files([index])
+            episodes[j] = {"file": index, "obs": self.envs[j].reset(),
+                           "isOver": [False] * self.agents,
+                           "sum_r": np.zeros((self.agents)),
+                           "start_dists": None, "steps": 0}
+
+        for j in range(len(self.envs)):
+            start(j)
+        while episodes:
+            playing = sorted(episodes)
+            inputs = torch.from_numpy(np.stack(
+                [episodes[j]["obs"] for j in playing])).permute(
+                    0, 1, 5, 2, 3, 4)
+            q_values = self.runner.q_values(inputs).numpy()
+            for j, q in zip(playing, q_values):
+                episode = episodes[j]
+                acts = q.argmax(-1).astype(np.int32)
+                obs, r, isOver, info = self.envs[j].step(
+                    acts, q, episode["isOver"])
+                episode["obs"], episode["isOver"] = obs, isOver
+                episode["steps"] += 1
+                if episode["start_dists"] is None:
+                    episode["start_dists"] = [
+                        info[f"distError_{i}"] for i in range(self.agents)]
+                episode["sum_r"] += np.where(episode["isOver"], 0, r)
+                if (np.all(episode["isOver"]) or
+                        episode["steps"] >= self.max_steps):
+                    results[episode["file"]] = (
+                        episode["sum_r"], episode["start_dists"], q, info)
+                    del episodes[j]
+                    start(j)
+            while next_file in results:
+                yield results.pop(next_file)
+                next_file += 1
+
+
+# evaluator of the current worker process of ParallelEvaluator
+_worker = None
+
+
+def _init_worker(make_env, model, agents, max_steps):
+    global _worker
+    torch.set_num_threads(1)
+    _worker = Evaluator(make_env(), model, None, agents, max_steps)
+
+
+def _play_file(index, seed):
+    # the starting points of a file do not depend on the worker playing it
+    np.random.seed(seed + index)
+    _worker.env.unwrapped.set_files([index])
+    return _worker.play_one_episode()
+
+
+class ParallelEvaluator(Evaluator):
+    """
+    Evaluator playing the files in a pool of processes, each with its own
+    environment, a copy of the model in shared memory and a single torch
+    thread. The pool is started by the first play_episodes and reused by the
+    next ones until close. The results come back in file order.
+    """
+
+    def __init__(self, environment, model, logger, agents, max_steps,
+                 make_env, processes=None, seed=0):
+        """
+        :param environment: evaluation environment, only used for the list
+            of files
+        :param make_env: picklable function returning a new evaluation
+            environment in the workers, e.g. a functools.partial of
+            get_player with the paths of the files
+        :param processes: number of workers, the number of CPUs if None
+        :param seed: NumPy seed of the first file, the file i is played
+            with seed + i
+        """
+        super(ParallelEvaluator, self).__init__(
+            environment, model, logger, agents, max_steps, cache_size=0)
+        self.make_env = make_env
+        self.processes = processes or multiprocessing.cpu_count()
+        self.seed = seed
+        self.pool = None
+        self._shared_model = None
+
+    def play_episodes(self, render=False):
+        """
+        Play every file once in the pool, with the current weights of the
+        model. Yields the results of play_one_episode in file order.
+        """
+        assert not render, "the workers can not render"
+        num_files = self.env.files.num_files
+        if self.pool is None:
+            self._shared_model = copy.deepcopy(self.model).cpu()
+            self._shared_model.device = torch.device("cpu")
+            self._shared_model.train(False)
+            self._shared_model.share_memory()
+            context = multiprocessing.get_context("spawn")
+            self.pool = context.Pool(
+                min(self.processes, num_files), _init_worker,
+                (self.make_env, self._shared_model, self.agents,
+                 self.max_steps))
+        else:
+            # seen by the workers, which are idle between two calls
+            self._shared_model.load_state_dict(self.model.state_dict())
+        yield from self.pool.imap(functools.partial(_play_file,
+                                                    seed=self.seed),
+                                  range(num_files))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def _validate(state_dict):
+    _worker.model.load_state_dict(state_dict)
+    _worker.model.train(False)
+    return [info for _, _, _, info in _worker.play_episodes()]
+
+
+class AsyncValidator(object):
+    """
+    Play the validation files in a background process with a snapshot of
+    the weights, so that training goes on meanwhile. Only one validation
+    runs at a time.
+    """
+
+    def __init__(self, model, make_env, agents, max_steps):
+        """
+        :param make_env: picklable function returning a new evaluation
+            environment in the background process
+        """
+        model = copy.deepcopy(model).cpu()
+        model.device = torch.device("cpu")
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(1, _init_worker,
+                                 (make_env, model, agents, max_steps))
+        self._pending = None
+
+    def busy(self):
+        return self._pending is not None and not self._pending[2].ready()
+
+    def submit(self, episode, state_dict):
+        """ Validate the weights state_dict saved after episode """
+        assert not self.busy(), "a validation is already running"
+        state_dict = {k: v.detach().cpu().clone()
+                      for k, v in state_dict.items()}
+        self._pending = (episode, state_dict,
+                         self.pool.apply_async(_validate, (state_dict,)))
+
+    def result(self, wait=False):
+        """
+        Returns the episode, weights and info dictionaries of the episodes
+        of the last validation once it is over (waiting for it if wait),
+        None if there is no new result.
+        """
+        if self._pending is None:
+            return None
+        episode, state_dict, job = self._pending
+        if not (wait or job.ready()):
+            return None
+        self._pending = None
+        return episode, state_dict, job.get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def compare_models(models, make_env, logger, agents, max_steps, seed=0,
+                   repeats=10):
+    """
+    Evaluate every model of the dictionary models on the same files and
+    starting locations, then log their mean distances, time per episode and
+    latency of a single forward pass. make_env(image_size) returns a new
+    evaluation environment cropping images of that size.
+    """
+    results = {}
+    for name, model in models.items():
+        np.random.seed(seed)
+        runner = InferenceRunner(model)
+        evaluator = Evaluator(make_env(model.image_size), model, logger,
+                              agents, max_steps, cache_size=0, runner=runner)
+        start = time.perf_counter()
+        distances = evaluator.play_n_episodes()
+        elapsed = (time.perf_counter() - start) / len(distances)
+        example = torch.zeros(
+            (1, agents, model.frame_history) + tuple(model.image_size))
+        runner.q_values(example)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            runner.q_values(example)
+        latency = (time.perf_counter() - start) / repeats
+        results[name] = (np.mean(distances, 0), elapsed, latency)
+    for name, (distances, elapsed, latency) in results.items():
+        logger.log(f"{name}: mean distances {distances}, "
+                   f"{elapsed:.2f}s per episode, "
+                   f"{latency * 1000:.1f}ms per forward pass")
+    return results
@@ -1,14 +1,23 @@
 import numpy as np
-import copy
-from collections import deque
+import json
+import os
+import threading
+import uuid
+
+SNAPSHOT_ARRAYS = ('state', 'action', 'reward', 'isOver')
 
 
 class ReplayMemory(object):
-    def __init__(self, max_size, state_shape, history_len, agents):
+    def __init__(self, max_size, state_shape, history_len, agents,
+                 n_step=1, gamma=0.9):
         self.max_size = int(max_size)
         self.state_shape = state_shape
         self.history_len = int(history_len)
         self.agents = agents
+        # sampled transitions use n_step discounted returns
+        self.n_step = int(n_step)
+        self.gamma = gamma
+        self._discounts = (gamma ** np.arange(self.n_step)).astype('float32')
 
         self.state = np.zeros(
             (self.agents, self.max_size) + state_shape, dtype='uint8')
@@ -18,102 +27,164 @@ class ReplayMemory(object):
 
         self._curr_pos = 0
         self._curr_size = 0
-        # TODO: was maxlen = history_len - 1
-        self._hist = deque(maxlen=history_len)
+        # total number of appended transitions, used to find the slots that
+        # changed since the last snapshot
+        self._appended = 0
+        self._lock = threading.Lock()
+        self._snapshot_thread = None
+        self._snapshot = None
+        self._snapshot_error = None
+        # snapshots written by another run (or before a load) are rewritten
+        # in full rather than only their changed slots
+        self._lineage = uuid.uuid4().hex
+        # most recent frames, stored twice (mirrored ring) so the last
+        # history_len frames are always a contiguous window in time order
+        self._hist = np.zeros(
+            (self.agents, 2 * self.history_len) + tuple(state_shape),
+            dtype='uint8')
+        self._hist_pos = 0
 
     def append(self, exp):
         """Append the replay memory with experience sample
         Args:
             exp (Experience): contains (state, action, reward, isOver)
         """
-        # increase current memory size if it is not full yet
-        if self._curr_size < self.max_size:
-            self._assign(self._curr_pos, exp)
-            self._curr_pos = (self._curr_pos + 1) % self.max_size
-            self._curr_size += 1
-        else:
-            self._assign(self._curr_pos, exp)
-            self._curr_pos = (self._curr_pos + 1) % self.max_size
+        with self._lock:
+            # increase current memory size if it is not full yet
+            if self._curr_size < self.max_size:
+                self._assign(self._curr_pos, exp)
+                self._curr_pos = (self._curr_pos + 1) % self.max_size
+                self._curr_size += 1
+            else:
+                self._assign(self._curr_pos, exp)
+                self._curr_pos = (self._curr_pos + 1) % self.max_size
+            self._appended += 1
         if np.all(exp[3]):
-            self._hist.clear()
+            self._clear_hist()
         else:
-            self._hist.append(exp)
+            self._push_hist(exp[0])
+
+    def extend(self, states, actions, rewards, isOver):
+        """Append n transitions at once, as n calls to append would
+        Args:
+            states, actions, rewards, isOver: arrays of the n transitions in
+            time order, of shape (n, agents) + ...
+        """
+        # only the last max_size transitions would be kept
+        skip = max(0, len(actions) - self.max_size)
+        n = len(actions) - skip
+        with self._lock:
+            slots = (self._curr_pos + skip + np.arange(n)) % self.max_size
+            self.state[:, slots] = np.swapaxes(states[skip:], 0, 1)
+            self.action[:, slots] = np.swapaxes(actions[skip:], 0, 1)
+            self.reward[:, slots] = np.swapaxes(rewards[skip:], 0, 1)
+            self.isOver[:, slots] = np.swapaxes(isOver[skip:], 0, 1)
+            self._curr_pos = (self._curr_pos + skip + n) % self.max_size
+            self._curr_size = min(self.max_size, self._curr_size + skip + n)
+            self._appended += skip + n
+        # the frame history starts after the last transition where all the
+        # agents are over
+        over = np.flatnonzero(np.all(isOver, axis=1))
+        start = 0
+        if len(over):
+            self._clear_hist()
+            start = over[-1] + 1
+        for frames in states[max(start, len(actions) - self.history_len):]:
+            self._push_hist(frames)
+
+    def clear_history(self, agents):
+        """ Blank the recent frames of the given agents only, whose episode
+        restarted """
+        self._hist[agents] = 0
+
+    def _push_hist(self, frames):
+        k = self.history_len
+        self._hist[:, self._hist_pos] = frames
+        self._hist[:, self._hist_pos + k] = frames
+        self._hist_pos = (self._hist_pos + 1) % k
 
     def recent_state(self):
-        """ return a list of (hist_len,) + STATE_SIZE """
-        lst = list(self._hist)
-        states = []
-        for i in range(self.agents):
-            states_temp = [np.zeros(self.state_shape,
-                                    dtype='uint8')] \
-                                    * (self._hist.maxlen - len(lst))
-            states_temp.extend([k[0][i] for k in lst])
-            states.append(states_temp)
-        return np.array(states)
-
-    def _encode_sample(self, idx):
-        """ Sample an experience replay from memory with index idx
-        :returns: a tuple of (state, next_state, reward, action, isOver)
-                  where state is of shape STATE_SIZE + (history_length,)
+        """ return a view of shape (agents, hist_len) + STATE_SIZE,
+        zero padded at the start of an episode. The view is updated in place
+        by the next append, copy it to keep it.
         """
-        idx = (self._curr_pos + idx) % self._curr_size
+        return self._hist[:, self._hist_pos:self._hist_pos + self.history_len]
+
+    def _clear_hist(self):
+        self._hist.fill(0)
+        self._hist_pos = 0
+
+    def sample(self, batch_size, out=None, rng=np.random):
+        """ Sample a batch of transitions with one vectorized gather per array
+        :param out: optional tuple of arrays as returned by empty_batch, the
+                    batch is written into them in place
+        :param rng: random state used to draw the sample indexes
+        :returns: a tuple of (states, actions, rewards, next_states, isOver)
+                  where states are of shape
+                  (batch_size, agents, history_len) + STATE_SIZE.
+                  rewards are the n_step returns, clipped to [-1, 1] at each
+                  step before discounting, and next_states are n_step frames
+                  ahead. isOver is True if the episode ended within the n
+                  steps, in which case the return must not be bootstrapped.
+        """
+        if out is None:
+            out = self.empty_batch(batch_size)
+        states, actions, rewards, next_states, isOver = out
         k = self.history_len
+        n = self.n_step
+        with self._lock:
+            size = self._curr_size
+            # windows never run past the most recent transition into the
+            # oldest one
+            idx = self._curr_pos + rng.randint(0, size - k - n + 1,
+                                               size=batch_size)
+            # (batch_size, agents, history_len + n_step) indexes into the
+            # (agents * max_size) flattened memory
+            window = (idx[:, None] + np.arange(k + n)) % size
+            window = (window[:, None, :] +
+                      self.max_size * np.arange(self.agents)[None, :, None])
+            frames = self.state.reshape((-1,) + tuple(self.state_shape))
+            np.take(frames, window[:, :, :k], axis=0, out=states, mode='clip')
+            np.take(frames, window[:, :, n:], axis=0, out=next_states,
+                    mode='clip')
+            # action of the most recent state, rewards and terminals of the
+            # following n steps
+            steps = window[:, :, k - 1:k - 1 + n]
+            np.take(self.action.reshape(-1), steps[:, :, 0], out=actions,
+                    mode='clip')
+            step_rewards = np.clip(self.reward.reshape(-1)[steps], -1, 1)
+            step_over = self.isOver.reshape(-1)[steps]
+            window_over = self.isOver.reshape(-1)[window]
+        # rewards after the end of the episode are not accumulated
+        step_rewards[:, :, 1:] *= ~np.logical_or.accumulate(
+            step_over[:, :, :-1], axis=-1)
+        np.dot(step_rewards, self._discounts, out=rewards)
+        np.any(step_over, axis=-1, out=isOver)
+        # the next_state is a different episode if current_state.isOver==True
+        states[step_over[:, :, 0]] = 0
+        # frames up to the end of an earlier episode of the agent are blank,
+        # as in recent_state at the start of an episode
+        states[self._before_over(window_over[:, :, :k - 1])] = 0
+        next_states[self._before_over(window_over[:, :, n:n + k - 1])] = 0
+        return states, actions, rewards, next_states, isOver
 
-        states = []
-        next_states = []
-        rewards = []
-        actions = []
-        isOver = []
-        for i in range(self.agents):
-            if idx + k < self._curr_size:
-                states.append(self.state[i, idx: idx + k])
-                next_states.append(self.state[i, idx + 1: idx + k + 1])
-                isOver.append(self.isOver[i, idx: idx + k])
-                rewards.append(self.reward[i, idx: idx + k])
-                actions.append(self.action[i, idx: idx + k])
-            else:
-                end = idx + k - self._curr_size
-                states.append(self._slice(self.state[i], idx, end))
-                next_states.append(
-                    self._slice(
-                        self.state[i],
-                        idx + 1,
-                        end + 1))
-                isOver.append(self._slice(self.isOver[i], idx, end))
-                rewards.append(self._slice(self.reward[i], idx, end))
-                actions.append(self._slice(self.action[i], idx, end))
-        states_padded = self._pad_sample(states, isOver)
-        return states_padded, actions, rewards, next_states, isOver
-
-    def sample(self, batch_size):
-        idxes = [np.random.randint(0, len(self) - 1)
-                 for _ in range(batch_size)]
-        states = []
-        next_states = []
-        rewards = []
-        actions = []
-        isOver = []
-        for i in idxes:
-            exp = self._encode_sample(i)
-            states.append(exp[0])
-            actions.append(exp[1])
-            rewards.append(exp[2])
-            next_states.append(exp[3])
-            isOver.append(exp[4])
-        # Only get most recent terminal state
-        return (np.array(states), np.array(actions)[:, :, -1],
-                np.array(rewards)[:, :, -1], np.array(next_states),
-                np.array(isOver)[:, :, -1])
-
-    # the next_state is a different episode if current_state.isOver==True
-    def _pad_sample(self, states, isOver):
-        for k in range(self.history_len - 1, -1, -1):
-            for i in range(self.agents):
-                if isOver[i][k]:
-                    states[i] = copy.deepcopy(states[i])
-                    states[i][:k + 1].fill(0)
-            break
-        return states
+    @staticmethod
+    def _before_over(over):
+        """ Mask of the frames of a history window followed by the end of
+        an episode, given the isOver of all its frames but the last """
+        before = np.logical_or.accumulate(over[..., ::-1], axis=-1)[..., ::-1]
+        return np.concatenate(
+            (before, np.zeros(before.shape[:-1] + (1,), dtype=bool)), axis=-1)
+
+    def empty_batch(self, batch_size):
+        """ Allocate arrays that can hold a sampled batch """
+        shape = (batch_size, self.agents)
+        frames = shape + (self.history_len,) + tuple(self.state_shape)
+        return (np.empty(frames, dtype=self.state.dtype),
+                np.empty(shape, dtype=self.action.dtype),
+                np.empty(shape, dtype=self.reward.dtype),
+                np.empty(frames, dtype=self.state.dtype),
+                np.empty(shape, dtype=self.isOver.dtype))
 
     def _slice(self, arr, start, end):
         s1 = arr[start:self._curr_size]
@@ -130,6 +201,143 @@ class ReplayMemory(object):
             self.reward[i, pos] = exp[2][i]
             self.isOver[i, pos] = exp[3][i]
 
+    def save(self, directory, background=True):
+        """Snapshot the buffer into directory as raw .npy dumps.
+        Only the slots written since the previous snapshot into the same
+        directory are rewritten, by a background thread while appends
+        continue. The snapshot is completed by wait_snapshot, which copies
+        the slots appended meanwhile: the snapshot holds the buffer as it is
+        when wait_snapshot is called, and can be saved together with the
+        state of its caller at that time. Until then directory holds no
+        complete snapshot.
+        Returns the writer thread (already joined and the snapshot complete
+        if background is False).
+        """
+        self.wait_snapshot()
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            appended = self._appended
+        self._snapshot_thread = threading.Thread(
+            target=self._write_snapshot, args=(directory, appended),
+            daemon=True)
+        self._snapshot_thread.start()
+        if not background:
+            self.wait_snapshot()
+        return self._snapshot_thread
+
+    def snapshot_written(self):
+        """Whether the background write of the snapshot started by save is
+        over, so that wait_snapshot only copies the latest appends"""
+        return (self._snapshot_thread is not None and
+                not self._snapshot_thread.is_alive())
+
+    def wait_snapshot(self):
+        """Complete the snapshot started by save (if any), waiting for its
+        background write, with the slots appended since save was called"""
+        if self._snapshot_thread is None:
+            return
+        self._snapshot_thread.join()
+        self._snapshot_thread = None
+        if self._snapshot_error is not None:
+            error, self._snapshot_error = self._snapshot_error, None
+            raise error
+        directory, arrays, appended = self._snapshot
+        self._snapshot = None
+        with self._lock:
+            self._copy_slots(arrays, self._changed_slots(appended,
+                                                         self._appended))
+            meta = {'max_size': self.max_size,
+                    'state_shape': list(self.state_shape),
+                    'agents': self.agents,
+                    'curr_pos': self._curr_pos,
+                    'curr_size': self._curr_size,
+                    'appended': self._appended,
+                    'lineage': self._lineage}
+        for arr in arrays.values():
+            arr.flush()
+        del arrays
+        meta_file = os.path.join(directory, 'meta.json')
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_file + '.tmp', meta_file)
+
+    def load(self, directory):
+        """Restore a snapshot written by save. The state array is memory
+        mapped copy-on-write, so frames are only read from disk when sampled
+        and new appends never modify the snapshot on disk.
+        """
+        meta = self._read_meta(directory)
+        assert meta is not None, f"No complete replay snapshot in {directory}"
+        assert self._compatible(meta), \
+            f"Replay snapshot in {directory} does not match buffer shape"
+        for name in SNAPSHOT_ARRAYS:
+            setattr(self, name, np.load(
+                os.path.join(directory, name + '.npy'), mmap_mode='c'))
+        self._curr_pos = meta['curr_pos']
+        self._curr_size = meta['curr_size']
+        self._appended = meta['appended']
+        # the next snapshots are written in full into new files, the mapped
+        # ones and those of later snapshots of the previous run are stale
+        self._lineage = uuid.uuid4().hex
+        self._clear_hist()
+
+    def _write_snapshot(self, directory, appended):
+        try:
+            meta = self._read_meta(directory)
+            meta_file = os.path.join(directory, 'meta.json')
+            # invalidate the previous snapshot while the arrays are rewritten
+            if os.path.exists(meta_file):
+                os.remove(meta_file)
+            since = None
+            mode = 'w+'
+            if (meta is not None and self._compatible(meta) and
+                    meta.get('lineage') == self._lineage):
+                since = meta['appended']
+                mode = 'r+'
+            arrays = {}
+            for name in SNAPSHOT_ARRAYS:
+                arr = getattr(self, name)
+                path = os.path.join(directory, name + '.npy')
+                if mode == 'w+' and os.path.exists(path):
+                    # a new file, the buffer may map the previous one
+                    os.remove(path)
+                arrays[name] = np.lib.format.open_memmap(
+                    path, mode=mode, dtype=arr.dtype, shape=arr.shape)
+            # bulk copy without holding the lock, appends keep going
+            self._copy_slots(arrays, self._changed_slots(since, appended))
+            self._snapshot = (directory, arrays, appended)
+        except Exception as e:
+            self._snapshot_error = e
+
+    def _changed_slots(self, since, until):
+        """Buffer slots written by appends number since..until-1,
+        all the slots if since is None"""
+        if since is None or until - since >= self.max_size:
+            return slice(0, self.max_size)
+        return np.arange(since, until) % self.max_size
+
+    def _copy_slots(self, arrays, slots, chunk=1024):
+        if isinstance(slots, slice):
+            for start in range(0, self.max_size, chunk):
+                for name, arr in arrays.items():
+                    arr[:, start:start + chunk] = \
+                        getattr(self, name)[:, start:start + chunk]
+        elif len(slots):
+            for name, arr in arrays.items():
+                arr[:, slots] = getattr(self, name)[:, slots]
+
+    def _read_meta(self, directory):
+        meta_file = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file) as f:
+            return json.load(f)
+
+    def _compatible(self, meta):
+        return (meta['max_size'] == self.max_size and
+                tuple(meta['state_shape']) == tuple(self.state_shape) and
+                meta['agents'] == self.agents)
+
     def __str__(self):
         return f"""Replay buffer:
          Current position / current size: {self._curr_pos}/{self._curr_size}
@@ -0,0 +1,96 @@
+import os
+import time
+import numpy as np
+import torch
+
+
+class InferenceRunner(object):
+    """
+    Runs a Q-network for action selection: no autograd (inference mode),
+    inputs used as given (torch.from_numpy views are fine) and converted to
+    float once, no copy back when the network is on the CPU. Optionally
+    with channels_last_3d weights, bfloat16 autocast on the CPU and
+    torch.compile, falling back to eager mode if compilation fails.
+    """
+
+    def __init__(self, model, channels_last=False, bf16=False, compile=False,
+                 logger=None):
+        self.model = model
+        self.device = model.device
+        self.bf16 = bf16
+        self.logger = logger
+        if channels_last:
+            model.to(memory_format=torch.channels_last_3d)
+        self._compiled = None
+        if compile:
+            if hasattr(torch, "compile"):
+                self._compiled = torch.compile(self._forward)
+            else:
+                self._log("torch.compile is not available, running eagerly")
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.log(message)
+
+    def _forward(self, inputs):
+        if not hasattr(self.model, "trunk"):
+            return self.model.forward(inputs)
+        x = inputs.to(self.device, torch.float32) / 255.0
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.bf16):
+            q_values = self.model.heads(self.model.trunk(x))
+        return q_values.float()
+
+    def q_values(self, inputs):
+        """
+        Input is a tensor of size
+        (batch_size, agents, frame_history, *image_size)
+        Output is a CPU tensor of size (batch_size, agents, number_actions)
+        """
+        with torch.inference_mode():
+            if self._compiled is not None:
+                try:
+                    q_values = self._compiled(inputs)
+                except Exception as e:
+                    self._log(f"torch.compile failed ({e!r}), "
+                              f"running eagerly")
+                    self._compiled = None
+                    q_values = self._forward(inputs)
+            else:
+                q_values = self._forward(inputs)
+        return q_values.cpu()
+
+    def greedy(self, inputs):
+        """
+        Greedy actions (agents,) and Q-values (agents, number_actions) of a
+        single frame stack (1, agents, frame_history, *image_size)
+        """
+        q_values = self.q_values(inputs).squeeze(0)
+        actions = torch.max(q_values, -1)[1]
+        return actions.numpy().astype(np.int32), q_values.numpy()
+
+
+def tune_threads(runner, example, candidates=None, repeats=3, logger=None):
+    """
+    Time runner on example for a few numbers of intra-op threads and keep
+    the fastest. Returns the chosen number of threads.
+    """
+    if candidates is None:
+        cpus = os.cpu_count() or 1
+        candidates = sorted(set([2 ** i for i in range(cpus.bit_length())] +
+                                [cpus]))
+    timings = {}
+    for threads in candidates:
+        torch.set_num_threads(threads)
+        runner.q_values(example)  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            runner.q_values(example)
+        timings[threads] = (time.perf_counter() - start) / repeats
+    best = min(timings, key=timings.get)
+    torch.set_num_threads(best)
+    if logger is not None:
+        logger.log("Inference time per call by number of threads: " +
+                   ", ".join(f"{n}: {t * 1000:.1f}ms"
+                             for n, t in timings.items()) +
+                   f", using {best}")
+    return best
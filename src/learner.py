@@ -0,0 +1,52 @@
+import queue
+import threading
+
+
+class LearnerThread(object):
+    """
+    Runs the work of the learner (gradient updates, target network copies)
+    on a background thread, in the order it was submitted, while the main
+    thread keeps stepping the environment. PyTorch and NumPy release the GIL
+    in their kernels. At most depth tasks wait in the queue, submit blocks
+    beyond that so that acting can not get further ahead of learning.
+    An exception raised by a task is raised again by the next submit or
+    wait, the following tasks are skipped.
+    """
+
+    def __init__(self, depth=2):
+        self._tasks = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                if self._error is None:
+                    task()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._tasks.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, task):
+        """ Queue the function task, run without arguments """
+        self._check()
+        self._tasks.put(task)
+
+    def wait(self):
+        """ Wait until all the submitted tasks are done """
+        self._tasks.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self._tasks.put(None)
+        self._thread.join()
@@ -1,20 +1,32 @@
 import os
 from datetime import datetime
 import socket
-import torch
 import sys
+import time
 from torch.utils.tensorboard import SummaryWriter
 import csv
+from checkpoint import CheckpointWriter, write_checkpoint
 
 
 class Logger(object):
-    def __init__(self, directory, write, save_freq=10):
+    def __init__(self, directory, write, save_freq=10, async_save=False,
+                 keep=1):
+        """
+        :param async_save: write the models on a background thread
+        :param keep: number of versions kept of every saved model
+        """
         self.parent_dir = directory
         self.write = write
         self.dir = ""
         self.fig_index = 0
         self.model_index = 0
         self.save_freq = save_freq
+        self.keep = keep
+        self.checkpoints = None
+        # durations of the synchronous model writes
+        self._save_times = []
+        if self.write and async_save:
+            self.checkpoints = CheckpointWriter(keep)
         if self.write:
             self.boardWriter = SummaryWriter()
             current_time = datetime.now().strftime('%b%d_%H-%M-%S')
@@ -65,7 +77,30 @@ class Logger(object):
             return
         if (forced or
            (self.model_index > 0 and self.model_index % self.save_freq == 0)):
-            torch.save(state_dict, os.path.join(self.dir, name))
+            path = os.path.join(self.dir, name)
+            if self.checkpoints is not None:
+                self.checkpoints.save(state_dict, path)
+            else:
+                start = time.perf_counter()
+                write_checkpoint(state_dict, path, self.keep)
+                self._save_times.append(time.perf_counter() - start)
+
+    def write_save_times(self, index=0):
+        """ Board the durations of the model writes since the last call """
+        if self.checkpoints is not None:
+            times = self.checkpoints.write_times()
+        else:
+            times, self._save_times = self._save_times, []
+        if len(times) > 0:
+            self.write_to_board("checkpoint", {
+                "writes": len(times),
+                "mean_write_s": sum(times) / len(times),
+                "max_write_s": max(times)}, index)
+
+    def flush_models(self):
+        """ Wait until the models saved in the background are written """
+        if self.checkpoints is not None:
+            self.checkpoints.flush()
 
     def write_locations(self, row):
         self.log(str(row))
@@ -37,6 +37,44 @@ Rectangle = namedtuple(
         'xmin', 'xmax', 'ymin', 'ymax', 'zmin', 'zmax'])
 
 
+def crop_screen(data, image_dims, location, scale, screen_dims, screen):
+    """
+    Write into screen (of size screen_dims, zero filled) the crop of the
+    image data around location, sampled with stride scale. The part of the
+    crop out of the image is left as background. Returns the Rectangle of
+    the crop in image coordinates.
+    """
+    limits = []
+    slices = []
+    for axis in range(3):
+        half = screen_dims[axis] * scale / 2
+        # screen uses coordinate system relative to origin (0, 0, 0)
+        screen_min, screen_max = 0, screen_dims[axis]
+        # extract boundary locations using coordinate system relative to
+        # "global" image
+        if scale % 2:
+            lower = location[axis] - int(half) - 1
+            upper = location[axis] + int(half)
+        else:
+            lower = location[axis] - round(half)
+            upper = location[axis] + round(half)
+        # check if they violate image boundary and fix it
+        if lower < 0:
+            lower = 0
+            screen_min = screen_max - len(np.arange(lower, upper, scale))
+        if upper > image_dims[axis]:
+            upper = image_dims[axis]
+            screen_max = screen_min + len(np.arange(lower, upper, scale))
+        limits += [lower, upper]
+        slices.append((slice(screen_min, screen_max),
+                       slice(lower, upper, scale)))
+    # crop image data to update what network sees
+    # image coordinate system becomes screen coordinates
+    # scale can be thought of as a stride
+    screen[tuple(s for s, _ in slices)] = data[tuple(d for _, d in slices)]
+    return Rectangle(*limits)
+
+
 # ===================================================================
 # =================== 3d medical environment ========================
 # ===================================================================
@@ -144,10 +182,16 @@ class MedicalPlayer(gym.Env):
 
         # prepare file sampler
         self.filepath = None
+        self.landmark_ids = landmark_ids
         self.sampled_files = self.files.sample_circular(landmark_ids)
         # reset buffer, terminal, counters, and init new_random_game
         self._restart_episode()
 
+    def set_files(self, file_indices):
+        """ play the files at file_indices (in turn) from the next reset """
+        self.sampled_files = self.files.sample_circular(
+            self.landmark_ids, indexes=file_indices)
+
     def reset(self):
         # with _ALE_LOCK:
         self._restart_episode()
@@ -211,8 +255,24 @@ class MedicalPlayer(gym.Env):
         # image volume size
         self._image_dims = self._image[0].dims
 
-        #######################################################################
         # select random starting point
+        self._location = self._random_locations(self.agents)
+        self._start_location = list(self._location)
+        self._qvalues = [[0, ] * self.actions] * self.agents
+        self._screen = self._current_state()
+
+        if self.task == 'play':
+            self.cur_dist = [0, ] * self.agents
+        else:
+            self.cur_dist = [
+                self.calcDistance(
+                    self._location[i],
+                    self._target_loc[i],
+                    self.spacing) for i in range(
+                    self.agents)]
+
+    def _random_locations(self, n):
+        """ n random starting points in the current image """
         # add padding to avoid start right on the border of the image
         if self.task == 'train':
             skip_thickness = ((int)(self._image_dims[0] / 5),
@@ -226,32 +286,38 @@ class MedicalPlayer(gym.Env):
         x = np.random.randint(
                 skip_thickness[0],
                 self._image_dims[0] - skip_thickness[0],
-                self.agents)
+                n)
         y = np.random.randint(
                 skip_thickness[1],
                 self._image_dims[1] - skip_thickness[1],
-                self.agents)
+                n)
         z = np.random.randint(
                 skip_thickness[2],
                 self._image_dims[2] - skip_thickness[2],
-                self.agents)
-
-        #######################################################################
+                n)
+        return [(x[i], y[i], z[i]) for i in range(n)]
 
-        self._location = [(x[i], y[i], z[i]) for i in range(self.agents)]
-        self._start_location = [(x[i], y[i], z[i]) for i in range(self.agents)]
-        self._qvalues = [[0, ] * self.actions] * self.agents
+    def reset_agents(self, agents):
+        """
+        Restart the episode of the given agents only, from new random
+        starting points in the current image, the other agents go on. With
+        multiscale, the restarted agents keep the current scale of the
+        environment.
+        """
+        for i, location in zip(agents, self._random_locations(len(agents))):
+            self._location[i] = location
+            self._start_location[i] = location
+            self._loc_history[i] = [
+                (0,) * self.dims for _ in range(self._history_length)]
+            self._qvalues_history[i] = [
+                (0,) * self.actions for _ in range(self._history_length)]
+            self.current_episode_score[i] = []
+            self.terminal[i] = False
+            if self.task != 'play':
+                self.cur_dist[i] = self.calcDistance(
+                    location, self._target_loc[i], self.spacing)
         self._screen = self._current_state()
-
-        if self.task == 'play':
-            self.cur_dist = [0, ] * self.agents
-        else:
-            self.cur_dist = [
-                self.calcDistance(
-                    self._location[i],
-                    self._target_loc[i],
-                    self.spacing) for i in range(
-                    self.agents)]
+        return self._screen
 
     def calcDistance(self, points1, points2, spacing=(1, 1, 1)):
         """ calculate the distance between two points in mm"""
@@ -440,10 +506,15 @@ class MedicalPlayer(gym.Env):
                 if isinstance(self.viz, float):
                     self.display()
 
-        distance_error = self.cur_dist
         for i in range(self.agents):
             self.current_episode_score[i].append(self.reward[i])
 
+        return self._current_state(), self.reward, self.terminal, \
+            self._get_info()
+
+    def _get_info(self):
+        """ diagnostic information on the current state of the agents """
+        distance_error = self.cur_dist
         info = {}
         for i in range(self.agents):
             info[f"score_{i}"] = np.sum(self.current_episode_score[i])
@@ -456,7 +527,7 @@ class MedicalPlayer(gym.Env):
             info[f"landmark_xpos_{i}"] = self._target_loc[i][0]
             info[f"landmark_ypos_{i}"] = self._target_loc[i][1]
             info[f"landmark_zpos_{i}"] = self._target_loc[i][2]
-        return self._current_state(), self.reward, self.terminal, info
+        return info
 
     def getBestLocation(self):
         ''' get best location with best qvalue from last for locations
@@ -511,84 +582,9 @@ class MedicalPlayer(gym.Env):
             self._image[0].data.dtype)
 
         for i in range(self.agents):
-            # screen uses coordinate system relative to origin (0, 0, 0)
-            screen_xmin, screen_ymin, screen_zmin = 0, 0, 0
-            screen_xmax, screen_ymax, screen_zmax = self.screen_dims
-
-            # extract boundary locations using coordinate system relative to
-            # "global" image
-            # width, height, depth in terms of screen coord system
-
-            if self.xscale % 2:
-                xmin = self._location[i][0] - \
-                    int(self.width * self.xscale / 2) - 1
-                xmax = self._location[i][0] + int(self.width * self.xscale / 2)
-                ymin = self._location[i][1] - \
-                    int(self.height * self.yscale / 2) - 1
-                ymax = self._location[i][1] + \
-                    int(self.height * self.yscale / 2)
-                zmin = self._location[i][2] - \
-                    int(self.depth * self.zscale / 2) - 1
-                zmax = self._location[i][2] + int(self.depth * self.zscale / 2)
-            else:
-                xmin = self._location[i][0] - \
-                    round(self.width * self.xscale / 2)
-                xmax = self._location[i][0] + \
-                    round(self.width * self.xscale / 2)
-                ymin = self._location[i][1] - \
-                    round(self.height * self.yscale / 2)
-                ymax = self._location[i][1] + \
-                    round(self.height * self.yscale / 2)
-                zmin = self._location[i][2] - \
-                    round(self.depth * self.zscale / 2)
-                zmax = self._location[i][2] + \
-                    round(self.depth * self.zscale / 2)
-
-            ###########################################################
-
-            # check if they violate image boundary and fix it
-            if xmin < 0:
-                xmin = 0
-                screen_xmin = screen_xmax - \
-                    len(np.arange(xmin, xmax, self.xscale))
-            if ymin < 0:
-                ymin = 0
-                screen_ymin = screen_ymax - \
-                    len(np.arange(ymin, ymax, self.yscale))
-            if zmin < 0:
-                zmin = 0
-                screen_zmin = screen_zmax - \
-                    len(np.arange(zmin, zmax, self.zscale))
-            if xmax > self._image_dims[0]:
-                xmax = self._image_dims[0]
-                screen_xmax = screen_xmin + \
-                    len(np.arange(xmin, xmax, self.xscale))
-            if ymax > self._image_dims[1]:
-                ymax = self._image_dims[1]
-                screen_ymax = screen_ymin + \
-                    len(np.arange(ymin, ymax, self.yscale))
-            if zmax > self._image_dims[2]:
-                zmax = self._image_dims[2]
-                screen_zmax = screen_zmin + \
-                    len(np.arange(zmin, zmax, self.zscale))
-
-            # crop image data to update what network sees
-            # image coordinate system becomes screen coordinates
-            # scale can be thought of as a stride
-            screen[i,
-                   screen_xmin:screen_xmax,
-                   screen_ymin:screen_ymax,
-                   screen_zmin:screen_zmax] = self._image[i].data[
-                xmin:xmax:self.xscale,
-                ymin:ymax:self.yscale,
-                zmin:zmax:self.zscale]
-
-            ###########################################################
-            # update rectangle limits from input image coordinates
-            # this is what the network sees
-            self.rectangle[i] = Rectangle(xmin, xmax,
-                                          ymin, ymax,
-                                          zmin, zmax)
+            self.rectangle[i] = crop_screen(
+                self._image[i].data, self._image_dims, self._location[i],
+                self.xscale, self.screen_dims, screen[i])
         return screen
 
     # Should the argument agent not be renamed to image rather?
@@ -0,0 +1,78 @@
+import queue
+import threading
+import numpy as np
+import torch
+
+
+class BatchPrefetcher(object):
+    """
+    Assembles the next minibatches from a ReplayMemory on a worker thread,
+    straight into reusable tensors, so that sampling and the host to tensor
+    conversion overlap with the learner's forward and backward passes.
+    NumPy's gathers release the GIL while copying the frames.
+    """
+
+    def __init__(self, buffer, batch_size, depth=2, pin_memory=False,
+                 seed=0, rng=None):
+        """
+        :param depth: number of minibatches prepared ahead of the learner
+        :param pin_memory: allocate page-locked tensors (only used with CUDA)
+        :param rng: RandomState the minibatches are drawn from instead of a
+            new one seeded with seed. It is advanced as the minibatches are
+            returned by next, so that its state can be saved and restored.
+        """
+        self.buffer = buffer
+        self.batch_size = batch_size
+        pin_memory = pin_memory and torch.cuda.is_available()
+        self.rng = rng if rng is not None else np.random.RandomState(seed)
+        # the worker draws ahead of the learner from a copy
+        self._rng = np.random.RandomState()
+        self._rng.set_state(self.rng.get_state())
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        # depth batches in flight plus the one held by the learner
+        for _ in range(depth + 1):
+            tensors = tuple(torch.from_numpy(arr)
+                            for arr in buffer.empty_batch(batch_size))
+            if pin_memory:
+                tensors = tuple(t.pin_memory() for t in tensors)
+            self._free.put(tensors)
+        self._held = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                tensors = self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                self.buffer.sample(self.batch_size,
+                                   out=tuple(t.numpy() for t in tensors),
+                                   rng=self._rng)
+            except Exception as e:
+                self._ready.put(e)
+                return
+            self._ready.put((tensors, self._rng.get_state()))
+
+    def next(self):
+        """
+        Return the next minibatch as tensors
+        (states, actions, rewards, next_states, isOver).
+        The tensors are recycled, they are only valid until the next call.
+        """
+        if self._held is not None:
+            self._free.put(self._held)
+        batch = self._ready.get()
+        if isinstance(batch, Exception):
+            self._held = None
+            raise batch
+        self._held, state = batch
+        self.rng.set_state(state)
+        return self._held
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
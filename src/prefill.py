@@ -0,0 +1,102 @@
+import numpy as np
+from medical import crop_screen
+
+# moves of the actions of MedicalPlayer.step along (x, y, z)
+MOVES = np.array([[0, 0, 1], [0, 1, 0], [1, 0, 0],
+                  [-1, 0, 0], [0, -1, 0], [0, 0, -1]])
+
+
+def oscillating(history, allowed):
+    """
+    Vectorized MedicalPlayer._oscillate of every agent, history is an array
+    of the location histories of shape (..., history_length, 3), where the
+    unused entries are (0, 0, 0).
+    """
+    same = (history[..., :, None, :] == history[..., None, :, :]).all(-1)
+    counts = same.sum(-1)
+    empty = (history == 0).all(-1)
+    zeros = empty.sum(-1)
+    most = np.where(empty, 0, counts).max(-1)
+    distinct = np.rint((1 / counts).sum(-1))
+    # (0, 0, 0) comes first among the most common when it is one of them
+    zeros_first = (zeros > 0) & (zeros >= most)
+    return np.where(zeros_first, (distinct >= allowed) & (most >= allowed),
+                    most >= allowed)
+
+
+def random_episodes(env, episodes, steps, rng=np.random):
+    """
+    Play episodes random-action episodes at once on the next volume of the
+    MedicalPlayer env (in train mode), as MedicalPlayer.step would with
+    zero Q-values: the moves blocked by the image borders, the rewards, the
+    terminals and the oscillation checks (going down a scale with
+    multiscale) are computed for all the episodes and agents together.
+    Yields the (states, actions, rewards, isOver) arrays of every episode,
+    of shape (length, agents) + ...
+    """
+    images, target, _, spacing = next(env.sampled_files)
+    dims = np.array(images[0].dims)
+    target = np.array(target, dtype=float)
+    spacing = np.array(spacing)
+    agents = env.agents
+    skip = dims // 5
+
+    def distance(locations):
+        return np.linalg.norm((locations - target) * spacing, axis=-1)
+
+    # x, y and z of all the agents are drawn in turn as in new_random_game
+    location = np.stack([rng.randint(skip[i], dims[i] - skip[i],
+                                     (episodes, agents))
+                         for i in range(3)], axis=-1)
+    scale = np.full(episodes, 3 if env.multiscale else 1)
+    action_step = np.full(episodes, 9 if env.multiscale else 1)
+    history = np.zeros((episodes, agents, env._history_length, 3), dtype=int)
+    cur_dist = distance(location)
+    running = np.ones(episodes, dtype=bool)
+    length = np.zeros(episodes, dtype=int)
+    scales = np.zeros((steps, episodes), dtype=int)
+    locations = np.zeros((steps, episodes, agents, 3), dtype=int)
+    actions = rng.randint(env.actions, size=(steps, episodes, agents))
+    rewards = np.zeros((steps, episodes, agents), dtype='float32')
+    terminals = np.zeros((steps, episodes, agents), dtype=bool)
+    for t in range(steps):
+        next_location = location + \
+            MOVES[actions[t]] * action_step[:, None, None]
+        go_out = ((next_location >= dims) & (MOVES[actions[t]] > 0)) | \
+            ((next_location <= 0) & (MOVES[actions[t]] < 0))
+        go_out = go_out.any(-1)
+        next_location[go_out] = location[go_out]
+        next_dist = distance(next_location)
+        rewards[t] = np.where(go_out, -1, cur_dist - next_dist)
+        # the distance before the move ends the episode of the agent
+        terminals[t] = cur_dist <= 1
+        location = next_location
+        cur_dist = next_dist
+        history = np.roll(history, -1, axis=2)
+        history[:, :, -1] = location
+        stuck = oscillating(history, env.oscillations_allowed).all(-1)
+        stuck &= running
+        # best location among the last four, the first with zero Q-values
+        location[stuck] = history[stuck, :, -4]
+        cur_dist[stuck] = distance(location[stuck])
+        down = stuck & (scale > 1) & env.multiscale
+        scale[down] -= 1
+        action_step[down] //= 3
+        history[down] = 0
+        terminals[t, stuck & ~down] = True
+        scales[t] = scale
+        locations[t] = location
+        length += running
+        running &= ~terminals[t].all(-1)
+        if not running.any():
+            break
+
+    for e in range(episodes):
+        n = length[e]
+        states = np.zeros((n, agents) + tuple(env.screen_dims),
+                          dtype=images[0].data.dtype)
+        for t in range(n):
+            for i in range(agents):
+                crop_screen(images[i].data, dims, locations[t, e, i],
+                            scales[t, e], env.screen_dims, states[t, i])
+        yield (states, actions[:n, e], rewards[:n, e], terminals[:n, e])
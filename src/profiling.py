@@ -0,0 +1,117 @@
+import cProfile
+import functools
+import os
+import pstats
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+
+class Profiler(object):
+    """
+    Profiles a bounded number of steps with cProfile and torch.profiler (CPU
+    operators with their input shapes and memory), then writes a Chrome
+    trace and pstats summaries to a directory. The steps are the calls to
+    the function given to count, and the labelled functions show up as
+    record_function regions in the trace. All the functions wrapped in
+    place are restored once the profile is written.
+    """
+
+    def __init__(self, directory, steps, warmup=0, logger=None):
+        """
+        :param steps: number of steps profiled
+        :param warmup: number of steps before the profile starts
+        """
+        self.directory = directory
+        self.steps = steps
+        self.warmup = warmup
+        self.logger = logger
+        self.count = 0
+        self._wrapped = []
+        self._cprofile = None
+        self._torch = None
+        self._done = False
+
+    def _wrap(self, owner, attribute, wrapper):
+        function = getattr(owner, attribute)
+        self._wrapped.append((owner, attribute, function))
+        setattr(owner, attribute, functools.wraps(function)(wrapper(function)))
+
+    def label(self, owner, attribute, name=None):
+        """ Label the calls to owner.attribute as name in the trace """
+        name = name or f"{owner.__name__}.{attribute}"
+
+        def wrapper(function):
+            def labelled(*args, **kwargs):
+                with record_function(name):
+                    return function(*args, **kwargs)
+            return labelled
+        self._wrap(owner, attribute, wrapper)
+
+    def count_steps(self, owner, attribute):
+        """ Profile the steps made of the calls to owner.attribute """
+        def wrapper(function):
+            def counted(*args, **kwargs):
+                if self.count == self.warmup:
+                    self.start()
+                self.count += 1
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    if self.count == self.warmup + self.steps:
+                        self.stop()
+            return counted
+        self._wrap(owner, attribute, wrapper)
+
+    def start(self):
+        self._torch = profile(activities=[ProfilerActivity.CPU],
+                              record_shapes=True, profile_memory=True)
+        self._torch.start()
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def stop(self):
+        """ Write the profile of the steps done so far """
+        if self._done:
+            return
+        self._done = True
+        for owner, attribute, function in reversed(self._wrapped):
+            setattr(owner, attribute, function)
+        if self._cprofile is None:
+            return
+        self._cprofile.disable()
+        self._torch.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        trace = os.path.join(self.directory, "trace.json")
+        self._torch.export_chrome_trace(trace)
+        with open(os.path.join(self.directory, "profile_ops.txt"), "w") as f:
+            f.write(self._torch.key_averages().table(
+                sort_by="self_cpu_time_total", row_limit=40))
+        self._cprofile.dump_stats(
+            os.path.join(self.directory, "profile.pstats"))
+        with open(os.path.join(self.directory, "profile.txt"), "w") as f:
+            stats = pstats.Stats(self._cprofile, stream=f)
+            stats.sort_stats("cumulative").print_stats(60)
+        if self.logger is not None:
+            self.logger.log(f"Profile of {self.count - self.warmup} steps "
+                            f"written to {self.directory}")
+
+    close = stop
+
+
+def profile_training(directory, steps, warmup=0, logger=None):
+    """
+    Profiler of steps environment steps after warmup steps, labelling the
+    environment steps, crops, replay sampling, forward passes with the loss
+    and backward passes. Must be called before the environments are created.
+    """
+    from medical import MedicalPlayer
+    from expreplay import ReplayMemory
+    from DQNModel import DQN
+    profiler = Profiler(directory, steps, warmup, logger)
+    profiler.label(MedicalPlayer, "step", "env_step")
+    profiler.label(MedicalPlayer, "_current_state", "crop")
+    profiler.label(ReplayMemory, "sample", "replay_sample")
+    profiler.label(DQN, "_calculate_loss", "forward")
+    profiler.label(torch.Tensor, "backward", "backward")
+    profiler.count_steps(MedicalPlayer, "step")
+    return profiler
@@ -0,0 +1,115 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+from evaluator import Evaluator
+
+
+class QuantizedNetwork(nn.Module):
+    """
+    Int8 CPU version of a Network3D / CommNet. The convolutions of the trunk
+    are statically quantized (activations observed on calibration data) and
+    the heads are split back into one nn.Linear per agent so that they can
+    be dynamically quantized. The PReLUs and pools stay in float, the
+    quantized PReLU kernel gives wrong results on 5D tensors. Call
+    prepare(), calibrate() then convert() before using it.
+    """
+
+    def __init__(self, model, backend="x86"):
+        super(QuantizedNetwork, self).__init__()
+        model = copy.deepcopy(model).cpu()
+        self.agents = model.agents
+        self.frame_history = model.frame_history
+        self.image_size = model.image_size
+        self.device = torch.device("cpu")
+        self.backend = backend
+        for i in range(4):
+            setattr(self, f"quant{i}", quantization.QuantStub())
+            setattr(self, f"conv{i}", getattr(model, f"conv{i}"))
+            setattr(self, f"prelu{i}", getattr(model, f"prelu{i}"))
+        for i in range(3):
+            setattr(self, f"maxpool{i}", getattr(model, f"maxpool{i}"))
+        self.dequant = quantization.DeQuantStub()
+        self.comm = []
+        for name in ("fc1", "fc2", "fc3"):
+            grouped = getattr(model, name)
+            linears = nn.ModuleList()
+            for i in range(self.agents):
+                linear = nn.Linear(grouped.weight.shape[1],
+                                   grouped.out_features)
+                linear.weight.data.copy_(grouped.weight.data[i].t())
+                linear.bias.data.copy_(grouped.bias.data[i])
+                linears.append(linear)
+            setattr(self, name, linears)
+            self.comm.append(grouped.comm)
+        # per-agent PReLU of the heads, kept in float
+        self.prelu4 = model.prelu4
+        self.prelu5 = model.prelu5
+
+    def prepare(self):
+        """ Insert the observers of the trunk activations """
+        torch.backends.quantized.engine = self.backend
+        self.eval()
+        self.qconfig = quantization.get_default_qconfig(self.backend)
+        for name in ("fc1", "fc2", "fc3", "prelu0", "prelu1", "prelu2",
+                     "prelu3", "prelu4", "prelu5"):
+            getattr(self, name).qconfig = None
+        quantization.prepare(self, inplace=True)
+        return self
+
+    def calibrate(self, env, episodes, max_steps, logger):
+        """ Observe the trunk activations on evaluation episodes in env """
+        evaluator = Evaluator(env, self, logger, self.agents, max_steps,
+                              cache_size=0)
+        self.eval()
+        for _ in range(episodes):
+            evaluator.play_one_episode()
+        return self
+
+    def convert(self):
+        quantization.convert(self, inplace=True)
+        for name in ("fc1", "fc2", "fc3"):
+            setattr(self, name, quantization.quantize_dynamic(
+                getattr(self, name), {nn.Linear}, dtype=torch.qint8))
+        return self
+
+    def trunk(self, input):
+        x = input.reshape(-1, *input.shape[2:])
+        for i in range(4):
+            x = getattr(self, f"conv{i}")(getattr(self, f"quant{i}")(x))
+            x = getattr(self, f"prelu{i}")(self.dequant(x))
+            if i < 3:
+                x = getattr(self, f"maxpool{i}")(x)
+        return x.reshape(input.shape[0], input.shape[1], -1)
+
+    def _linear(self, index, x):
+        linears = getattr(self, f"fc{index + 1}")
+        if self.comm[index]:
+            x = torch.cat((x, x.mean(1, keepdim=True).expand_as(x)), -1)
+        return torch.stack([linears[i](x[:, i]) for i in range(self.agents)],
+                           dim=1)
+
+    def heads(self, x):
+        x = self.prelu4(self._linear(0, x))
+        x = self.prelu5(self._linear(1, x))
+        return self._linear(2, x)
+
+    def forward(self, input):
+        """
+        Input is a tensor of size
+        (batch_size, agents, frame_history, *image_size)
+        Output is a tensor of size
+        (batch_size, agents, number_actions)
+        """
+        input = input.float() / 255.0
+        return self.heads(self.trunk(input))
+
+
+def quantize_model(model, env, episodes, max_steps, logger):
+    """
+    Return an int8 copy of model, calibrated on episodes episodes of env.
+    """
+    quantized = QuantizedNetwork(model).prepare()
+    quantized.calibrate(env, episodes, max_steps, logger).convert()
+    logger.log(f"Quantized model calibrated on {episodes} episodes")
+    return quantized
@@ -0,0 +1,188 @@
+import copy
+from typing import List, Optional, Tuple
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+class GreedyRollout(nn.Module):
+    """
+    A whole greedy evaluation episode of MedicalPlayer wrapped in FrameStack,
+    written for TorchScript so that it runs without returning to Python:
+    crop, frame stack, Q-network, argmax, move, oscillation check and the
+    multi-scale schedule of MedicalPlayer.step (task "eval" or "play").
+    """
+
+    def __init__(self, network, agents, frame_history=4,
+                 screen_dims=(45, 45, 45), number_actions=6,
+                 history_length=20, oscillations_allowed=4):
+        """
+        :param network: traced Q-network, taking the frame stacks of size
+            (1, agents, frame_history, *screen_dims)
+        """
+        super(GreedyRollout, self).__init__()
+        self.network = network
+        self.agents = agents
+        self.frame_history = frame_history
+        self.screen_dims = list(screen_dims)
+        self.number_actions = number_actions
+        self.history_length = history_length
+        self.oscillations_allowed = oscillations_allowed
+        # axis and direction of the actions Z+, Y+, X+, X-, Y-, Z-
+        self.register_buffer("axes", torch.tensor([2, 1, 0, 0, 1, 2]))
+        self.register_buffer("signs", torch.tensor([1, 1, 1, -1, -1, -1]))
+
+    def _bounds(self, location: int, width: int, scale: int,
+                dim: int) -> List[int]:
+        """ crop limits along one axis, as in MedicalPlayer._current_state """
+        half = width * scale // 2
+        if scale % 2 == 1:
+            low, high = location - half - 1, location + half
+        else:
+            low, high = location - half, location + half
+        screen_low, screen_high = 0, width
+        if low < 0:
+            low = 0
+            screen_low = screen_high - max(0, (high + scale - 1) // scale)
+        if high > dim:
+            high = dim
+            screen_high = screen_low + max(
+                0, (high - low + scale - 1) // scale)
+        return [low, high, screen_low, screen_high]
+
+    def crop(self, volumes: List[Tensor], locations: Tensor, scale: int,
+             dims: List[int]) -> Tensor:
+        screens = torch.zeros([self.agents] + self.screen_dims,
+                              dtype=volumes[0].dtype)
+        for i in range(self.agents):
+            x = self._bounds(int(locations[i, 0]), self.screen_dims[0],
+                             scale, dims[0])
+            y = self._bounds(int(locations[i, 1]), self.screen_dims[1],
+                             scale, dims[1])
+            z = self._bounds(int(locations[i, 2]), self.screen_dims[2],
+                             scale, dims[2])
+            screens[i, x[2]:x[3], y[2]:y[3], z[2]:z[3]] = volumes[i][
+                x[0]:x[1]:scale, y[0]:y[1]:scale, z[0]:z[1]:scale]
+        return screens
+
+    def _distances(self, locations: Tensor, targets: Tensor,
+                   spacing: Tensor) -> Tensor:
+        return torch.linalg.norm(spacing * locations.double() -
+                                 spacing * targets, dim=-1)
+
+    def _stuck(self, history: Tensor) -> Tensor:
+        """
+        Per agent oscillation test of MedicalPlayer._oscillate, the most
+        common location of the history has been visited oscillations_allowed
+        times, not counting the (0, 0, 0) padding of the history.
+        """
+        same = (history.unsqueeze(2) == history.unsqueeze(1)).all(-1)
+        counts = same.sum(-1)
+        padding = (history == 0).all(-1)
+        zeros = padding.sum(-1)
+        most = torch.where(padding, torch.zeros_like(counts),
+                           counts).max(-1)[0]
+        # Counter.most_common orders ties by first occurrence and the padding
+        # always comes first
+        distinct = (~torch.tril(same, diagonal=-1).any(-1)).sum(-1)
+        padding_first = (zeros > 0) & (zeros >= most)
+        return torch.where(
+            padding_first,
+            (distinct >= self.oscillations_allowed) &
+            (most >= self.oscillations_allowed),
+            most >= self.oscillations_allowed)
+
+    def forward(self, volumes: List[Tensor], locations: Tensor, scale: int,
+                action_step: int, multiscale: bool, max_steps: int,
+                targets: Optional[Tensor] = None,
+                spacing: Optional[Tensor] = None
+                ) -> Tuple[Tensor, Tensor, Tensor, bool]:
+        """
+        Play an episode from the starting locations (agents, 3) in volumes.
+        Rewards are only computed if the target locations (agents, 3) and
+        the voxel spacing (3) are given.
+        Returns the locations after every step (steps, agents, 3), the score
+        of the agents, the last Q-values (agents, number_actions) and
+        whether the episode ended before max_steps.
+        """
+        dims = volumes[0].shape
+        dims_tensor = torch.tensor(dims)
+        agent_index = torch.arange(self.agents)
+        locations = locations.clone()
+        frames = torch.zeros([self.agents, self.frame_history] +
+                             self.screen_dims, dtype=volumes[0].dtype)
+        frames[:, -1] = self.crop(volumes, locations, scale, dims)
+        loc_history = torch.zeros(self.agents, self.history_length, 3,
+                                  dtype=torch.long)
+        q_history = torch.zeros(self.agents, self.history_length,
+                                self.number_actions)
+        score = torch.zeros(self.agents, dtype=torch.double)
+        q_values = torch.zeros(self.agents, self.number_actions)
+        trajectory: List[Tensor] = []
+        terminal = False
+        steps = 0
+        while steps < max_steps and not terminal:
+            q_values = self.network(frames.unsqueeze(0)).squeeze(0)
+            acts = torch.max(q_values, -1)[1]
+
+            axes = self.axes[acts]
+            signs = self.signs[acts]
+            current = locations[agent_index, axes]
+            moved = current + signs * action_step
+            go_out = torch.where(signs > 0, moved >= dims_tensor[axes],
+                                 moved <= 0)
+            next_locations = locations.clone()
+            next_locations[agent_index, axes] = torch.where(
+                go_out, current, moved)
+
+            reward = torch.zeros(self.agents, dtype=torch.double)
+            if targets is not None and spacing is not None:
+                reward = torch.where(
+                    go_out, -torch.ones_like(reward),
+                    self._distances(locations, targets, spacing) -
+                    self._distances(next_locations, targets, spacing))
+            locations = next_locations
+
+            loc_history = torch.cat(
+                (loc_history[:, 1:], locations.unsqueeze(1)), 1)
+            q_history = torch.cat(
+                (q_history[:, 1:], q_values.unsqueeze(1)), 1)
+            if bool(self._stuck(loc_history).all()):
+                # best location of the last four, as getBestLocation
+                best = q_history[:, -4:].max(-1)[0].argmin(-1)
+                locations = loc_history[:, -4:][agent_index, best]
+                if multiscale and scale > 1:
+                    scale -= 1
+                    action_step = action_step // 3
+                    loc_history.zero_()
+                    q_history.zero_()
+                else:
+                    terminal = True
+            if not terminal:
+                score += reward
+
+            frames = torch.cat((frames[:, 1:], self.crop(
+                volumes, locations, scale, dims).unsqueeze(1)), 1)
+            trajectory.append(locations)
+            steps += 1
+        return torch.stack(trajectory), score, q_values, terminal
+
+
+def export_rollout(model, path, agents, frame_history=4,
+                   screen_dims=(45, 45, 45), number_actions=6,
+                   history_length=20, oscillations_allowed=4):
+    """
+    Trace a CPU copy of the Q-network model, script the greedy rollout
+    around it and save the TorchScript module at path.
+    """
+    model = copy.deepcopy(model).cpu()
+    model.device = torch.device("cpu")
+    model.train(False)
+    example = torch.zeros((1, agents, frame_history) + tuple(screen_dims))
+    with torch.no_grad():
+        network = torch.jit.trace(model, example)
+    rollout = torch.jit.script(GreedyRollout(
+        network, agents, frame_history, screen_dims, number_actions,
+        history_length, oscillations_allowed))
+    rollout.save(path)
+    return rollout
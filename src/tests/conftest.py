@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of src import each other as top-level modules, as they do when
+# the scripts are run from src
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,143 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from ..DQNModel import DQN, Network3D, CommNet, trunk_features
+
+
+def _looped_forward(model, input):
+    """ forward pass running the shared layers once per agent """
+    features = []
+    for i in range(model.agents):
+        features.append(model.trunk(input[:, i:i + 1]).squeeze(1))
+    return model.heads(torch.stack(features, dim=1))
+
+
+def test_batched_trunk():
+    torch.manual_seed(0)
+    input = torch.rand(2, 3, 4, 45, 45, 45)
+    for network in (Network3D, CommNet):
+        model = network(agents=3, frame_history=4, number_actions=6)
+        with torch.no_grad():
+            batched = model.heads(model.trunk(input))
+            looped = _looped_forward(model, input)
+        assert batched.shape == (2, 3, 6)
+        assert torch.allclose(batched, looped, atol=1e-5)
+
+
+def _per_agent_state_dict(model):
+    """ state dict in the old layout with one nn.Linear / nn.PReLU per
+    agent """
+    state_dict = {}
+    for key, value in model.state_dict().items():
+        name, param = key.split(".")
+        if name.startswith("fc"):
+            for i in range(model.agents):
+                state_dict[f"{name}.{i}.{param}"] = \
+                    value[i].t() if param == "weight" else value[i]
+        elif name in ("prelu4", "prelu5"):
+            for i in range(model.agents):
+                state_dict[f"{name}.{i}.{param}"] = value[i:i + 1]
+        else:
+            state_dict[key] = value
+    return state_dict
+
+
+def test_grouped_heads_per_agent_checkpoint():
+    torch.manual_seed(0)
+    features = torch.rand(5, 3, 512)
+    model = CommNet(agents=3, frame_history=4, number_actions=6)
+    old = _per_agent_state_dict(model)
+    # reference: the per-agent layers with explicit communication
+    x = features
+    for fc, prelu in (("fc1", "prelu4"), ("fc2", "prelu5"), ("fc3", None)):
+        comm = x.mean(1)
+        out = []
+        for i in range(3):
+            y = torch.nn.functional.linear(
+                torch.cat((x[:, i], comm), -1),
+                old[f"{fc}.{i}.weight"], old[f"{fc}.{i}.bias"])
+            if prelu is not None:
+                y = torch.nn.functional.prelu(y, old[f"{prelu}.{i}.weight"])
+            out.append(y)
+        x = torch.stack(out, 1)
+
+    loaded = CommNet(agents=3, frame_history=4, number_actions=6)
+    loaded.load_state_dict(old)
+    with torch.no_grad():
+        assert torch.allclose(loaded.heads(features), x, atol=1e-5)
+
+
+def test_load_single_agent_checkpoint():
+    path = os.path.join(os.path.dirname(__file__), "..", "data", "models",
+                        "BrainMRI", "SingleAgent.pt")
+    model = Network3D(agents=1, frame_history=4, number_actions=6)
+    model.load_state_dict(torch.load(path, map_location=model.device))
+    assert model.fc1.weight.shape == (1, 512, 256)
+    assert model.prelu4.weight.shape == (1,)
+
+
+def test_compact_network():
+    assert trunk_features((32, 32, 64, 64), (45, 45, 45)) == 512
+    input = torch.rand(2, 3, 4, 37, 37, 37) * 255
+    for network in (Network3D, CommNet):
+        model = network(agents=3, frame_history=4, number_actions=6,
+                        channels=(8, 8, 16, 16), image_size=(37, 37, 37))
+        assert model.fc1.in_features == trunk_features((8, 8, 16, 16),
+                                                       (37, 37, 37))
+        assert model(input).shape == (2, 3, 6)
+
+
+class _SilentLogger(object):
+    def log(self, message):
+        pass
+
+
+def _small_dqn():
+    return DQN(agents=2, frame_history=4, logger=_SilentLogger(),
+               type="CommNet", channels=(4, 4, 8, 8), image_size=(37, 37, 37))
+
+
+def _transitions(seed, batch_size=3):
+    generator = torch.Generator().manual_seed(seed)
+    states = torch.randint(0, 256, (2 * batch_size, 2, 4, 37, 37, 37),
+                           generator=generator, dtype=torch.uint8)
+    return (states[:batch_size].numpy(),
+            torch.randint(0, 6, (batch_size, 2), generator=generator).numpy(),
+            torch.rand(batch_size, 2, generator=generator).numpy(),
+            states[batch_size:].numpy(),
+            (torch.rand(batch_size, 2, generator=generator) < 0.5).numpy())
+
+
+def _distributed_update(rank, world_size, init_method):
+    dist.init_process_group("gloo", init_method=init_method, rank=rank,
+                            world_size=world_size)
+    # different initial weights, replaced by those of rank 0
+    torch.manual_seed(rank)
+    dqn = _small_dqn()
+    dqn.distribute()
+    start = {k: v.clone() for k, v in dqn.q_network.state_dict().items()}
+    dqn.train_q_network(_transitions(rank), 0.9)
+    params = torch.cat([p.detach().flatten()
+                        for p in dqn.q_network.parameters()])
+    gathered = [torch.zeros_like(params) for _ in range(world_size)]
+    dist.all_gather(gathered, params)
+    dist.destroy_process_group()
+    for other in gathered:
+        assert torch.equal(other, params)
+    # same update as on the concatenated mini-batches in one process
+    reference = _small_dqn()
+    reference.q_network.load_state_dict(start)
+    reference.copy_to_target_network()
+    batches = [_transitions(r) for r in range(world_size)]
+    reference.train_q_network(
+        tuple(torch.cat([torch.as_tensor(b[i]) for b in batches]).numpy()
+              for i in range(5)), 0.9)
+    expected = torch.cat([p.detach().flatten()
+                          for p in reference.q_network.parameters()])
+    torch.testing.assert_close(params, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_distributed_gradients(tmp_path):
+    mp.spawn(_distributed_update,
+             args=(2, f"file://{tmp_path / 'store'}"), nprocs=2, join=True)
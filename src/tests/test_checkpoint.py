@@ -0,0 +1,32 @@
+import os
+import pytest
+import torch
+from ..checkpoint import CheckpointWriter
+
+
+def test_checkpoint_rotation(tmp_path):
+    writer = CheckpointWriter(keep=3)
+    path = str(tmp_path / "latest_dqn.pt")
+    weight = torch.zeros(2)
+    for i in range(4):
+        weight.fill_(i)
+        writer.save({"weight": weight}, path)
+        # the saved copy does not change with the weights
+        weight.fill_(-1)
+        writer.flush()
+    assert len(writer.write_times()) == 4
+    assert torch.load(path)["weight"][0] == 3
+    assert torch.load(str(tmp_path / "latest_dqn.1.pt"))["weight"][0] == 2
+    assert torch.load(str(tmp_path / "latest_dqn.2.pt"))["weight"][0] == 1
+    assert sorted(os.listdir(tmp_path)) == [
+        "latest_dqn.1.pt", "latest_dqn.2.pt", "latest_dqn.pt"]
+    writer.close()
+
+
+def test_checkpoint_error(tmp_path):
+    writer = CheckpointWriter()
+    writer.save({"weight": torch.zeros(2)},
+                str(tmp_path / "missing" / "dqn.pt"))
+    with pytest.raises(Exception):
+        writer.flush()
+    writer.close()
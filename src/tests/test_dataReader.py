@@ -0,0 +1,21 @@
+import glob
+import os
+import pytest
+from ..dataReader import NiftiImage
+
+
+def test_cached_images_are_read_only():
+    filename = sorted(glob.glob(os.path.join(
+        os.path.dirname(__file__), "..", "data", "images", "*.nii.gz")))[0]
+    NiftiImage.cache_size = 1
+    try:
+        _, image = NiftiImage().decode(filename, label=True)
+        _, cached = NiftiImage().decode(filename, label=True)
+        assert cached is image
+        with pytest.raises(ValueError):
+            cached.data[0, 0, 0] = 1
+    finally:
+        NiftiImage.cache_size = 0
+        NiftiImage._cache.clear()
+    _, uncached = NiftiImage().decode(filename, label=True)
+    assert uncached is not image and uncached.data.flags.writeable
@@ -0,0 +1,29 @@
+import torch
+# the modules of the networks built by ensemble, see conftest
+from DQNModel import CommNet, Network3D
+from ensemble import StackedModels, load_model
+
+
+def test_load_model(tmp_path):
+    model = CommNet(agents=3, frame_history=4, number_actions=6,
+                    channels=(8, 8, 16, 16))
+    torch.save(model.state_dict(), tmp_path / "comm.pt")
+    loaded = load_model(tmp_path / "comm.pt", 4, 6, (45, 45, 45))
+    assert isinstance(loaded, CommNet) and loaded.agents == 3
+    single = Network3D(agents=1, frame_history=4, number_actions=6)
+    torch.save(single.state_dict(), tmp_path / "single.pt")
+    loaded = load_model(tmp_path / "single.pt", 4, 6, (45, 45, 45))
+    assert isinstance(loaded, Network3D) and loaded.agents == 1
+
+
+def test_stacked_models():
+    torch.manual_seed(0)
+    models = [CommNet(agents=2, frame_history=4, number_actions=6,
+                      channels=(8, 8, 16, 16)) for _ in range(3)]
+    for model in models:
+        model.train(False)
+    inputs = torch.rand(2, 1, 2, 4, 45, 45, 45) * 255
+    q_values = StackedModels(models).q_values([2, 0], inputs)
+    with torch.no_grad():
+        torch.testing.assert_close(q_values[0], models[2](inputs[0]))
+        torch.testing.assert_close(q_values[1], models[0](inputs[1]))
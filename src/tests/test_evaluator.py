@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+import numpy as np
+import torch
+from ..DQNModel import CommNet
+from ..evaluator import (BatchedEvaluator, MultiStartEvaluator,
+                         ParallelEvaluator, QValueCache)
+# the module read by the evaluators, see conftest
+from dataReader import NiftiImage
+
+
+def test_q_value_cache():
+    cache = QValueCache(size=2)
+    assert cache.get("a") is None
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    # "b" is now the least recently used entry
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert cache.hit_rate() == 0.6
+    cache.clear()
+    assert cache.get("a") is None
+
+
+class _Env(object):
+    """ Evaluation environment of one agent starting at random locations """
+
+    agents = 1
+
+    def __init__(self):
+        self.files = SimpleNamespace(num_files=3)
+        self.unwrapped = self
+        self.xscale = 1
+        self._file = 0
+
+    def set_files(self, indexes):
+        self._file = indexes[0]
+
+    def reset(self):
+        self._image = [SimpleNamespace(name=f"file{self._file}")]
+        self._location = [tuple(np.random.randint(0, 100, 3))]
+        return np.zeros((1, 37, 37, 37, 4), dtype=np.uint8)
+
+    def step(self, acts, q_values, isOver):
+        self._location = [tuple(np.add(self._location[0], acts[0]))]
+        info = {"distError_0": float(sum(self._location[0]))}
+        return (np.zeros((1, 37, 37, 37, 4), dtype=np.uint8), [0.0],
+                [False], info)
+
+
+def test_parallel_evaluator():
+    torch.manual_seed(0)
+    model = CommNet(agents=1, frame_history=4, number_actions=6,
+                    channels=(4, 4, 8, 8), image_size=(37, 37, 37))
+    model.train(False)
+    evaluator = ParallelEvaluator(_Env(), model, None, 1, 2, _Env,
+                                  processes=2, seed=5)
+    single = ParallelEvaluator(_Env(), model, None, 1, 2, _Env,
+                               processes=1, seed=5)
+    try:
+        first = list(evaluator.play_episodes())
+        pool = evaluator.pool
+        with torch.no_grad():
+            model.fc3.bias += 1
+        second = list(evaluator.play_episodes())
+        # the pool is reused, with the new weights
+        assert evaluator.pool is pool
+        for (_, starts, q_values, _), (_, starts_, q_values_, _) in zip(
+                first, second):
+            assert starts == starts_
+            np.testing.assert_allclose(q_values_, q_values + 1, rtol=1e-5)
+        # the starting points only depend on the seed and the file
+        assert [starts for _, starts, _, _ in single.play_episodes()] == \
+            [starts for _, starts, _, _ in second]
+        assert len(set(starts[0] for _, starts, _, _ in first)) == 3
+    finally:
+        evaluator.close()
+        single.close()
+
+
+def test_cache_size_restored():
+    model = CommNet(agents=1, frame_history=4, number_actions=6,
+                    channels=(4, 4, 8, 8), image_size=(37, 37, 37))
+    NiftiImage._cache.update(a=1, b=2)
+    try:
+        evaluators = [MultiStartEvaluator(_Env, model, None, 1, 2, starts=2),
+                      BatchedEvaluator(_Env, model, None, 1, 2, volumes=2)]
+        assert NiftiImage.cache_size == 1 and list(NiftiImage._cache) == [
+            "b"]
+        for evaluator in reversed(evaluators):
+            evaluator.close()
+        assert NiftiImage.cache_size == 0 and not NiftiImage._cache
+    finally:
+        NiftiImage.set_cache_size(0)
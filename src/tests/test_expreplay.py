@@ -1,3 +1,4 @@
+import numpy as np
 from ..expreplay import ReplayMemory
 
 
@@ -16,7 +17,7 @@ def test_instantiate_expreplay():
     assert replay.action.shape == (1, 10)
     assert replay.reward.shape == (1, 10)
     assert replay.isOver.shape == (1, 10)
-    assert len(replay._hist) == 0
+    assert not replay.recent_state().any()
 
 
 def test_slices():
@@ -27,3 +28,147 @@ def test_slices():
     replay.isOver[1, 9] = True
     replay._curr_size = 10
     replay._slice(replay.isOver[1], 7, 1)
+
+
+def _fill(replay, n, offset=0):
+    for k in range(n):
+        value = offset + k
+        replay.append((np.full((replay.agents,) + replay.state_shape,
+                               value % 256, dtype='uint8'),
+                       [value] * replay.agents,
+                       [float(value)] * replay.agents,
+                       [False] * replay.agents))
+
+
+def test_snapshot_roundtrip(tmp_path):
+    replay = ReplayMemory(max_size=8, state_shape=(3, 3), history_len=4,
+                          agents=2)
+    _fill(replay, 5)
+    replay.save(str(tmp_path), background=False)
+    # incremental snapshot, wraps around the ring
+    _fill(replay, 6, offset=5)
+    replay.save(str(tmp_path), background=False)
+
+    restored = ReplayMemory(max_size=8, state_shape=(3, 3), history_len=4,
+                            agents=2)
+    restored.load(str(tmp_path))
+    assert len(restored) == len(replay)
+    assert restored._curr_pos == replay._curr_pos
+    np.testing.assert_array_equal(restored.state, replay.state)
+    np.testing.assert_array_equal(restored.action, replay.action)
+    np.testing.assert_array_equal(restored.reward, replay.reward)
+    np.testing.assert_array_equal(restored.isOver, replay.isOver)
+
+    # appending to the restored buffer leaves the snapshot untouched
+    _fill(restored, 1, offset=100)
+    reloaded = ReplayMemory(max_size=8, state_shape=(3, 3), history_len=4,
+                            agents=2)
+    reloaded.load(str(tmp_path))
+    np.testing.assert_array_equal(reloaded.state, replay.state)
+
+
+def test_sample_into_buffers():
+    replay = ReplayMemory(max_size=10, state_shape=(3, 3), history_len=4,
+                          agents=2)
+    _fill(replay, 12)
+    replay.isOver[1, 4] = True
+    out = replay.empty_batch(16)
+    batch = replay.sample(16, out=out, rng=np.random.RandomState(0))
+    assert all(a is b for a, b in zip(batch, out))
+    states, actions, rewards, next_states, isOver = batch
+    assert states.shape == (16, 2, 4, 3, 3)
+    assert next_states.shape == (16, 2, 4, 3, 3)
+    assert actions.shape == rewards.shape == isOver.shape == (16, 2)
+    # frames are consecutive and the action matches the last state
+    np.testing.assert_array_equal(states[:, :, 1:], next_states[:, :, :-1])
+    last = states[:, :, -1, 0, 0].astype(int)
+    np.testing.assert_array_equal(np.where(isOver, 0, actions % 256),
+                                  last)
+    assert not states[isOver].any()
+
+
+def test_recent_state():
+    replay = ReplayMemory(max_size=10, state_shape=(3, 3), history_len=4,
+                          agents=2)
+    _fill(replay, 2, offset=1)
+    recent = replay.recent_state()
+    assert recent.shape == (2, 4, 3, 3)
+    np.testing.assert_array_equal(recent[:, :, 0, 0], [[0, 0, 1, 2]] * 2)
+    _fill(replay, 5, offset=3)
+    np.testing.assert_array_equal(replay.recent_state()[:, :, 0, 0],
+                                  [[4, 5, 6, 7]] * 2)
+    replay.append((np.ones((2, 3, 3), dtype='uint8'), [0, 0], [0, 0],
+                   [True, True]))
+    assert not replay.recent_state().any()
+
+
+def test_n_step_returns():
+    replay = ReplayMemory(max_size=30, state_shape=(2, 2), history_len=4,
+                          agents=2, n_step=3, gamma=0.5)
+    rng = np.random.RandomState(0)
+    for k in range(30):
+        replay.append((np.full((2, 2, 2), k, dtype='uint8'), [k, k],
+                       rng.uniform(-2, 2, size=2), rng.rand(2) < 0.2))
+    states, actions, rewards, next_states, isOver = replay.sample(
+        32, rng=np.random.RandomState(1))
+    for b in range(32):
+        for i in range(2):
+            t = actions[b, i]
+            ret, over = 0., False
+            for j in range(3):
+                ret += 0.5 ** j * np.clip(replay.reward[i, t + j], -1, 1)
+                if replay.isOver[i, t + j]:
+                    over = True
+                    break
+            assert np.isclose(rewards[b, i], ret)
+            assert isOver[b, i] == over
+            assert next_states[b, i, -1, 0, 0] == t + 3
+
+
+def test_extend_matches_append():
+    appended = ReplayMemory(max_size=6, state_shape=(3, 3), history_len=3,
+                            agents=2)
+    extended = ReplayMemory(max_size=6, state_shape=(3, 3), history_len=3,
+                            agents=2)
+    _fill(appended, 2)
+    _fill(extended, 2)
+    n = 9
+    states = np.arange(n * 2 * 9, dtype='uint8').reshape(n, 2, 3, 3)
+    actions = np.arange(n * 2).reshape(n, 2) % 6
+    rewards = np.linspace(-1, 1, n * 2).reshape(n, 2)
+    isOver = np.zeros((n, 2), dtype=bool)
+    isOver[4] = True
+    isOver[6, 0] = True
+    for exp in zip(states, actions, rewards, isOver):
+        appended.append(exp)
+    extended.extend(states, actions, rewards, isOver)
+    assert len(extended) == len(appended)
+    assert extended._curr_pos == appended._curr_pos
+    assert extended._appended == appended._appended
+    np.testing.assert_array_equal(extended.state, appended.state)
+    np.testing.assert_array_equal(extended.action, appended.action)
+    np.testing.assert_array_equal(extended.reward, appended.reward)
+    np.testing.assert_array_equal(extended.isOver, appended.isOver)
+    np.testing.assert_array_equal(extended.recent_state(),
+                                  appended.recent_state())
+
+
+def test_sample_blanks_earlier_episode():
+    replay = ReplayMemory(max_size=20, state_shape=(3, 3), history_len=4,
+                          agents=2)
+    _fill(replay, 12, offset=1)
+    # agent 0 restarted after slot 5, agent 1 went on
+    replay.isOver[0, 5] = True
+    states, actions, _, next_states, _ = replay.sample(
+        64, rng=np.random.RandomState(0))
+    for b in range(64):
+        last = actions[b, 0] - 1
+        for j in range(4):
+            slot = last - 3 + j
+            blank = slot <= 5 < last or last == 5
+            assert (states[b, 0, j, 0, 0] == 0) == blank
+            assert next_states[b, 0, j, 0, 0] == \
+                (0 if slot + 1 <= 5 < last + 1 else slot + 2)
+    # the frames of agent 1 are never blanked
+    np.testing.assert_array_equal(states[:, 1, -1, 0, 0], actions[:, 1])
+    assert states[:, 1].all()
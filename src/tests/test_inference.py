@@ -0,0 +1,21 @@
+import numpy as np
+import torch
+from ..DQNModel import CommNet
+from ..inference import InferenceRunner
+
+
+def test_inference_runner():
+    torch.manual_seed(0)
+    model = CommNet(agents=2, frame_history=4, number_actions=6)
+    model.train(False)
+    obs = np.random.RandomState(0).randint(
+        0, 255, (2, 45, 45, 45, 4)).astype(np.float32)
+    inputs = torch.from_numpy(obs).permute(0, 4, 1, 2, 3).unsqueeze(0)
+    with torch.no_grad():
+        expected = model.forward(inputs.contiguous()).squeeze(0)
+    actions, q_values = InferenceRunner(model).greedy(inputs)
+    np.testing.assert_allclose(q_values, expected.numpy(), rtol=1e-5,
+                               atol=1e-6)
+    np.testing.assert_array_equal(actions, expected.argmax(-1).numpy())
+    q_values = InferenceRunner(model, channels_last=True).q_values(inputs)
+    torch.testing.assert_close(q_values.squeeze(0), expected)
@@ -0,0 +1,22 @@
+import pytest
+from ..learner import LearnerThread
+
+
+def test_learner_thread_order():
+    learner = LearnerThread(depth=2)
+    done = []
+    for i in range(10):
+        learner.submit(lambda i=i: done.append(i))
+    learner.wait()
+    assert done == list(range(10))
+    learner.close()
+
+
+def test_learner_thread_error():
+    learner = LearnerThread(depth=1)
+
+    def fail():
+        raise ValueError("update failed")
+    learner.submit(fail)
+    with pytest.raises(ValueError):
+        learner.wait()
@@ -0,0 +1,22 @@
+import numpy as np
+from ..expreplay import ReplayMemory
+from ..prefetch import BatchPrefetcher
+
+
+def test_prefetcher_rng():
+    replay = ReplayMemory(max_size=20, state_shape=(3, 3), history_len=4,
+                          agents=1)
+    for i in range(20):
+        replay.append((np.full((1, 3, 3), i), [i], [0], [False]))
+    rng = np.random.RandomState(3)
+    prefetcher = BatchPrefetcher(replay, 4, depth=3, rng=rng)
+    expected = np.random.RandomState(3)
+    try:
+        for _ in range(2):
+            batch = prefetcher.next()
+            np.testing.assert_array_equal(
+                batch[1].numpy(), replay.sample(4, rng=expected)[1])
+        # only advanced by the minibatches returned so far
+        assert rng.randint(1 << 30) == expected.randint(1 << 30)
+    finally:
+        prefetcher.close()
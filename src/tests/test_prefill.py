@@ -0,0 +1,57 @@
+import glob
+import os
+import numpy as np
+# the modules read by prefill, see conftest
+from dataReader import NiftiImage
+from logger import Logger
+from medical import MedicalPlayer
+from prefill import random_episodes
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def test_random_episodes_match_steps(tmp_path):
+    images = tmp_path / "images.txt"
+    landmarks = tmp_path / "landmarks.txt"
+    images.write_text(sorted(glob.glob(
+        os.path.join(DATA, "images", "*.nii.gz")))[0] + "\n")
+    landmarks.write_text(sorted(glob.glob(
+        os.path.join(DATA, "landmarks", "*.txt")))[0] + "\n")
+    logger = Logger("runs", False)
+    # cases met by the episodes below
+    border, oscillation, down = False, False, False
+    NiftiImage.cache_size = 1
+    try:
+        for multiscale in (False, True):
+            for agents in (1, 2):
+                for seed in range(3):
+                    envs = [MedicalPlayer(files_list=[open(images),
+                                                      open(landmarks)],
+                                          file_type="brain",
+                                          landmark_ids=list(range(agents)),
+                                          screen_dims=(45, 45, 45),
+                                          task="train", agents=agents,
+                                          multiscale=multiscale,
+                                          logger=logger)
+                            for _ in range(2)]
+                    np.random.seed(seed)
+                    (states, actions, rewards, isOver), = random_episodes(
+                        envs[0], 1, 100)
+                    np.random.seed(seed)
+                    env = envs[1]
+                    env.reset()
+                    for t in range(len(actions)):
+                        scale = env.xscale
+                        state, reward, terminal, _ = env.step(
+                            actions[t].copy(), np.zeros((agents, 6)), None)
+                        np.testing.assert_array_equal(state, states[t])
+                        np.testing.assert_allclose(reward, rewards[t],
+                                                   rtol=1e-5)
+                        assert list(terminal) == list(isOver[t])
+                        down |= env.xscale < scale
+                    border |= (rewards == -1).any()
+                    oscillation |= not multiscale and len(actions) < 100
+    finally:
+        NiftiImage.cache_size = 0
+        NiftiImage._cache.clear()
+    assert border and oscillation and down
@@ -0,0 +1,44 @@
+import json
+import os
+import pstats
+import torch
+from ..profiling import Profiler
+
+
+class _Stepped(object):
+    def step(self, x):
+        return self.work(x)
+
+    def work(self, x):
+        y = torch.ones(3, requires_grad=True) * x
+        y.sum().backward()
+        return x + 1
+
+
+def test_profiler(tmpdir):
+    step, work = _Stepped.step, _Stepped.work
+    profiler = Profiler(str(tmpdir), steps=2, warmup=1)
+    profiler.label(_Stepped, "work", "work")
+    profiler.count_steps(_Stepped, "step")
+    stepped = _Stepped()
+    assert [stepped.step(i) for i in range(5)] == [1, 2, 3, 4, 5]
+    assert profiler.count == 3
+    # the wrapped functions are restored after the profiled steps
+    assert _Stepped.step is step and _Stepped.work is work
+    with open(os.path.join(str(tmpdir), "trace.json")) as f:
+        events = json.load(f)["traceEvents"]
+    assert sum(event.get("name") == "work" for event in events) == 2
+    stats = pstats.Stats(os.path.join(str(tmpdir), "profile.pstats"))
+    assert any(function == "work" and calls == 2
+               for (_, _, function), (calls, *_) in stats.stats.items())
+    assert os.path.getsize(os.path.join(str(tmpdir), "profile.txt")) > 0
+    profiler.close()
+
+
+def test_profiler_closed_early(tmpdir):
+    profiler = Profiler(str(tmpdir), steps=10)
+    profiler.count_steps(_Stepped, "step")
+    _Stepped().step(0)
+    profiler.close()
+    assert os.path.exists(os.path.join(str(tmpdir), "trace.json"))
+    assert profiler.count == 1
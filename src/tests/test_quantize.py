@@ -0,0 +1,19 @@
+import torch
+from ..DQNModel import Network3D, CommNet
+from ..quantize import QuantizedNetwork
+
+
+def test_quantized_network():
+    torch.manual_seed(0)
+    input = torch.randint(0, 255, (2, 3, 4, 45, 45, 45), dtype=torch.uint8)
+    for network in (Network3D, CommNet):
+        model = network(agents=3, frame_history=4, number_actions=6)
+        quantized = QuantizedNetwork(model).prepare()
+        with torch.no_grad():
+            expected = model(input)
+            # observers only record the ranges, the heads are split per agent
+            torch.testing.assert_close(quantized(input), expected)
+            quantized.convert()
+            output = quantized(input)
+        assert output.shape == expected.shape
+        assert (output - expected).norm() < 0.1 * expected.norm()
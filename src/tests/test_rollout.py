@@ -0,0 +1,46 @@
+from collections import Counter
+import numpy as np
+import torch
+from ..rollout import GreedyRollout
+
+
+def _oscillate(history, oscillations_allowed=4):
+    """ MedicalPlayer._oscillate for one agent """
+    freq = Counter(history).most_common()
+    if freq[0][0] == (0, 0, 0):
+        return (len(freq) >= oscillations_allowed and
+                freq[1][1] >= oscillations_allowed)
+    return freq[0][1] >= oscillations_allowed
+
+
+def test_stuck_matches_env():
+    rng = np.random.RandomState(0)
+    rollout = GreedyRollout(None, agents=1, history_length=20)
+    for _ in range(200):
+        padding = rng.randint(0, 21)
+        visited = [tuple(rng.randint(1, 4, 3)) for _ in range(20 - padding)]
+        history = [(0, 0, 0)] * padding + visited
+        stuck = rollout._stuck(torch.tensor([history]))
+        assert bool(stuck[0]) == _oscillate(history)
+
+
+def test_scripted_episode():
+    agents = 2
+
+    def network(frames):
+        # always move right (X+), the agents stop at the image border
+        q = torch.zeros(frames.shape[:2] + (6,))
+        q[..., 2] = frames.mean((2, 3, 4, 5))
+        return q
+
+    rollout = torch.jit.script(GreedyRollout(
+        torch.jit.trace(network, torch.zeros(1, agents, 4, 45, 45, 45)),
+        agents))
+    volume = torch.rand(60, 50, 40)
+    locations, score, q_values, terminal = rollout(
+        [volume] * agents, torch.tensor([[50, 20, 20], [30, 25, 20]]),
+        1, 1, False, 100, torch.zeros(agents, 3, dtype=torch.double),
+        torch.ones(3, dtype=torch.double))
+    assert terminal
+    assert locations[-1, :, 0].tolist() == [59, 59]
+    assert q_values.shape == (agents, 6)
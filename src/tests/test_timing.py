@@ -0,0 +1,56 @@
+import time
+from ..timing import Timers
+
+
+class _Timed(object):
+    def work(self, x):
+        return 2 * x
+
+    def items(self):
+        yield 1
+        yield 2
+
+
+class _Board(object):
+    def __init__(self):
+        self.scalars = {}
+
+    def write_to_board(self, name, scalars, index=0):
+        self.scalars[name] = scalars
+
+
+def test_timers():
+    timers = Timers()
+    board = _Board()
+    timers.write_to_board(board)
+    assert board.scalars == {}
+    timers.instrument(_Timed, "work", "step")
+    timers.instrument(_Timed, "items")
+    timed = _Timed()
+    assert [timed.work(i) for i in range(3)] == [0, 2, 4]
+    assert list(timed.items()) == [1, 2]
+    timers.write_to_board(board, steps="step")
+    assert board.scalars["timing/step"]["calls"] == 3
+    assert board.scalars["timing/_Timed.items"]["calls"] == 2
+    assert board.scalars["timing/step"]["p99_ms"] >= \
+        board.scalars["timing/step"]["p50_ms"]
+    assert board.scalars["timing"]["steps_per_s"] > 0
+    durations, _ = timers.pop()
+    assert durations == {}
+
+
+def test_timers_section():
+    timers = Timers()
+    board = _Board()
+    timers.instrument(_Timed, "work", "step")
+    timed = _Timed()
+    timed.work(0)
+    with timers.section("validation"):
+        timed.work(1)
+        timed.work(2)
+        time.sleep(0.2)
+    timers.write_to_board(board, steps="step")
+    assert board.scalars["timing/step"]["calls"] == 1
+    assert board.scalars["timing/validation/step"]["calls"] == 2
+    # the time spent in the section is not counted
+    assert board.scalars["timing"]["steps_per_s"] > 10
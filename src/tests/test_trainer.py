@@ -0,0 +1,109 @@
+import random
+from types import SimpleNamespace
+import numpy as np
+from ..logger import Logger
+from ..trainer import Trainer
+
+IMAGE_SIZE = (37, 37, 37)
+
+
+class _Env(object):
+    """ Environment of two agents stepping over random frames """
+
+    agents = 2
+    files = SimpleNamespace(num_files=1)
+
+    def __init__(self, over=()):
+        """ :param over: steps after which the first agent is over """
+        self.over = over
+        self.steps = 0
+        self.is_over = []
+        self.restarted = []
+
+    def _frames(self):
+        return np.random.randint(0, 255, (self.agents,) + IMAGE_SIZE,
+                                 dtype=np.uint8)
+
+    def reset(self):
+        return self._frames()
+
+    def step(self, acts, q_values, isOver):
+        self.steps += 1
+        self.is_over.append(list(isOver))
+        terminal = [self.steps in self.over, False]
+        info = {f"distError_{i}": 1.0 for i in range(self.agents)}
+        return self._frames(), [0.5] * self.agents, terminal, info
+
+    def reset_agents(self, agents):
+        self.restarted.append((self.steps, list(agents)))
+
+
+def _trainer(env=None, **kwargs):
+    kwargs = dict(dict(init_memory_size=10, max_episodes=2), **kwargs)
+    return Trainer(env or _Env(), image_size=IMAGE_SIZE, replay_buffer_size=50,
+                   steps_per_episode=5, channels=(4, 4, 8, 8),
+                   logger=Logger("runs", False), **kwargs)
+
+
+def test_snapshot_resume(tmp_path):
+    directory = str(tmp_path)
+    trainer = _trainer()
+    trainer.set_reproducible()
+    trainer.init_memory()
+    trainer.eps = 0.5
+    trainer.sample_rng.random_sample()
+    trainer.save_snapshot(directory, 3)
+    trainer.commit_snapshot(3, wait=True)
+    saved = trainer.buffer.state.copy()
+    python_rng = random.getstate()
+    sample_rng = trainer.sample_rng.randint(1 << 30)
+
+    # a snapshot interrupted before its commit leaves the previous one
+    trainer.init_memory_size = 20
+    trainer.eps = 1
+    trainer.init_memory()
+    trainer.eps = 0.2
+    trainer.save_snapshot(directory, 6)
+    trainer.buffer._snapshot_thread.join()
+    random.random()
+    resumed = _trainer()
+    assert resumed.load_snapshot(directory) == 3
+    assert resumed.eps == 0.5 and len(resumed.buffer) == 10
+    np.testing.assert_array_equal(resumed.buffer.state, saved)
+    assert random.getstate() == python_rng
+    assert resumed.sample_rng.randint(1 << 30) == sample_rng
+
+    # appended after the start of the snapshot and written with its commit
+    trainer.buffer.append((np.zeros((2,) + IMAGE_SIZE), [0, 0], [0, 0],
+                           [False, False]))
+    trainer.commit_snapshot(6)
+    resumed = _trainer()
+    assert resumed.load_snapshot(directory) == 6
+    assert resumed.eps == 0.2 and len(resumed.buffer) == 21
+    np.testing.assert_array_equal(resumed.buffer.state, trainer.buffer.state)
+
+    # the resumed buffer maps the files of the latest slot, which are
+    # replaced rather than rewritten by the snapshot after the next one
+    for episode in (7, 8):
+        resumed.buffer.append((np.full((2,) + IMAGE_SIZE, episode),
+                               [0, 0], [0, 0], [False, False]))
+        resumed.save_snapshot(directory, episode)
+        resumed.commit_snapshot(episode, wait=True)
+    np.testing.assert_array_equal(resumed.buffer.state[:, :21],
+                                  trainer.buffer.state[:, :21])
+    reloaded = _trainer()
+    assert reloaded.load_snapshot(directory) == 8
+    np.testing.assert_array_equal(reloaded.buffer.state,
+                                  resumed.buffer.state)
+
+
+def test_restart_agents():
+    env = _Env(over=(2,))
+    trainer = _trainer(env, init_memory_size=0, max_episodes=1,
+                       train_freq=100, async_reset=True)
+    trainer.train()
+    assert env.restarted == [(2, [0])]
+    # the restarted agent is not over at its next step
+    assert env.is_over == [[False, False]] * 5
+    assert trainer.buffer.isOver[:, :5].tolist() == [
+        [False, True, False, False, False], [False] * 5]
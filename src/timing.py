@@ -0,0 +1,131 @@
+import contextlib
+import functools
+import inspect
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+
+
+class Timers(object):
+    """
+    Registry of the durations of the calls to instrumented functions,
+    reported per epoch. Functions are only timed once instrument has wrapped
+    them in place, so that timing costs nothing when it is off.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._durations = defaultdict(list)
+        self._start = time.perf_counter()
+        # time spent in sections since the last pop
+        self._excluded = 0
+        self._local = threading.local()
+
+    def _name(self, name):
+        section = getattr(self._local, "section", None)
+        return name if section is None else f"{section}/{name}"
+
+    @contextlib.contextmanager
+    def section(self, section):
+        """
+        Record the calls made by this thread inside the block under
+        section/name, and leave the duration of the block out of the elapsed
+        time of pop, e.g. for the validation episodes played during training
+        """
+        start = time.perf_counter()
+        self._local.section = section
+        try:
+            yield
+        finally:
+            self._local.section = None
+            self._excluded += time.perf_counter() - start
+
+    def instrument(self, owner, attribute, name=None):
+        """
+        Time the calls to owner.attribute (a function of a class or module)
+        under name, for a generator the time spent in each next()
+        """
+        function = getattr(owner, attribute)
+        name = name or f"{owner.__name__}.{attribute}"
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    self._durations[self._name(name)].append(
+                        time.perf_counter() - start)
+                    yield item
+        else:
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self._durations[self._name(name)].append(
+                        time.perf_counter() - start)
+        setattr(owner, attribute, timed)
+        self.enabled = True
+
+    def pop(self):
+        """
+        Durations (in seconds) of the calls of every timer since the last
+        call, and the time elapsed since then outside of the sections
+        """
+        durations, self._durations = self._durations, defaultdict(list)
+        now = time.perf_counter()
+        elapsed, self._start = now - self._start - self._excluded, now
+        self._excluded = 0
+        return dict(durations), elapsed
+
+    def write_to_board(self, logger, index=0, steps="env_step"):
+        """
+        Board the mean, median and 99th percentile durations of every timer
+        since the last call, and the number of calls to steps per second
+        outside of the sections
+        """
+        if not self.enabled:
+            return
+        durations, elapsed = self.pop()
+        for name, values in sorted(durations.items()):
+            values = np.array(values) * 1000
+            logger.write_to_board(f"timing/{name}", {
+                "mean_ms": values.mean(),
+                "p50_ms": np.percentile(values, 50),
+                "p99_ms": np.percentile(values, 99),
+                "calls": len(values)}, index)
+        logger.write_to_board("timing", {
+            "steps_per_s": len(durations.get(steps, [])) / elapsed}, index)
+
+
+timers = Timers()
+
+
+def instrument_training():
+    """
+    Time the hot paths of training: image decoding, cropping, environment
+    steps, replay sampling, action selection and updates. Must be called
+    before the environments are created.
+    """
+    from dataReader import (filesListBrainMRLandmark, filesListCardioLandmark,
+                            filesListFetalUSLandmark)
+    from medical import MedicalPlayer
+    from expreplay import ReplayMemory
+    from trainer import Trainer
+    from DQNModel import DQN
+    for files in (filesListBrainMRLandmark, filesListCardioLandmark,
+                  filesListFetalUSLandmark):
+        timers.instrument(files, "sample_circular", "decode")
+    timers.instrument(MedicalPlayer, "step", "env_step")
+    timers.instrument(MedicalPlayer, "_current_state", "crop")
+    timers.instrument(ReplayMemory, "sample", "replay_sample")
+    timers.instrument(Trainer, "get_next_actions", "act")
+    # forward pass and loss, and the whole update with the backward pass
+    timers.instrument(DQN, "_calculate_loss", "update_forward")
+    timers.instrument(DQN, "train_q_network", "update")
@@ -1,8 +1,19 @@
+import copy
+import functools
+import os
+import random
+import threading
 import torch
 import numpy as np
 from expreplay import ReplayMemory
+from prefetch import BatchPrefetcher
+from prefill import random_episodes
+from learner import LearnerThread
+from timing import timers
 from DQNModel import DQN
-from evaluator import Evaluator
+from evaluator import (Evaluator, AsyncValidator, BatchedEvaluator,
+                       ParallelEvaluator)
+from inference import InferenceRunner
 from tqdm import tqdm
 
 
@@ -26,7 +37,50 @@ class Trainer(object):
                  model_name="CommNet",
                  logger=None,
                  train_freq=1,
+                 snapshot_freq=0,
+                 resume=None,
+                 prefetch=0,
+                 n_step=1,
+                 channels_last=False,
+                 bf16=False,
+                 compile=False,
+                 teacher=None,
+                 channels=(32, 32, 64, 64),
+                 network_image_size=None,
+                 eval_processes=1,
+                 eval_volumes=1,
+                 make_eval_env=None,
+                 async_validation=False,
+                 learner_thread=0,
+                 prefill_episodes=0,
+                 async_reset=False,
                  ):
+        """
+        :param teacher: Q-network whose Q-values are distilled into a
+            (smaller) network instead of Q-learning, the teacher also
+            selects the greedy actions
+        :param channels: channels of the conv layers of the trained network
+        :param network_image_size: size of the crops seen by the trained
+            network, the centre of the image_size crops of the environment
+        :param eval_processes: number of processes playing the validation
+            files, each in an environment returned by make_eval_env (which
+            must be picklable)
+        :param eval_volumes: number of validation files played at the same
+            time in this process, batching their forward passes
+        :param async_validation: play the validation files in a background
+            process (with an environment returned by make_eval_env) on a
+            copy of the weights while training goes on
+        :param learner_thread: run the updates on a background thread while
+            the environment is stepped, with at most learner_thread updates
+            waiting. The agents act with a copy of the Q-network published
+            after every update. 0 to update in the training loop.
+        :param prefill_episodes: number of random episodes generated at once
+            per volume to fill the replay buffer before training, without
+            stepping the environment. 0 to step the environment.
+        :param async_reset: restart the agents whose episode is over from
+            new starting points in the same image while the others go on,
+            instead of waiting for all the agents to be over
+        """
         self.env = env
         self.eval_env = eval_env
         self.agents = env.agents
@@ -49,27 +103,116 @@ class Trainer(object):
             self.replay_buffer_size,
             self.image_size,
             self.frame_history,
-            self.agents)
+            self.agents,
+            n_step=n_step,
+            gamma=self.gamma)
         self.dqn = DQN(
             self.agents,
             self.frame_history,
             logger=logger,
-            type=model_name)
+            type=model_name,
+            n_step=n_step,
+            channels=channels,
+            image_size=network_image_size or image_size)
         self.dqn.q_network.train(True)
-        self.evaluator = Evaluator(eval_env,
-                                   self.dqn.q_network,
-                                   logger,
-                                   self.agents,
-                                   steps_per_episode)
+        # action selection of the agents and of the validation episodes
+        self.q_runner = InferenceRunner(
+            self.dqn.q_network, channels_last=channels_last, bf16=bf16,
+            compile=compile, logger=logger)
+        self.target_runner = InferenceRunner(
+            self.dqn.target_network, channels_last=channels_last, bf16=bf16,
+            compile=compile, logger=logger)
+        self.teacher = teacher
+        self.act_runner = self.q_runner
+        self.learner_thread = learner_thread
+        # held to publish the weights used to act, and while acting
+        self._publish_lock = threading.Lock()
+        self.act_network = None
+        if teacher is not None:
+            teacher.train(False)
+            self.act_runner = InferenceRunner(
+                teacher, channels_last=channels_last, bf16=bf16,
+                compile=compile, logger=logger)
+        elif learner_thread > 0:
+            self.act_network = copy.deepcopy(self.dqn.q_network)
+            self.act_network.train(False)
+            self.act_runner = InferenceRunner(
+                self.act_network, channels_last=channels_last, bf16=bf16,
+                compile=compile, logger=logger)
+        if eval_processes > 1 and eval_env is not None:
+            self.evaluator = ParallelEvaluator(eval_env,
+                                               self.dqn.q_network,
+                                               logger,
+                                               self.agents,
+                                               steps_per_episode,
+                                               make_eval_env,
+                                               eval_processes)
+        elif eval_volumes > 1 and eval_env is not None:
+            self.evaluator = BatchedEvaluator(make_eval_env,
+                                              self.dqn.q_network,
+                                              logger,
+                                              self.agents,
+                                              steps_per_episode,
+                                              eval_volumes,
+                                              runner=self.q_runner)
+        else:
+            self.evaluator = Evaluator(eval_env,
+                                       self.dqn.q_network,
+                                       logger,
+                                       self.agents,
+                                       steps_per_episode,
+                                       runner=self.q_runner)
+        self.validator = None
+        if async_validation and eval_env is not None:
+            self.validator = AsyncValidator(self.dqn.q_network,
+                                            make_eval_env,
+                                            self.agents,
+                                            steps_per_episode)
         self.logger = logger
         self.train_freq = train_freq
+        self.snapshot_freq = snapshot_freq
+        self.resume = resume
+        self.prefetch = prefetch
+        self.prefill_episodes = prefill_episodes
+        self.async_reset = async_reset
+        # (directory, slot) of the snapshot being written
+        self._snapshot = None
+        # draws the minibatches, apart from the actions of the agents as
+        # they may be sampled on another thread, saved in the snapshots
+        self.sample_rng = np.random.RandomState(0)
 
     def train(self):
         self.logger.log(self.dqn.q_network)
+        if self.teacher is not None:
+            self.logger.log("Distilling the Q-values of the teacher")
+        # the RNG states are then restored from the snapshot when resuming
         self.set_reproducible()
-        self.init_memory()
-        episode = 1
+        if self.resume is not None:
+            episode = self.load_snapshot(self.resume) + 1
+        else:
+            self.init_memory()
+            episode = 1
+        prefetcher = None
+        if self.prefetch > 0:
+            prefetcher = BatchPrefetcher(self.buffer, self.batch_size,
+                                         depth=self.prefetch,
+                                         pin_memory=True,
+                                         rng=self.sample_rng)
+        if prefetcher is not None:
+            next_batch = prefetcher.next
+        else:
+            next_batch = functools.partial(self.buffer.sample,
+                                           self.batch_size,
+                                           rng=self.sample_rng)
+        learner = None
+        if self.learner_thread > 0:
+            learner = LearnerThread(self.learner_thread)
+            if self.act_network is not None:
+                # the weights may come from a snapshot
+                self.act_network.load_state_dict(
+                    self.dqn.q_network.state_dict())
         acc_steps = 0
+        restarts = 0
         epoch_distances = []
         while episode <= self.max_episodes:
             # Reset the environment for the start of the episode.
@@ -87,31 +230,116 @@ class Trainer(object):
                 score = [sum(x) for x in zip(score, reward)]
                 self.buffer.append((obs, acts, reward, terminal))
                 if acc_steps % self.train_freq == 0:
-                    mini_batch = self.buffer.sample(self.batch_size)
-                    loss = self.dqn.train_q_network(mini_batch, self.gamma)
-                    losses.append(loss)
+                    if learner is not None:
+                        learner.submit(functools.partial(
+                            self.update, next_batch, losses))
+                    else:
+                        losses.append(self.train_step(next_batch()))
                 if all(t for t in terminal):
                     break
+                if self.async_reset and any(terminal):
+                    restarts += sum(terminal)
+                    terminal = self.restart_agents(terminal)
             epoch_distances.append([info['distError_' + str(i)]
                                     for i in range(self.agents)])
             self.append_episode_board(info, score, "train", episode)
             if (episode * self.epoch_length) % self.update_frequency == 0:
-                self.dqn.copy_to_target_network()
+                if learner is not None:
+                    learner.submit(self.copy_to_target_network)
+                else:
+                    self.copy_to_target_network()
             self.eps = max(self.min_eps, self.eps - self.delta)
+            self.poll_validation()
             # Every epoch
             if episode % self.epoch_length == 0:
+                if learner is not None:
+                    # the weights must not change while they are evaluated
+                    # and saved
+                    learner.wait()
                 self.append_epoch_board(epoch_distances, self.eps, losses,
                                         "train", episode)
+                if self.async_reset:
+                    self.logger.write_to_board(
+                        "train", {"agent_restarts": restarts}, episode)
+                    restarts = 0
                 self.validation_epoch(episode)
                 self.dqn.save_model(name="latest_dqn.pt", forced=True)
+                self.logger.write_save_times(episode)
+                timers.write_to_board(self.logger, episode)
                 self.dqn.scheduler.step()
                 epoch_distances = []
+                epoch = episode // self.epoch_length
+                if (self.logger.write and self.snapshot_freq > 0
+                        and epoch % self.snapshot_freq == 0):
+                    self.save_snapshot(
+                        os.path.join(self.logger.dir, "snapshot"), episode)
+            self.commit_snapshot(episode, learner=learner)
             episode += 1
+        if learner is not None:
+            learner.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        if self.validator is not None:
+            self.poll_validation(wait=True)
+            self.validator.close()
+        self.evaluator.close()
+        self.commit_snapshot(episode - 1, wait=True)
+        self.logger.flush_models()
+
+    def train_step(self, mini_batch):
+        """ Q-learning or distillation update on one mini-batch """
+        if self.teacher is None:
+            return self.dqn.train_q_network(mini_batch, self.gamma)
+        states = torch.as_tensor(mini_batch[0])
+        with torch.no_grad():
+            teacher_q_values = self.teacher.forward(states)
+        return self.dqn.distill(self.center_crop(states), teacher_q_values)
+
+    def update(self, next_batch, losses):
+        """
+        Update on the mini-batch returned by next_batch() run by the learner
+        thread, then publish the new weights to the acting network
+        """
+        losses.append(self.train_step(next_batch()))
+        if self.act_network is not None:
+            with self._publish_lock:
+                self.act_network.load_state_dict(
+                    self.dqn.q_network.state_dict())
+
+    def copy_to_target_network(self):
+        with self._publish_lock:
+            self.dqn.copy_to_target_network()
+
+    def restart_agents(self, terminal):
+        """
+        Restart the agents whose episode is over, with a blank frame history,
+        returns the terminal flags of the agents after the restart, to pass
+        to the next step
+        """
+        over = [i for i in range(self.agents) if terminal[i]]
+        self.env.reset_agents(over)
+        self.buffer.clear_history(over)
+        return [False] * self.agents
+
+    def center_crop(self, states):
+        """ Centre of the states, of the size seen by the network """
+        crop = tuple(slice((n - c) // 2, (n - c) // 2 + c) for n, c in zip(
+            states.shape[-3:], self.dqn.q_network.image_size))
+        return states[(Ellipsis,) + crop]
 
     def init_memory(self):
         self.logger.log("Initialising memory buffer...")
         pbar = tqdm(desc="Memory buffer", total=self.init_memory_size)
         while len(self.buffer) < self.init_memory_size:
+            if self.prefill_episodes > 0:
+                for episode in random_episodes(self.env,
+                                               self.prefill_episodes,
+                                               self.steps_per_episode):
+                    self.buffer.extend(*episode)
+                    pbar.update(len(episode[1]))
+                    if len(self.buffer) >= self.init_memory_size:
+                        break
+                continue
             # Reset the environment for the start of the episode.
             obs = self.env.reset()
             terminal = [False for _ in range(self.agents)]
@@ -131,22 +359,50 @@ class Trainer(object):
     def validation_epoch(self, episode):
         if self.eval_env is None:
             return
+        if self.validator is not None:
+            if self.validator.busy():
+                self.logger.log(f"validation still running, skipping the "
+                                f"validation of episode {episode}")
+            else:
+                self.validator.submit(episode,
+                                      self.dqn.q_network.state_dict())
+            return
         self.dqn.q_network.train(False)
         epoch_distances = []
-        for k in range(self.eval_env.files.num_files):
-            self.logger.log(f"eval episode {k}")
-            (score, start_dists, q_values,
-                info) = self.evaluator.play_one_episode()
-            epoch_distances.append([info['distError_' + str(i)]
-                                    for i in range(self.agents)])
+        # timed apart from the training steps
+        with timers.section("validation"):
+            for k, (score, start_dists, q_values, info) in enumerate(
+                    self.evaluator.play_episodes()):
+                self.logger.log(f"eval episode {k}")
+                epoch_distances.append([info['distError_' + str(i)]
+                                        for i in range(self.agents)])
+        self.record_validation(epoch_distances, episode,
+                               self.dqn.q_network.state_dict())
+        self.dqn.q_network.train(True)
+
+    def poll_validation(self, wait=False):
+        """ Record the result of the background validation if it is over """
+        if self.validator is None:
+            return
+        result = self.validator.result(wait)
+        if result is not None:
+            episode, state_dict, infos = result
+            self.record_validation(
+                [[info['distError_' + str(i)] for i in range(self.agents)]
+                 for info in infos], episode, state_dict)
 
+    def record_validation(self, epoch_distances, episode, state_dict):
+        """
+        Log the validation distances of the weights state_dict of episode,
+        saved as best_dqn.pt if they are the best so far
+        """
         val_dists = self.append_epoch_board(epoch_distances, name="eval",
                                             episode=episode)
         if (val_dists < self.best_val_distance):
             self.logger.log("Improved new best mean validation distances")
             self.best_val_distance = val_dists
-            self.dqn.save_model(name="best_dqn.pt", forced=True)
-        self.dqn.q_network.train(True)
+            self.logger.save_model(state_dict, name="best_dqn.pt",
+                                   forced=True)
 
     def append_episode_board(self, info, score, name="train", episode=0):
         dists = {str(i):
@@ -187,15 +443,100 @@ class Trainer(object):
         return actions, q_values
 
     def get_greedy_actions(self, obs_stack, doubleLearning=True):
-        inputs = torch.tensor(obs_stack).unsqueeze(0)
-        if doubleLearning:
-            q_vals = self.dqn.q_network.forward(inputs).detach().squeeze(0)
-        else:
-            q_vals = self.dqn.target_network.forward(
-                inputs).detach().squeeze(0)
-        idx = torch.max(q_vals, -1)[1]
-        greedy_steps = np.array(idx, dtype=np.int32).flatten()
-        return greedy_steps, q_vals.data.numpy()
+        inputs = torch.from_numpy(obs_stack).unsqueeze(0)
+        with self._publish_lock:
+            if doubleLearning:
+                return self.act_runner.greedy(inputs)
+            return self.target_runner.greedy(inputs)
+
+    def save_snapshot(self, directory, episode):
+        """
+        Start a snapshot of everything needed to resume training into
+        directory, completed by commit_snapshot. The replay buffer is
+        written in the background into the slot of directory ("a" or "b")
+        not holding the latest complete snapshot, which is kept until the
+        new one is complete.
+        """
+        # the previous snapshot may still be written
+        self.commit_snapshot(episode, wait=True)
+        slot = "b" if self._latest_slot(directory) == "a" else "a"
+        self.logger.log(f"Saving training snapshot to "
+                        f"{os.path.join(directory, slot)}")
+        self.buffer.save(os.path.join(directory, slot, "memory"))
+        self._snapshot = (directory, slot)
+
+    def commit_snapshot(self, episode, wait=False, learner=None):
+        """
+        Complete the snapshot started by save_snapshot with the networks,
+        optimiser, scheduler, epsilon and RNG states after episode, once the
+        replay buffer is written (or waiting for it), and make it the latest
+        snapshot. The transitions appended meanwhile are added to the buffer
+        snapshot at the same time, so that both match.
+        :param learner: LearnerThread whose updates are waited for before
+            the networks are saved
+        """
+        if self._snapshot is None or not (
+                wait or self.buffer.snapshot_written()):
+            return
+        directory, slot = self._snapshot
+        self._snapshot = None
+        if learner is not None:
+            learner.wait()
+        self.buffer.wait_snapshot()
+        state = {"q_network": self.dqn.q_network.state_dict(),
+                 "target_network": self.dqn.target_network.state_dict(),
+                 "optimiser": self.dqn.optimiser.state_dict(),
+                 "scheduler": self.dqn.scheduler.state_dict(),
+                 "eps": self.eps,
+                 "episode": episode,
+                 "best_val_distance": self.best_val_distance,
+                 "torch_rng": torch.get_rng_state(),
+                 "numpy_rng": np.random.get_state(),
+                 "python_rng": random.getstate(),
+                 "sample_rng": self.sample_rng.get_state()}
+        path = os.path.join(directory, slot, "trainer.pt")
+        torch.save(state, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        latest = os.path.join(directory, "latest")
+        with open(latest + ".tmp", "w") as f:
+            f.write(slot)
+        os.replace(latest + ".tmp", latest)
+        self.logger.log(f"Training snapshot of episode {episode} saved")
+
+    @staticmethod
+    def _latest_slot(directory):
+        """ Slot of the latest complete snapshot in directory, or None """
+        latest = os.path.join(directory, "latest")
+        if not os.path.exists(latest):
+            return None
+        with open(latest) as f:
+            return f.read().strip()
+
+    def load_snapshot(self, directory):
+        """
+        Restore the latest snapshot written in directory by save_snapshot,
+        returns the episode it was taken at.
+        """
+        slot = self._latest_slot(directory)
+        assert slot is not None, f"No complete snapshot in {directory}"
+        self.logger.log(f"Resuming training from "
+                        f"{os.path.join(directory, slot)}")
+        state = torch.load(os.path.join(directory, slot, "trainer.pt"),
+                           map_location="cpu", weights_only=False)
+        self.dqn.q_network.load_state_dict(state["q_network"])
+        self.dqn.target_network.load_state_dict(state["target_network"])
+        self.dqn.optimiser.load_state_dict(state["optimiser"])
+        self.dqn.scheduler.load_state_dict(state["scheduler"])
+        self.eps = state["eps"]
+        self.best_val_distance = state["best_val_distance"]
+        torch.set_rng_state(state["torch_rng"])
+        np.random.set_state(state["numpy_rng"])
+        random.setstate(state["python_rng"])
+        self.sample_rng.set_state(state["sample_rng"])
+        self.buffer.load(os.path.join(directory, slot, "memory"))
+        self.logger.log(f"Restored {len(self.buffer)} transitions, "
+                        f"episode {state['episode']}, eps {self.eps}")
+        return state["episode"]
 
     def set_reproducible(self):
         torch.manual_seed(0)